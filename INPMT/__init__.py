@@ -18,37 +18,42 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 # Built-ins
-import os
+import importlib
 import sys
-
-# 3rd party
-import alive_progress
+from typing import Any
 
 # 1st party
 try:
-    from __main__ import run
     from _version import __version__
 except ImportError:
-    from INPMT.__main__ import run
     from INPMT._version import __version__
 
 
-# If the python version is too old, the code will not execute
-if f"{sys.version_info[0]}.{sys.version_info[1]}" != "3.10":
-    raise Exception("Python 3.10 is required.")
-
-# To avoid writing venv's python path everytime
-# Might be overridden by the setup.py entry points
-os.environ["PATH"] = sys.executable
-
 __file__ = sys.modules[__name__]
 __doc__ = sys.modules[__name__].__doc__
 
 __all__ = (
     "__doc__",
     "__version__",
+    "prepare",
     "run",
 )
 
-# Progress bar settings
-alive_progress.config_handler.set_global(length=20, force_tty=True)
+# Functions imported on first use, so importing the package (in a worker process or to print the version) doesn't
+# import geopandas, rasterio, pandas and alive_progress
+LAZY = {
+    "prepare": "__main__",
+    "run": "__main__",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f"{__name__}.{LAZY[name]}"), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(LAZY))
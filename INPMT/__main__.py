@@ -17,61 +17,439 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import argparse
 import os
+import sys
 import warnings
 
-import rioxarray as rxr
+import pandas as pd
 from pandas import DataFrame
 
 try:
-    from processing import get_urban_profile
+    from processing import (
+        BUFFER_MASKS,
+        LAYERS,
+        PARK_COLUMNS,
+        STACK_LAYOUTS,
+        estimate_urban_profile,
+        get_dtypes,
+        iter_urban_profile,
+    )
+    from utils.aggregate import RINGS, ParkAggregator
+    from utils.layers import Layer, read_layers
+    from utils.raster import (
+        MemmapReader,
+        RasterReader,
+        is_prepared,
+        open_dataset,
+        prepare_raster,
+    )
+    from utils.report import RunReport
+    from utils.writer import FORMATS, ProfileWriter
 except ImportError:
-    from INPMT.processing import get_urban_profile
+    from INPMT.processing import (
+        BUFFER_MASKS,
+        LAYERS,
+        PARK_COLUMNS,
+        STACK_LAYOUTS,
+        estimate_urban_profile,
+        get_dtypes,
+        iter_urban_profile,
+    )
+    from INPMT.utils.aggregate import RINGS, ParkAggregator
+    from INPMT.utils.layers import Layer, read_layers
+    from INPMT.utils.raster import (
+        MemmapReader,
+        RasterReader,
+        is_prepared,
+        open_dataset,
+        prepare_raster,
+    )
+    from INPMT.utils.report import RunReport
+    from INPMT.utils.writer import FORMATS, ProfileWriter
 
 warnings.filterwarnings("ignore")
 
 
-def run(datasets: str) -> DataFrame:
+def get_prepared_path(store: str, file: str) -> str:
+    """
+    :param store: Path to the directory of the prepared rasters
+    :type store: str
+    :param file: Name of the file of the raster
+    :type file: str
+    :return: The path to the prepared raster
+    :rtype: str
+    """
+    return os.path.join(store, f"{os.path.splitext(file)[0]}.npy")
+
+
+def get_layers(datasets: str, layers: str | None = None) -> dict[str, Layer]:
+    """
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param layers: Path to the JSON file of the registry of the rasters, layers.json in the datasets directory if it
+        exists
+    :type layers: str | None
+    :return: The layers, by name
+    :rtype: dict[str, Layer]
+    """
+    if layers is None and os.path.exists(os.path.join(datasets, "layers.json")):
+        layers = os.path.join(datasets, "layers.json")
+    return read_layers(layers, LAYERS)
+
+
+def open_rasters(
+    datasets: str,
+    settings: dict[str, Layer],
+    store: str | None = None
+) -> list[RasterReader | MemmapReader]:
+    """
+    Open the raster of every layer, the windows around the villages being read from the files (or the memory mapped
+    arrays of the prepared rasters) when needed.
+
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param settings: The layers, by name
+    :type settings: dict[str, Layer]
+    :param store: Path to the directory of the prepared rasters, the prepared directory of the datasets if it exists
+    :type store: str | None
+    :return: The rasters of the layers having a file
+    :rtype: list[RasterReader | MemmapReader]
+    """
+    if store is None and os.path.isdir(os.path.join(datasets, "prepared")):
+        store = os.path.join(datasets, "prepared")
+    rasters = []
+    try:
+        for name, layer in settings.items():
+            if not layer.file:
+                continue
+            path = os.path.join(datasets, layer.file)
+            if store is not None:
+                prepared = get_prepared_path(store, layer.file)
+                if is_prepared(path, prepared):
+                    path = prepared
+                else:
+                    print(f"{layer.file} is not prepared or changed since, it is read from the file")
+            rasters.append(open_dataset(path, name=name))
+    except Exception:
+        # The rasters already opened are closed when one of them can't be
+        for dataset in rasters:
+            dataset.close()
+        raise
+    return rasters
+
+
+def prepare(datasets: str, store: str | None = None, layers: str | None = None) -> None:
+    """
+    Convert the raster of every layer once into an uncompressed array which is memory mapped by the next runs, instead
+    of decompressing the GeoTIFF files at each run. The rasters already prepared since their last change are skipped.
+
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param store: Path to the directory of the prepared rasters, the prepared directory of the datasets by default
+    :type store: str | None
+    :param layers: Path to the JSON file of the registry of the rasters, layers.json in the datasets directory if it
+        exists
+    :type layers: str | None
+    """
+    store = store or os.path.join(datasets, "prepared")
+    for layer in get_layers(datasets, layers).values():
+        if not layer.file:
+            continue
+        path, prepared = os.path.join(datasets, layer.file), get_prepared_path(store, layer.file)
+        if is_prepared(path, prepared):
+            print(f"{layer.file} is already prepared")
+            continue
+        prepare_raster(path, prepared)
+        print(f"{layer.file} prepared in {prepared}")
+
+
+def run(
+    datasets: str,
+    radii: list[int] = (500, 2000),
+    workers: int = 1,
+    cache: str | None = None,
+    checkpoint: str | None = None,
+    output: str | None = None,
+    return_profile: bool = True,
+    spatial_order: bool = False,
+    buffer_mask: str = "circle",
+    report: bool = False,
+    layers: str | None = None,
+    store: str | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    ids: list[str] | None = None,
+    output_format: str | None = None,
+    stack_layout: str = "wide",
+    nearest: int = 0,
+    max_distance: float = 50000.,
+    rings: tuple[float, ...] | None = None,
+    min_pixels: int = 1
+) -> DataFrame | None:
     """
     Retrieves the datasets path and executes the functions.
     For the countries, i only execute it like that.
-    For the villages, i execute first after setting the buffer parameter to
-        500, then i execute it after setting the
-    parameter to 2000. Then i merge the two results.
+    For the villages, the statistics are computed for every buffer size (500
+        and 2000 by default) and suffixed by it.
+    The profile is written batch after batch while the villages are processed,
+        in a CSV, Parquet or Arrow IPC file depending on its extension.
 
-    :return: Nothing
-    :rtype: None
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param workers: Number of worker processes used to process the villages
+    :type workers: int
+    :param cache: Path to the SQLite file caching the statistics between runs
+    :type cache: str | None
+    :param checkpoint: Path to the directory used to resume the run if it stops before the end, with the same rasters
+        and settings
+    :type checkpoint: str | None
+    :param output: Path to the output file, profile_villages.csv in the datasets directory by default
+    :type output: str | None
+    :param return_profile: Whether to keep the profile in memory to return it. Set it to False for very large layers.
+    :type return_profile: bool
+    :param spatial_order: Whether to process the villages along a Hilbert curve, which reads less blocks of the
+        rasters but writes the villages in that order (the returned DataFrame is sorted back)
+    :type spatial_order: bool
+    :param buffer_mask: Shape of the buffers: 'square' (bounding box of the circle), 'circle' (pixels whose centre is
+        in the circle) or 'coverage' (pixels weighted by the fraction of their area in the circle)
+    :type buffer_mask: str
+    :param report: Whether to write the time spent in each stage and the counters of the run (pixels read, villages
+        failed...) as a JSON file next to the output file
+    :type report: bool
+    :param layers: Path to the JSON file of the registry of the rasters (file, kind, legend, statistics, scale, offset,
+        nodata and dtype), layers.json in the datasets directory if it exists. The layers and settings missing are the
+        default ones, or the ones of the metadata of the rasters.
+    :type layers: str | None
+    :param store: Path to the directory of the rasters converted by the ***prepare*** function, the prepared directory
+        of the datasets if it exists. The rasters which changed since they were prepared are read from their file.
+    :type store: str | None
+    :param bbox: Bounds (xmin, ymin, xmax, ymax) of the villages to process, in the CRS of the villages shapefile
+    :type bbox: tuple[float, float, float, float] | None
+    :param ids: IDs of the villages to process (their name with underscores, as in the ID column of the profile)
+    :type ids: list[str] | None
+    :param output_format: 'csv', 'parquet' or 'arrow', the extension of the output file by default
+    :type output_format: str | None
+    :param stack_layout: Layout of the statistics of the layers with several bands: 'wide' (a column per band) or
+        'long' (a row per village and band, with a band column)
+    :type stack_layout: str
+    :param nearest: Number of nearest parks added to the profile of each village (NP_1, loc_NP_1, dist_NP_1...), 0 to
+        only keep the nearest one
+    :type nearest: int
+    :param max_distance: Distance beyond which the parks are not among the nearest ones, unless they contain the village
+    :type max_distance: float
+    :param rings: Limits of the distance rings around the parks, starting at 0. If set, the number of villages and
+        the mean prevalence and NDVI of each park by ring are written in a file next to the output file, suffixed
+        with _parks.
+    :type rings: tuple[float, ...] | None
+    :param min_pixels: Minimum number of pixels of the smallest buffer in every raster. The villages below it, the ones
+        whose buffers are not fully inside the rasters and the ones without geometry are flagged in the flag column.
+    :type min_pixels: int
+    :return: A DataFrame of the processed values
+    :rtype: DataFrame | None
     """
-    # Convert all raster data as xarray DataArrays
-    population = rxr.open_rasterio(os.path.join(datasets, "POPULATION_AFRICA_100m_reprj3857.tif"))
-    landuse = rxr.open_rasterio(os.path.join(datasets, "LANDUSE_ESACCI-LC-L4-LC10-Map-300m-P1Y-2016-v1.0_reprj3857.tif"))
-    ndvi = rxr.open_rasterio(os.path.join(datasets, "NDVI_MOD13A1.006__300m_16_days_NDVI_doy2016_aid0001_reprj3857.tif"))
-    swi = rxr.open_rasterio(os.path.join(datasets, "SWI_c_gls_SWI10_QL_2016_AFRICA_ASCAT_V3.1.1_reprj3857.tif"))
-    gws = rxr.open_rasterio(os.path.join(datasets, "GWS_seasonality_AFRICA_reprj3857.tif"))
-    prevalence = rxr.open_rasterio(os.path.join(datasets, "PREVALENCE_2019_Global_PfPR_2016_reprj3857.tif"))
-
-    # Add name attribute
-    population.name = 'population'
-    landuse.name = 'landuse'
-    ndvi.name = 'ndvi'
-    swi.name = 'swi'
-    gws.name = 'gws'
-    prevalence.name = 'prevalence'
+    run_report = RunReport()
+    settings = get_layers(datasets, layers)
+    aggregator = None
+    if rings is not None:
+        columns = [f"{column}_{radius}" for radius in sorted(radii) for column in PARK_COLUMNS]
+        aggregator = ParkAggregator(columns, rings, nearest)
 
     # Convert all vector data as a WKT geometry
     national_parks_with_anopheles_kyalo = os.path.join(datasets, "NATIONAL_PARKS_WDPA_Africa_anopheles.shp")
     anopheles_kyalo = os.path.join(datasets, "KYALO.shp")
 
-    profile_villages = get_urban_profile(
-        datasets=datasets,
-        villages=anopheles_kyalo,
-        parks=national_parks_with_anopheles_kyalo,
-        population=population,
-        landuse=landuse,
-        ndvi=ndvi,
-        swi=swi,
-        gws=gws,
-        prevalence=prevalence)
-    profile_villages.to_csv(os.path.join(datasets, 'profile_villages.csv'))
+    batches = []
+    output = output or os.path.join(datasets, 'profile_villages.csv')
+    rasters = open_rasters(datasets, settings, store)
+    try:
+        profile_villages = iter_urban_profile(
+            datasets=datasets,
+            villages=anopheles_kyalo,
+            parks=national_parks_with_anopheles_kyalo,
+            rasters=rasters,
+            radii=radii,
+            workers=workers,
+            cache=cache,
+            checkpoint=checkpoint,
+            spatial_order=spatial_order,
+            buffer_mask=buffer_mask,
+            report=run_report,
+            layers=settings,
+            bbox=bbox,
+            ids=ids,
+            stack_layout=stack_layout,
+            nearest=nearest,
+            max_distance=max_distance,
+            aggregator=aggregator,
+            min_pixels=min_pixels)
+        with run_report.timer("total"), ProfileWriter(
+            output, dtypes=get_dtypes(settings, radii, nearest), file_format=output_format
+        ) as writer:
+            for batch in profile_villages:
+                with run_report.timer("write"):
+                    writer.write(batch)
+                if return_profile:
+                    batches.append(batch)
+    finally:
+        for dataset in rasters:
+            dataset.close()
+    if aggregator is not None:
+        stem, extension = os.path.splitext(output)
+        with ProfileWriter(f"{stem}_parks{extension}", dtypes={"NP": object, "ring": object, "villages": "int64"},
+                           file_format=output_format, index=False) as writer:
+            writer.write(aggregator.to_dataframe())
+    if report:
+        run_report.write(f"{os.path.splitext(output)[0]}_report.json")
     print("Jesus was black.")
-    return profile_villages
+    return pd.concat(batches).sort_index(kind="stable") if return_profile else None
+
+
+def estimate(
+    datasets: str,
+    radii: list[int] = (500, 2000),
+    workers: int = 1,
+    buffer_mask: str = "circle",
+    layers: str | None = None,
+    store: str | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    ids: list[str] | None = None,
+    sample: int = 100
+) -> DataFrame:
+    """
+    Estimate the pixels a run would read, the memory of its chunks and its time, without running it (see
+    ***estimate_urban_profile***), so a large run can be scheduled with the resources it needs.
+
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param workers: Number of worker processes of the run
+    :type workers: int
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param layers: Path to the JSON file of the registry of the rasters, layers.json in the datasets directory if it
+        exists
+    :type layers: str | None
+    :param store: Path to the directory of the prepared rasters, the prepared directory of the datasets if it exists
+    :type store: str | None
+    :param bbox: Bounds (xmin, ymin, xmax, ymax) of the villages to process, in the CRS of the villages shapefile
+    :type bbox: tuple[float, float, float, float] | None
+    :param ids: IDs of the villages to process
+    :type ids: list[str] | None
+    :param sample: Number of villages processed to time the statistics, 0 to skip the time
+    :type sample: int
+    :return: The villages, pixels, bytes, memory of a chunk and seconds of each raster and in total
+    :rtype: DataFrame
+    """
+    settings = get_layers(datasets, layers)
+    rasters = open_rasters(datasets, settings, store)
+    try:
+        return estimate_urban_profile(
+            datasets=datasets,
+            villages=os.path.join(datasets, "KYALO.shp"),
+            rasters=rasters,
+            radii=radii,
+            workers=workers,
+            buffer_mask=buffer_mask,
+            layers=settings,
+            bbox=bbox,
+            ids=ids,
+            sample=sample)
+    finally:
+        for dataset in rasters:
+            dataset.close()
+
+
+def read_ids(values: list[str]) -> list[str] | None:
+    """
+    :param values: IDs, or paths to text files of one ID per line prefixed with @
+    :type values: list[str]
+    :return: The IDs, None if there is none
+    :rtype: list[str] | None
+    """
+    ids = []
+    for value in values:
+        if value.startswith("@"):
+            with open(value[1:], encoding="utf-8") as file:
+                ids += [line.strip() for line in file if line.strip()]
+        else:
+            ids.append(value)
+    return ids or None
+
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="INPMT", description="Impact of National Parks on Malaria Transmission: profile of the villages"
+    )
+    parser.add_argument("datasets", help="Path to the datasets")
+    parser.add_argument("--radii", type=int, nargs="+", default=[500, 2000], help="Sizes of the buffers")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+                        help="Only process the villages inside these bounds, in the CRS of the villages")
+    parser.add_argument("--ids", nargs="+", default=[],
+                        help="Only process the villages with these IDs, or the ones listed in @file (one per line)")
+    parser.add_argument("--output", help="Path to the output file, profile_villages.csv in the datasets by default")
+    parser.add_argument("--format", choices=sorted(set(FORMATS.values())),
+                        help="Format of the output file, its extension by default")
+    parser.add_argument("--buffer-mask", choices=BUFFER_MASKS, default="circle", help="Shape of the buffers")
+    parser.add_argument("--stack-layout", choices=STACK_LAYOUTS, default="wide",
+                        help="A column per band of the stacks (wide) or a row per village and band (long)")
+    parser.add_argument("--nearest", type=int, default=0, help="Number of nearest parks of each village to add")
+    parser.add_argument("--max-distance", type=float, default=50000.,
+                        help="Distance beyond which the parks are ignored, unless they contain the village")
+    parser.add_argument("--rings", type=float, nargs="*",
+                        help=f"Write the profile of the parks by distance ring, with these limits ({RINGS} if empty)")
+    parser.add_argument("--min-pixels", type=int, default=1,
+                        help="Minimum number of pixels of the smallest buffer below which a village is flagged")
+    parser.add_argument("--cache", help="Path to the SQLite file caching the statistics between runs")
+    parser.add_argument("--checkpoint", help="Path to the directory used to resume the run")
+    parser.add_argument("--spatial-order", action="store_true", help="Process the villages along a Hilbert curve")
+    parser.add_argument("--report", action="store_true", help="Write the timers and counters of the run")
+    parser.add_argument("--layers", help="Path to the JSON file of the registry of the rasters")
+    parser.add_argument("--store", help="Path to the directory of the prepared rasters")
+    parser.add_argument("--prepare", action="store_true", help="Prepare the rasters for the next runs and exit")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Estimate the pixels read, the memory and the time of the run without running it")
+    parser.add_argument("--sample", type=int, default=100, help="Number of villages timed by the dry run")
+    options = parser.parse_args(args)
+
+    if options.prepare:
+        prepare(options.datasets, options.store, options.layers)
+        return 0
+    ids = read_ids(options.ids)
+    if options.dry_run:
+        estimation = estimate(
+            options.datasets, options.radii, options.workers, options.buffer_mask, options.layers, options.store,
+            options.bbox, ids, options.sample
+        )
+        print(estimation.to_string(float_format="{:.3f}".format))
+        return 0
+    run(
+        datasets=options.datasets,
+        radii=options.radii,
+        workers=options.workers,
+        cache=options.cache,
+        checkpoint=options.checkpoint,
+        output=options.output,
+        return_profile=False,
+        spatial_order=options.spatial_order,
+        buffer_mask=options.buffer_mask,
+        report=options.report,
+        layers=options.layers,
+        store=options.store,
+        bbox=options.bbox,
+        ids=ids,
+        output_format=options.format,
+        stack_layout=options.stack_layout,
+        nearest=options.nearest,
+        max_distance=options.max_distance,
+        rings=None if options.rings is None else tuple(options.rings) or RINGS,
+        min_pixels=options.min_pixels,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
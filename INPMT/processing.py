@@ -19,139 +19,922 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import os
 import warnings
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import cache
 from typing import Any, AnyStr
 
+import alive_progress
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-import xarray as xr
 from alive_progress import alive_bar
-from geopandas import GeoDataFrame
+from geopandas import GeoDataFrame, GeoSeries
 from pandas import DataFrame
 
 try:
+    from utils.aggregate import ParkAggregator
+    from utils.cache import (
+        ZonalCache,
+        get_geometry_keys,
+    )
+    from utils.checkpoint import (
+        read_checkpoint,
+        write_checkpoint,
+        write_errors,
+    )
+    from utils.layers import Layer
     from utils.raster import (
-        get_pixel_count,
+        MemmapReader,
+        RasterReader,
+        get_fingerprint,
+        open_dataset,
     )
+    from utils.report import RunReport
     from utils.utils import (
-        clip,
+        ResultAccumulator,
+        get_hilbert_order,
         read_qml,
         strip,
     )
+    from utils.zonal import (
+        SUBPIXEL_BINS,
+        crop_windows,
+        get_buffer_mask,
+        get_centred_windows,
+        get_local_resolution,
+        get_subpixel_offsets,
+        get_windows,
+        group_windows,
+        is_reprojected,
+        read_windows,
+        reduce_windows,
+        reproject_points,
+    )
 except ImportError:
+    from INPMT.utils.aggregate import ParkAggregator
+    from INPMT.utils.cache import (
+        ZonalCache,
+        get_geometry_keys,
+    )
+    from INPMT.utils.checkpoint import (
+        read_checkpoint,
+        write_checkpoint,
+        write_errors,
+    )
+    from INPMT.utils.layers import Layer
     from INPMT.utils.raster import (
-        get_pixel_count,
+        MemmapReader,
+        RasterReader,
+        get_fingerprint,
+        open_dataset,
     )
+    from INPMT.utils.report import RunReport
     from INPMT.utils.utils import (
-        clip,
+        ResultAccumulator,
+        get_hilbert_order,
         read_qml,
         strip,
     )
+    from INPMT.utils.zonal import (
+        SUBPIXEL_BINS,
+        crop_windows,
+        get_buffer_mask,
+        get_centred_windows,
+        get_local_resolution,
+        get_subpixel_offsets,
+        get_windows,
+        group_windows,
+        is_reprojected,
+        read_windows,
+        reduce_windows,
+        reproject_points,
+    )
 
 warnings.filterwarnings("ignore")
 
+# Progress bar settings
+alive_progress.config_handler.set_global(length=20, force_tty=True)
+
+# Rasters processed around the villages, with their file and legend in the datasets directory, the statistics computed
+# as (column, statistic) in the order of the columns of the profile, and the settings of their values. The categories
+# of the categorical rasters are also computed. Rasters are added or changed with a JSON file (see ***read_layers***)
+# and the settings left to None are read from the metadata of the rasters.
+# HAB_DIV: the "distinct" statistic is the number of different values, counted along with the landuse categories.
+# NDVI: I divide by 10 000 because Normalized Difference Vegetation Index is usually between -1 and 1.
+# SWI: https://land.copernicus.eu/global/products/SWI I divide by a 2 because SWI data must be between 0 and 100.
+# PREVALENCE: https://malariaatlas.org/explorer/#/ I multiply by 100 because PREVALENCE is a percentage between 0 and
+# 100, and its nodata value is not the one of the metadata.
+LAYERS = {
+    "population": Layer(
+        "population",
+        file="POPULATION_AFRICA_100m_reprj3857.tif",
+        statistics=(("POP", "sum"),),
+    ),
+    "prevalence": Layer(
+        "prevalence",
+        file="PREVALENCE_2019_Global_PfPR_2016_reprj3857.tif",
+        statistics=(("PREVALENCE", "mean"),),
+        scale=100,
+        nodata=-9999.,
+    ),
+    "swi": Layer(
+        "swi",
+        file="SWI_c_gls_SWI10_QL_2016_AFRICA_ASCAT_V3.1.1_reprj3857.tif",
+        statistics=(("SWI", "sum"),),
+        scale=1 / 2,
+    ),
+    "ndvi": Layer(
+        "ndvi",
+        file="NDVI_MOD13A1.006__300m_16_days_NDVI_doy2016_aid0001_reprj3857.tif",
+        statistics=(("NDVI_min", "min"), ("NDVI_mean", "mean"), ("NDVI_max", "max")),
+        scale=1 / 10000,
+    ),
+    "landuse": Layer(
+        "landuse",
+        file="LANDUSE_ESACCI-LC-L4-LC10-Map-300m-P1Y-2016-v1.0_reprj3857.tif",
+        kind="categorical",
+        legend="LANDUSE_ESACCI-LC-L4-LC10-Map-300m-P1Y-2016-v1.0_reprj3857-2.qml",
+        legend_item="item",
+        statistics=(("HAB_DIV", "distinct"),),
+    ),
+    "gws": Layer(
+        "gws",
+        file="GWS_seasonality_AFRICA_reprj3857.tif",
+        kind="categorical",
+        legend="GWS_seasonality_AFRICA_reprj3857.qml",
+        legend_item="paletteEntry",
+    ),
+}
+# Types of the columns of the profile which are not floats
+DTYPES = {
+    "ID": object,
+    "NP": object,
+    "loc_NP": object,
+    "ANO_DIV": np.int64,
+    "band": object,
+    "flag": object,
+}
+# Shapes of the buffers: the bounding box of the circle, the pixels whose centre is in the circle, or the pixels
+# weighted by the fraction of their area in the circle
+BUFFER_MASKS = ("square", "circle", "coverage")
+# Statistics averaged by park and distance ring in the profile of the parks, for every buffer size
+PARK_COLUMNS = ("PREVALENCE", "NDVI_mean")
+# Layouts of the statistics of the stacks: a column per band, or a row per band with a band column
+STACK_LAYOUTS = ("wide", "long")
+
+
+def get_dtypes(layers: dict[str, Layer], radii: list[int], nearest: int = 0) -> dict[str, Any]:
+    """
+    Gather the types of the columns of the profile which are not float64: the ones of DTYPES, the ones of the k
+    nearest parks and the ones given to the statistics of the layers.
+
+    :param layers: Settings of the rasters
+    :type layers: dict[str, Layer]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param nearest: Number of nearest parks of each village
+    :type nearest: int
+    :return: The type of the columns, by name
+    :rtype: dict[str, Any]
+    """
+    dtypes = dict(DTYPES)
+    for n in range(1, nearest + 1):
+        dtypes.update({f"NP_{n}": object, f"loc_NP_{n}": object})
+    for layer in layers.values():
+        for radius in radii:
+            columns = [column for column, _ in layer.statistics]
+            # The long layout of the stacks names the columns without the band
+            for name in {*layer.get_columns(columns, radius), *(f"{column}_{radius}" for column in columns)}:
+                dtypes[name] = np.dtype(layer.dtype)
+    return dtypes
+
 
 def get_nearest_park(
         parks: GeoDataFrame,
-        geom_villages: GeoDataFrame
-) -> tuple[Any | None, str | None, str]:
-    """
-    For each polygon, I check the distance from the point to the boundary of the polygon and compare it to the minimum
-    distance found yet (at the start it's 100000 but it is modified in the first occurrence).
-    Every time a distance is smaller, the minimum distance it's reset.
-    Every time the distance from point to the centroid of the polygon equals 0, it means the polygon of villages is
-    inside the polygon of parks. In these cases I set it as a negative value.
-    :param geom_villages: A GeoDataFrame of the locations of mosquito counts of Africa
-    :type: geom_villages: GeoDataFrame
+        geom_villages: GeoSeries
+) -> DataFrame:
+    """
+    I build a spatial index on the boundaries of the parks once and query it with the centroids of every village at
+    the same time, which gives me the nearest park boundary and its distance for each village in a single batch.
+    When several boundaries are at the exact same distance, I keep the first park (like the former loop over the parks
+    did with its strict comparison).
+    Every time the polygon of the village is inside the polygon of the nearest park, I set the distance as a negative
+    value and the location as "P" (otherwise "B").
     :param parks: A GeoDataFrame of the national parks of Africa
-    :type: parks: GeoDataFrame
-    :return: A DataFrame of the result
+    :type parks: GeoDataFrame
+    :param geom_villages: A GeoSeries of the (buffered) locations of mosquito counts of Africa
+    :type: geom_villages: GeoSeries
+    :return: A DataFrame with the distance, the location and the name of the nearest park of each village
     :rtype: DataFrame
     """
-    name = None
-    loc_np = None
-    res_dist = None
-    min_dist = 1000000000000000
-    for i in range(len(parks)):
-        dist = parks.loc[i, "geometry"].boundary.distance(geom_villages.centroid)
-        if dist < min_dist:
-            min_dist = dist
-            name = parks.loc[i, "NAME"]
-            if parks.loc[i, "geometry"].contains(geom_villages):
-                res_dist = -min_dist
-                loc_np = "P"
-            else:
-                res_dist = min_dist
-                loc_np = "B"
-    return res_dist, loc_np, name
+    result = pd.DataFrame(index=geom_villages.index, columns=["dist_NP", "loc_NP", "NP"])
+    if parks.empty or geom_villages.empty:
+        return result
+    boundaries = parks.geometry.boundary.reset_index(drop=True)
+    (idx_villages, idx_parks), distances = boundaries.sindex.nearest(
+        geom_villages.centroid, return_all=True, return_distance=True
+    )
+    # Keep the first park of each village when there are ties
+    order = np.lexsort((idx_parks, idx_villages))
+    idx_villages, idx_parks, distances = idx_villages[order], idx_parks[order], distances[order]
+    _, first = np.unique(idx_villages, return_index=True)
+    idx_villages, idx_parks, distances = idx_villages[first], idx_parks[first], distances[first]
 
+    nearest_parks = parks.geometry.iloc[idx_parks].reset_index(drop=True)
+    villages = geom_villages.iloc[idx_villages].reset_index(drop=True)
+    inside = nearest_parks.contains(villages, align=False).to_numpy()
 
-def get_landuse(
-    dataset: xr.Dataset,
-    qml: list
-) -> tuple[DataFrame, int]:
+    rows = geom_villages.index[idx_villages]
+    result.loc[rows, "dist_NP"] = np.where(inside, -distances, distances)
+    result.loc[rows, "loc_NP"] = np.where(inside, "P", "B")
+    result.loc[rows, "NP"] = parks["NAME"].to_numpy()[idx_parks]
+    return result
+
+
+def get_nearest_parks(
+        parks: GeoDataFrame,
+        geom_villages: GeoSeries,
+        k: int = 3,
+        max_distance: float = 50000.
+) -> DataFrame:
     """
-    Use a shapefile and a raster file to process landuse nature and landuse percentage.
-    To do this, I first read the qml (legend file) to get the values and their corresponding labels.
-    Then I retrieve a number of pixels by values using the Counter object.
-    I process the category area and the landuse percentage using the pixel area and the polygon area
+    I query the spatial index of the boundaries of the parks with the centroids of every village at once, for the
+    parks closer than the maximum distance, and the spatial index of the parks for the ones containing the village,
+    which are always in reach however far their boundary is. I keep the k nearest ones of each village by distance to
+    their boundary (the first park on ties, like ***get_nearest_park***). As for the nearest park, the distance is
+    negative and the location is "P" when the village is inside the park (otherwise "B"). The villages with less than
+    k parks in reach have empty columns.
+
+    :param parks: A GeoDataFrame of the national parks of Africa
+    :type parks: GeoDataFrame
+    :param geom_villages: A GeoSeries of the (buffered) locations of mosquito counts of Africa
+    :type geom_villages: GeoSeries
+    :param k: Number of parks kept for each village
+    :type k: int
+    :param max_distance: Distance to their boundary beyond which the parks are ignored, unless they contain the village
+    :type max_distance: float
+    :return: A DataFrame with the name, the location and the distance of the k nearest parks of each village, in the
+        columns NP_1, loc_NP_1, dist_NP_1, NP_2...
+    :rtype: DataFrame
+    """
+    columns = [f"{column}_{n}" for n in range(1, k + 1) for column in ("NP", "loc_NP", "dist_NP")]
+    result = pd.DataFrame(index=geom_villages.index, columns=columns)
+    if parks.empty or geom_villages.empty or k == 0:
+        return result.astype({f"dist_NP_{n}": np.float64 for n in range(1, k + 1)})
+    boundaries = parks.geometry.boundary.reset_index(drop=True)
+    villages = geom_villages.reset_index(drop=True)
+    centroids = villages.centroid
+    near_villages, near_parks = boundaries.sindex.query(centroids, predicate="dwithin", distance=max_distance)
+    # A village deep inside a large park is further than the maximum distance from its boundary
+    in_villages, in_parks = parks.geometry.reset_index(drop=True).sindex.query(villages, predicate="within")
+    pairs = np.unique(np.concatenate([near_villages * len(parks) + near_parks, in_villages * len(parks) + in_parks]))
+    idx_villages, idx_parks = np.divmod(pairs, len(parks))
+    distances = boundaries.iloc[idx_parks].distance(centroids.iloc[idx_villages], align=False).to_numpy()
+    # Rank the parks of each village by distance, the first park first on ties
+    order = np.lexsort((idx_parks, distances, idx_villages))
+    idx_villages, idx_parks, distances = idx_villages[order], idx_parks[order], distances[order]
+    starts = np.searchsorted(idx_villages, idx_villages, side="left")
+    ranks = np.arange(len(idx_villages)) - starts
+    keep = ranks < k
+    idx_villages, idx_parks, distances, ranks = idx_villages[keep], idx_parks[keep], distances[keep], ranks[keep]
+    inside = parks.geometry.iloc[idx_parks].contains(villages.iloc[idx_villages], align=False).to_numpy()
+    names = parks["NAME"].to_numpy()[idx_parks]
+    for n in range(1, k + 1):
+        rank = ranks == n - 1
+        rows = geom_villages.index[idx_villages[rank]]
+        result.loc[rows, f"NP_{n}"] = names[rank]
+        result.loc[rows, f"loc_NP_{n}"] = np.where(inside[rank], "P", "B")
+        result.loc[rows, f"dist_NP_{n}"] = np.where(inside[rank], -distances[rank], distances[rank])
+    return result.astype({f"dist_NP_{n}": np.float64 for n in range(1, k + 1)})
+
+
+def get_lookup_table(
+    qml: list,
+    unknown: str = "Unknown"
+) -> tuple[np.ndarray, int, list[str]]:
+    """
+    Turn a legend into a dense lookup array giving the position of the label of every value, so the labels of all the
+    pixels are retrieved at once instead of scanning the legend for each value.
+    The values which are not in the legend, or are outside its range, get the position of the unknown label, which is
+    always the last one. When a value is in the legend several times, its first label is kept.
 
-    :param dataset: Path to the dataset file
-    :type dataset: AnyStr
     :param qml: List of qml values
     :type qml: list
-    :return: A DataFrame updated with the processed values
-    :rtype: tuple(DataFrame, SupportsInt)
-    """
-    df = get_pixel_count(dataset=dataset)
-    len_df = len(df)
-    for i, r in df.iterrows():
-        label = "Unknown"
-        for category in qml:
-            # https://stackoverflow.com/a/8948303/12258568
-            if int(float(r["cat"])) == int(category[0]):
-                label = category[1]
-                break
-        df.loc[i, "Label"] = label
-    df = df.pivot_table(columns="Label",
-                        values="Proportion (%)",
-                        aggfunc="sum")
-    return df, len_df
+    :param unknown: Label of the values which are not in the legend
+    :type unknown: str
+    :return: The lookup array, the offset to subtract from the values to index it, and the labels
+    :rtype: tuple[np.ndarray, int, list[str]]
+    """
+    # https://stackoverflow.com/a/8948303/12258568
+    values = [int(float(category[0])) for category in qml]
+    labels = list(dict.fromkeys(category[1] for category in qml)) + [unknown]
+    offset = min(values, default=0) - 1
+    lut = np.full(max(values, default=0) - offset + 2, len(labels) - 1, dtype=np.intp)
+    for value, category in reversed(list(zip(values, qml))):
+        lut[value - offset] = labels.index(category[1])
+    return lut, offset, labels
 
 
-def get_urban_profile(
+def get_landuse(
+    stack: np.ndarray,
+    lookup_table: tuple[np.ndarray, int, list[str]],
+    weights: np.ndarray | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Use a stack of windows of a raster to process landuse nature and landuse percentage.
+    To do this, I retrieve the label of every pixel with the lookup table of the legend and count the pixels of each
+    label in each window with a single bincount. The percentages are returned for every label of the legend (even the
+    ones absent from the windows) so the columns of the result are always the same.
+    With weights (a buffer mask shared by the whole stack), the pixels outside the buffer are ignored and each pixel
+    counts for its weight.
+
+    :param stack: Stack of windows of shape (k, height, width)
+    :type stack: np.ndarray
+    :param lookup_table: Lookup table of the legend, from the ***get_lookup_table*** function
+    :type lookup_table: tuple[np.ndarray, int, list[str]]
+    :param weights: Weight of each pixel of the windows, of shape (height, width)
+    :type weights: np.ndarray | None
+    :return: The percentage of each label in each window, of shape (k, labels), and the number of values of each window,
+        NaN for the windows without pixels
+    :rtype: tuple(np.ndarray, np.ndarray)
+    """
+    lut, offset, labels = lookup_table
+    values = stack.reshape(len(stack), -1)
+    if weights is not None:
+        weights = weights.ravel()
+        values, weights = values[:, weights > 0], np.broadcast_to(weights[weights > 0], (len(stack), (weights > 0).sum()))
+    positions = np.clip(np.nan_to_num(values, nan=offset).astype(np.int64) - offset, 0, len(lut) - 1)
+    codes = lut[positions] + np.arange(len(stack))[:, None] * len(labels)
+    counts = np.bincount(
+        codes.ravel(), weights=None if weights is None else weights.ravel(), minlength=len(stack) * len(labels)
+    ).reshape(len(stack), len(labels))
+    # The windows without any pixel (villages outside the raster) get NaN, like their other statistics
+    with np.errstate(invalid="ignore", divide="ignore"):
+        proportions = counts * 100 / counts.sum(axis=1, keepdims=True)
+    if not values.shape[1]:
+        return proportions, np.full(len(stack), np.nan)
+    return proportions, (np.diff(np.sort(values, axis=1), axis=1) != 0).sum(axis=1) + 1
+
+
+def get_buffer_windows(
+    dataset: RasterReader,
+    geom_villages: GeoSeries,
+    radii: list[int],
+    buffer_mask: str = "circle"
+) -> tuple[dict[int, list[np.ndarray] | None], dict[int, tuple[np.ndarray, np.ndarray | None]]]:
+    """
+    Compute the windows of the buffers of every size around the villages in a raster, and the masks of their pixels.
+    The villages are read in the CRS of the raster: when it is not the one of the villages, the buffers are reprojected
+    instead of the raster. The square buffers are the bounds of the reprojected buffers. The circles are centred on the
+    reprojected villages with masks computed for the size of the pixels around each village in the CRS of the villages
+    (see ***get_local_resolution***) and its position inside its pixel (see ***get_subpixel_offsets***), one mask being
+    shared by all the villages with the same size of pixels in the same part of their pixel.
+
+    :param dataset: The raster
+    :type dataset: RasterReader
+    :param geom_villages: A GeoSeries of the locations of mosquito counts of Africa
+    :type geom_villages: GeoSeries
+    :param radii: Sizes of the buffers around the villages, in the units of the CRS of the villages
+    :type radii: list[int]
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :return: For every buffer size, the masks of the buffers (None for squares), and the windows of the villages with,
+        for each one, the mask of its buffer and the part of the mask matching its window (None for squares) as an
+        array of shape (n, 5)
+    :rtype: tuple[dict[int, list[np.ndarray] | None], dict[int, tuple[np.ndarray, np.ndarray | None]]]
+    """
+    transform, shape = dataset.transform, dataset.shape
+    reprojected = is_reprojected(geom_villages.crs, dataset.crs)
+    if buffer_mask == "square":
+        if reprojected:
+            bounds = {radius: geom_villages.buffer(radius).to_crs(dataset.crs).bounds.to_numpy() for radius in radii}
+        else:
+            # The bounds of a buffer are the bounds of the geometry pushed away by the size of the buffer
+            extent = geom_villages.bounds.to_numpy()
+            bounds = {radius: extent + np.array([-radius, -radius, radius, radius]) for radius in radii}
+        return dict.fromkeys(radii), {radius: (get_windows(transform, bounds[radius], shape), None) for radius in radii}
+    centroids = geom_villages.centroid
+    x, y = centroids.x.to_numpy(dtype=np.float64), centroids.y.to_numpy(dtype=np.float64)
+    if reprojected:
+        x, y = reproject_points(x, y, geom_villages.crs, dataset.crs)
+        resolutions = get_local_resolution(transform, dataset.crs, x, y, geom_villages.crs)
+        resolutions, groups = np.unique(resolutions, axis=0, return_inverse=True)
+        groups = groups.ravel()
+    else:
+        resolutions, groups = np.array([[transform.a, transform.e]]), np.zeros(len(x), dtype=np.int64)
+    # Each mask is shared by the villages with the same size of pixels in the same part of their pixel
+    parameters = np.column_stack([resolutions[groups], get_subpixel_offsets(transform, x, y)])
+    parameters, groups = np.unique(parameters, axis=0, return_inverse=True)
+    groups = groups.ravel()
+    masks, windows = {}, {}
+    for radius in radii:
+        masks[radius] = [
+            get_buffer_mask((float(a), float(e)), radius, buffer_mask == "coverage", (float(dx), float(dy)))
+            for a, e, dx, dy in parameters
+        ]
+        outer, keys = np.zeros((len(x), 4), dtype=np.int64), np.zeros((len(x), 5), dtype=np.int64)
+        for group, mask in enumerate(masks[radius]):
+            selected = groups == group
+            outer[selected], keys[selected, 1:] = get_centred_windows(transform, x[selected], y[selected], mask.shape, shape)
+            keys[selected, 0] = group
+        windows[radius] = (outer, keys)
+    return masks, windows
+
+
+def get_layer_settings(
+    layer: Layer,
+    lookup_table: tuple[np.ndarray, int, list[str]] | None = None,
+    buffer_mask: str = "circle"
+) -> list:
+    """
+    Gather the settings changing the statistics of a raster, to be fingerprinted along with it (see
+    ***get_fingerprint***) in the cache and in the checkpoint.
+
+    :param layer: Settings of the raster, resolved with its metadata
+    :type layer: Layer
+    :param lookup_table: Lookup table of the legend of the raster, if it is categorical
+    :type lookup_table: tuple[np.ndarray, int, list[str]] | None
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :return: The settings, JSON serializable
+    :rtype: list
+    """
+    return [
+        [layer.statistics, layer.scale, layer.offset, layer.nodata, layer.bands],
+        None if lookup_table is None else [lookup_table[0].tolist(), *lookup_table[1:]],
+        [buffer_mask, SUBPIXEL_BINS],
+    ]
+
+
+def get_zonal_stats(
+    geom_villages: GeoSeries,
+    rasters: list[RasterReader],
+    radii: list[int],
+    lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]],
+    zonal_cache: ZonalCache | None = None,
+    buffer_mask: str = "circle",
+    report: RunReport | None = None,
+    layers: dict[str, Layer] | None = None
+) -> DataFrame:
+    """
+    I compute the statistics of every raster for every village and every buffer size at once.
+    For each raster, I turn the bounds of the largest buffers into pixel windows with the affine transform of the
+    raster and read each window only once. The windows of the smaller buffers are nested in it so I crop them from the
+    pixels already read. Then I stack the windows having the same shape and reduce them together with NumPy, in the
+    dtype of the raster, with the scale, offset and nodata of its layer.
+    Unless the buffers are squares, the windows are centred on the pixel of each village and the pixels outside the
+    circle are masked with a mask computed once per buffer size and raster (see ***get_buffer_mask***).
+    The rasters don't need to be in the CRS of the villages: the buffers are reprojected in the CRS of each raster
+    (see ***get_buffer_windows***).
+    With a cache, I only compute the villages whose statistics are not stored yet for the current version of the raster
+    and I store them afterwards.
+    The time spent reading, reducing and labelling the windows and the number of pixels read are added to the report.
+
+    :param geom_villages: A GeoSeries of the locations of mosquito counts of Africa
+    :type geom_villages: GeoSeries
+    :param rasters: The rasters to process, named after the keys of the layers
+    :type rasters: list[RasterReader]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param lookup_tables: Lookup tables of the legends of the categorical rasters, by name
+    :type lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]]
+    :param zonal_cache: Cache of the statistics already computed
+    :type zonal_cache: ZonalCache | None
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param report: Report of the run
+    :type report: RunReport | None
+    :param layers: Settings of the rasters, LAYERS by default
+    :type layers: dict[str, Layer] | None
+    :return: A DataFrame of the statistics of each village, suffixed by the size of the buffer
+    :rtype: DataFrame
+    """
+    if buffer_mask not in BUFFER_MASKS:
+        raise UserWarning(f"Unknown buffer mask {buffer_mask}, choose one of {BUFFER_MASKS}")
+    report = report if report is not None else RunReport()
+    layers = LAYERS if layers is None else layers
+    layers = {dataset.name: layers.get(dataset.name, Layer(dataset.name)).resolve(dataset) for dataset in rasters}
+    radii = sorted(radii, reverse=True)
+    columns = {}
+    for dataset in rasters:
+        layer = layers[dataset.name]
+        for radius in radii:
+            columns.update(dict.fromkeys(layer.get_columns([column for column, _ in layer.statistics], radius), np.float64))
+            if dataset.name in lookup_tables:
+                columns.update(dict.fromkeys(layer.get_columns(lookup_tables[dataset.name][2], radius), np.float64))
+    result = ResultAccumulator(index=geom_villages.index, columns=columns)
+    keys = get_geometry_keys(geom_villages) if zonal_cache is not None else []
+    for dataset in rasters:
+        layer = layers[dataset.name]
+        lookup_table = lookup_tables.get(dataset.name)
+        names = {
+            radius: layer.get_columns([column for column, _ in layer.statistics], radius)
+            + (layer.get_columns(lookup_table[2], radius) if lookup_table is not None else [])
+            for radius in radii
+        }
+        todo = np.arange(len(geom_villages))
+        if zonal_cache is not None:
+            # Only the villages missing a buffer size of this raster in the cache are computed
+            fingerprint = get_fingerprint(dataset, get_layer_settings(layer, lookup_table, buffer_mask))
+            with report.timer("cache"):
+                cached = {radius: zonal_cache.get(keys, radius, fingerprint) for radius in radii}
+            found = np.array([all(key in cached[radius] for radius in radii) for key in keys], dtype=bool)
+            for radius in radii:
+                for column in names[radius]:
+                    result.set(column, found, [cached[radius][key][column] for key in np.asarray(keys)[found]])
+            todo = np.flatnonzero(~found)
+            report.count("cache_hits", found.sum() * len(radii))
+            report.count("cache_misses", len(todo) * len(radii))
+        if len(todo) == 0:
+            continue
+        masks, windows = get_buffer_windows(dataset, geom_villages.iloc[todo], radii, buffer_mask)
+        # The categorical layers may have no continuous statistic at all, their windows are then only labelled
+        reductions = [statistic for _, statistic in layer.statistics if statistic != "distinct"]
+        outer = windows[radii[0]][0]
+        with report.timer("read"):
+            # Every band of a stack is read with the same windows at once
+            pixels = read_windows(dataset, outer, None if layer.bands else 1)
+        report.count("windows_read", len(pixels))
+        report.count("pixels_read", sum(array.size for array in pixels))
+        for radius in radii:
+            arrays = crop_windows(pixels, windows[radius][0], outer)
+            report.count("windows_clipped", len(arrays))
+            for positions, stack, key in group_windows(arrays, windows[radius][1]):
+                # The windows of a group share the same part of the same mask (the whole mask, except near the edges)
+                weights = masks[radius][key[0]][key[1]:key[2], key[3]:key[4]] if masks[radius] is not None else None
+                # The bands of the windows of a stack are reduced together as windows of their own, then the values
+                # are split by band
+                by_band = lambda values: values.reshape(len(stack), -1).T
+                flat = stack.reshape(int(np.prod(stack.shape[:-2])), *stack.shape[-2:])
+                reduced = {}
+                if reductions:
+                    with report.timer("reduce"):
+                        reduced = reduce_windows(flat, reductions, layer.nodata, weights, layer.scale, layer.offset)
+                if lookup_table is not None:
+                    with report.timer("landuse"):
+                        proportions, reduced["distinct"] = get_landuse(flat, lookup_table, weights)
+                    for label, values in zip(lookup_table[2], proportions.T):
+                        for name, band_values in zip(layer.get_columns([label], radius), by_band(values)):
+                            result.set(name, todo[positions], band_values)
+                for column, statistic in layer.statistics:
+                    for name, values in zip(layer.get_columns([column], radius), by_band(reduced[statistic])):
+                        result.set(name, todo[positions], values)
+            if zonal_cache is not None:
+                with report.timer("cache"):
+                    zonal_cache.set(
+                        [keys[i] for i in todo],
+                        radius,
+                        fingerprint,
+                        [{column: result.columns[column][i] for column in names[radius]} for i in todo]
+                    )
+    return result.to_dataframe()
+
+
+def validate_villages(
+    geom_villages: GeoSeries,
+    rasters: list[RasterReader],
+    radii: list[int],
+    buffer_mask: str = "circle",
+    min_pixels: int = 1
+) -> pd.Series:
+    """
+    Check every village against every raster before processing them, with the bounds of their buffers and the windows
+    of the pixels they would read, so the villages which need care are known before the batches are made. A village is
+    flagged when:
+    - its geometry is missing or empty ('geometry', the other checks are skipped),
+    - its largest buffer, reprojected in the CRS of the raster, is outside the extent of a raster ('outside name') or
+        only partly inside ('edge name'),
+    - its smallest buffer holds less than min_pixels pixels of a raster ('pixels name'), counted from the windows and
+        the buffer mask without reading the raster.
+
+    :param geom_villages: A GeoSeries of the locations of mosquito counts of Africa
+    :type geom_villages: GeoSeries
+    :param rasters: The rasters to process
+    :type rasters: list[RasterReader]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param min_pixels: Minimum number of pixels of the smallest buffer
+    :type min_pixels: int
+    :return: The reasons the village is flagged, separated by ';', or None if it is valid
+    :rtype: pd.Series
+    """
+    centroids = geom_villages.centroid
+    x, y = centroids.x.to_numpy(dtype=np.float64), centroids.y.to_numpy(dtype=np.float64)
+    invalid = (geom_villages.isna() | geom_villages.is_empty).to_numpy() | ~np.isfinite(x) | ~np.isfinite(y)
+    x, y = np.where(invalid, 0., x), np.where(invalid, 0., y)
+    flags = np.where(invalid, "geometry;", "").astype(object)
+    valid = geom_villages[~invalid]
+    largest, smallest = max(radii), min(radii)
+    for dataset in rasters:
+        transform, (height, width) = dataset.transform, dataset.shape
+        x_min, x_max = sorted((transform.c, transform.c + transform.a * width))
+        y_min, y_max = sorted((transform.f, transform.f + transform.e * height))
+        if is_reprojected(geom_villages.crs, dataset.crs):
+            bounds = valid.buffer(largest).to_crs(dataset.crs).bounds.to_numpy()
+        else:
+            bounds = valid.bounds.to_numpy() + np.array([-largest, -largest, largest, largest])
+        inside = (bounds[:, 0] >= x_min) & (bounds[:, 2] <= x_max) & (bounds[:, 1] >= y_min) & (bounds[:, 3] <= y_max)
+        overlaps = (bounds[:, 2] > x_min) & (bounds[:, 0] < x_max) & (bounds[:, 3] > y_min) & (bounds[:, 1] < y_max)
+        masks, windows = get_buffer_windows(dataset, valid, [smallest], buffer_mask)
+        outer, keys = windows[smallest]
+        if keys is None:
+            pixels = (outer[:, 1] - outer[:, 0]) * (outer[:, 3] - outer[:, 2])
+        else:
+            pixels = np.zeros(len(valid), dtype=np.int64)
+            for group, mask in enumerate(masks[smallest]):
+                selected = keys[:, 0] == group
+                # Count the pixels of the part of the mask of each village with a summed-area table
+                table = np.pad((mask > 0).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+                # The parts of the villages outside the raster can point outside the mask, they are empty anyway
+                r0, r1 = np.clip(keys[selected, 1:3], 0, mask.shape[0]).T
+                c0, c1 = np.clip(keys[selected, 3:5], 0, mask.shape[1]).T
+                pixels[selected] = table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+        for reason, flagged in (("outside", ~overlaps), ("edge", overlaps & ~inside), ("pixels", pixels < min_pixels)):
+            flags[~invalid] = np.where(flagged, flags[~invalid] + f"{reason} {dataset.name};", flags[~invalid])
+    flags = pd.Series(flags, index=geom_villages.index, dtype=object).str.rstrip(";")
+    return flags.where(flags != "", None)
+
+
+def get_zonal_stats_isolated(
+    geom_villages: GeoSeries,
+    rasters: list[RasterReader],
+    radii: list[int],
+    lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]],
+    zonal_cache: ZonalCache | None = None,
+    buffer_mask: str = "circle",
+    report: RunReport | None = None,
+    layers: dict[str, Layer] | None = None
+) -> tuple[DataFrame, list[tuple[Any, str]]]:
+    """
+    Compute the zonal statistics of the villages with the ***get_zonal_stats*** function, all at once, and fall back
+    to computing them one by one if it fails, so an error only costs the statistics of the villages raising it instead
+    of the ones of the whole chunk.
+
+    :param geom_villages: A GeoSeries of the locations of mosquito counts of Africa
+    :type geom_villages: GeoSeries
+    :param rasters: The rasters to process, named after the keys of the layers
+    :type rasters: list[RasterReader]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param lookup_tables: Lookup tables of the legends of the categorical rasters, by name
+    :type lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]]
+    :param zonal_cache: Cache of the statistics already computed
+    :type zonal_cache: ZonalCache | None
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param report: Report of the run
+    :type report: RunReport | None
+    :param layers: Settings of the rasters, LAYERS by default
+    :type layers: dict[str, Layer] | None
+    :return: A DataFrame of the statistics of the villages computed, and the index and error of the other ones
+    :rtype: tuple[DataFrame, list[tuple[Any, str]]]
+    """
+    report = report if report is not None else RunReport()
+    try:
+        return get_zonal_stats(
+            geom_villages, rasters, radii, lookup_tables, zonal_cache, buffer_mask, report, layers
+        ), []
+    except Exception:
+        report.count("chunks_isolated")
+    profiles, errors = [], []
+    for i in range(len(geom_villages)):
+        try:
+            profiles.append(get_zonal_stats(
+                geom_villages.iloc[i:i + 1], rasters, radii, lookup_tables, zonal_cache, buffer_mask, report, layers
+            ))
+        except Exception as e:
+            errors.append((geom_villages.index[i], repr(e)))
+    return pd.concat(profiles) if profiles else pd.DataFrame(index=geom_villages.index[:0]), errors
+
+
+@cache
+def open_raster(path: str, name: str) -> RasterReader | MemmapReader:
+    """
+    Open a raster once per process, so the worker processes don't need the readers of the main process to be pickled.
+
+    :param path: Path to the raster, or to the raster prepared with the ***prepare_raster*** function
+    :type path: str
+    :param name: Name of the raster, one of the keys of the layers
+    :type name: str
+    :return: The raster opened with a RasterReader, or a MemmapReader if it was prepared
+    :rtype: RasterReader | MemmapReader
+    """
+    return open_dataset(path, name=name)
+
+
+def get_zonal_stats_chunk(
+    sources: list[tuple[str, str]],
+    geom_villages: GeoSeries,
+    radii: list[int],
+    lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]],
+    cache_path: str | None = None,
+    buffer_mask: str = "circle",
+    layers: dict[str, Layer] | None = None
+) -> tuple[DataFrame, list[tuple[Any, str]], RunReport]:
+    """
+    Compute the zonal statistics of a chunk of villages in a worker process, opening the rasters (and the cache) from
+    their paths. The villages raising an error are isolated (see ***get_zonal_stats_isolated***).
+
+    :param sources: Name and path of each raster
+    :type sources: list[tuple[str, str]]
+    :param geom_villages: A GeoSeries of the locations of the villages of the chunk
+    :type geom_villages: GeoSeries
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param lookup_tables: Lookup tables of the legends of the categorical rasters, by name
+    :type lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]]
+    :param cache_path: Path to the cache of the statistics already computed
+    :type cache_path: str | None
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param layers: Settings of the rasters, LAYERS by default
+    :type layers: dict[str, Layer] | None
+    :return: A DataFrame of the statistics of the villages of the chunk computed, the index and error of the other
+        ones and the report of the chunk
+    :rtype: tuple[DataFrame, list[tuple[Any, str]], RunReport]
+    """
+    report = RunReport()
+    rasters = [open_raster(path, name) for name, path in sources]
+    zonal_cache = ZonalCache(cache_path) if cache_path is not None else None
+    try:
+        with report.timer("zonal_stats"):
+            profile, errors = get_zonal_stats_isolated(
+                geom_villages, rasters, radii, lookup_tables, zonal_cache, buffer_mask, report, layers
+            )
+        return profile, errors, report
+    finally:
+        if zonal_cache is not None:
+            zonal_cache.close()
+
+
+def read_villages(
+    villages: AnyStr,
+    bbox: tuple[float, float, float, float] | None = None,
+    ids: list[str] | None = None
+) -> GeoDataFrame:
+    """
+    Read the villages of the shapefile, or only a subset of them. With a bounding box, only the villages inside it are
+    read from the file.
+    Whatever the subset, the index of the villages is their row in the shapefile (its feature ID), so a village keeps
+    the same index in every run.
+
+    :param villages: Path to the shapefile
+    :type villages: AnyStr
+    :param bbox: Bounds (xmin, ymin, xmax, ymax) of the villages to keep, in the CRS of the shapefile
+    :type bbox: tuple[float, float, float, float] | None
+    :param ids: IDs of the villages to keep (their name with underscores, as in the ID column of the profile)
+    :type ids: list[str] | None
+    :return: The villages
+    :rtype: GeoDataFrame
+    """
+    try:
+        gdf_villages = gpd.read_file(
+            villages, bbox=tuple(bbox) if bbox is not None else None, engine="pyogrio", fid_as_index=True
+        )
+    except ImportError:
+        # Without pyogrio, the whole file is read to keep the rows of the villages in the index
+        gdf_villages = gpd.read_file(villages)
+        if bbox is not None:
+            gdf_villages = gdf_villages.cx[bbox[0]:bbox[2], bbox[1]:bbox[3]]
+    gdf_villages = gdf_villages.rename_axis(None)
+    if ids is not None:
+        gdf_villages = gdf_villages[gdf_villages["Full_Name"].map(lambda name: strip(name)[1]).isin(ids)]
+    return gdf_villages
+
+
+def get_lookup_tables(datasets: str, layers: dict[str, Layer]) -> dict[str, tuple[np.ndarray, int, list[str]]]:
+    """
+    Read the legend of every categorical raster and turn it into a lookup table (see ***get_lookup_table***).
+
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param layers: The layers processed
+    :type layers: dict[str, Layer]
+    :return: The lookup tables, by name
+    :rtype: dict[str, tuple[np.ndarray, int, list[str]]]
+    """
+    # Retrieve the legend file's path
+    legends = {
+        name: read_qml(path_qml=os.path.join(datasets, layer.legend), item_type=layer.legend_item)
+        for name, layer in layers.items()
+        if layer.kind == "categorical"
+    }
+    # Turn the legends into lookup tables only once for every village
+    return {name: get_lookup_table(qml, unknown=f"Unknown {name}") for name, qml in legends.items()}
+
+
+def get_band_columns(
+    layers: dict[str, Layer],
+    lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]],
+    radii: list[int]
+) -> dict[str, tuple[str, str]]:
+    """
+    Map the columns of the stacks in the wide layout to their name in the long layout and their band.
+
+    :param layers: The layers processed
+    :type layers: dict[str, Layer]
+    :param lookup_tables: Lookup tables of the legends of the categorical rasters, by name
+    :type lookup_tables: dict[str, tuple[np.ndarray, int, list[str]]]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :return: The name without the band and the band of each column of the stacks, by name
+    :rtype: dict[str, tuple[str, str]]
+    """
+    bands = {}
+    for radius in sorted(radii):
+        for name, layer in layers.items():
+            columns = [column for column, _ in layer.statistics]
+            columns += lookup_tables[name][2] if name in lookup_tables else []
+            for column in columns:
+                for band in layer.bands:
+                    bands[f"{column}_{band}_{radius}"] = (f"{column}_{radius}", band)
+    return bands
+
+
+def to_long_format(profile: DataFrame, bands: dict[str, tuple[str, str]]) -> DataFrame:
+    """
+    Turn the columns of the stacks into a row per village and band, with the label of the band in a band column. The
+    other columns are repeated on every row of the village, and the columns of the stacks missing a band are NaN.
+
+    :param profile: The profile in the wide layout
+    :type profile: DataFrame
+    :param bands: The name without the band and the band of each column of the stacks, from ***get_band_columns***
+    :type bands: dict[str, tuple[str, str]]
+    :return: The profile in the long layout, indexed by village
+    :rtype: DataFrame
+    """
+    fixed = profile.drop(columns=list(bands))
+    columns = list(dict.fromkeys(column for column, _ in bands.values()))
+    parts = []
+    for band in dict.fromkeys(band for _, band in bands.values()):
+        names = {wide: column for wide, (column, label) in bands.items() if label == band}
+        part = profile[list(names)].rename(columns=names).reindex(columns=columns)
+        parts.append(fixed.assign(band=band).join(part))
+    return pd.concat(parts).sort_index(kind="stable")
+
+
+def iter_urban_profile(
     datasets: str,
     villages: AnyStr,
     parks: AnyStr,
-    population: xr.Dataset,
-    landuse: xr.Dataset,
-    ndvi: xr.Dataset,
-    swi: xr.Dataset,
-    gws: xr.Dataset,
-    prevalence: xr.Dataset,
-) -> DataFrame:
+    rasters: list[RasterReader],
+    radii: list[int] = (500, 2000),
+    workers: int = 1,
+    chunksize: int = 1000,
+    cache: str | None = None,
+    checkpoint: str | None = None,
+    spatial_order: bool = False,
+    buffer_mask: str = "circle",
+    report: RunReport | None = None,
+    layers: dict[str, Layer] | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    ids: list[str] | None = None,
+    stack_layout: str = "wide",
+    nearest: int = 0,
+    max_distance: float = 50000.,
+    aggregator: ParkAggregator | None = None,
+    min_pixels: int = 1,
+) -> Iterator[DataFrame]:
     """
-    I use 4 different data, 2 vectors that I read in a GeoDataFrame at the beginning of the script and 2 raster.
-    Then, I iterate on the GeoDataFrame of the villages.
-    This allows me to make calculations for each entity and not for the whole layer.
-
-    For each iteration:
-    - I first calculate which is the nearest park with the ***get_nearest_park*** function. In addition, if the village
-        is in the park, I transform the value into a negative value),
-    - I count the number of mosquito species in the village,
-    - I transform the GeoSeries in GeoDataFrame: The result that we obtain when we iterate on each line of a
-        GeoDataFrame, is an object of type GeoSeries. I transform it in GeoDataFrame because these two objects have
-        different properties (in particular to calculate a buffer or especially to cut a raster),
-    - I calculate a buffer of 500m,
-    - I cut my raster of NDVI values with the ***raster_crop*** function. This function has the particularity to produce
-        a new raster file that I have to save and then reopen. Indeed, the rasterio package does not allow to overwrite
-        files as it can be done with geopandas,
-    - I read the raster that I have cut and then calculate statistical values like the minimum, the average and the
-        maximum thanks to the ***raster_stats*** function,
-    - I cut my raster of NDVI values with the ***raster_crop*** function. This function has the particularity to produce
-        a new raster file that I have to save and then reopen. Indeed, the rasterio package does not allow to overwrite
-        files as it can be done with geopandas (which I just use above),
-    - I read the raster that I cut out then I calculate the percentages of land use and I associate them to the nature
-        of these land uses with the ***get_landuse*** function
+    I use 2 vectors that I read in a GeoDataFrame at the beginning of the script and the rasters of the layers.
+    Then, I process the whole layer of villages at once instead of iterating on each village:
+    - I retrieve the ID, the coordinates and the number of mosquito species of each village,
+    - I calculate which is the nearest park of each village with the ***get_nearest_park*** function. In addition, if
+        the village is in the park, I transform the value into a negative value),
+    - For every buffer size (500m and 2000m by default), I compute the statistics of every raster (population sum,
+        NDVI minimum, average and maximum, SWI sum, prevalence average by default) with the ***get_zonal_stats***
+        function. It reads the window of the largest buffer of each village only once per raster and crops the
+        smaller buffers out of it,
+    - For the categorical rasters, I compute the percentages of land use and I associate them to the nature of
+        these land uses with the ***get_landuse*** function. There is a column for every label of the legends
+        (suffixed with the size of the buffer) whether it is found around the villages or not.
+    The villages are processed by chunks, either one after the other or in parallel by several worker processes which
+    open the rasters themselves. Each chunk is yielded as soon as it is done (in the order of the villages, the workers
+    processing the next chunks meanwhile) so the caller can write it and the memory used doesn't grow with the number
+    of villages.
+    Before that, every village is checked against the extent of every raster at once (see ***validate_villages***) and
+    the reasons of the villages flagged are given in the flag column. The villages at the edge of a raster or with too
+    few pixels stay in the batches, where their windows are clipped and their empty buffers give NaN. Only the villages
+    without a geometry or outside every raster are not computed. A batch that fails is computed again village by
+    village, so only the villages raising an error are yielded without statistics. They are printed at the end.
+    Only the villages inside a bounding box or with the IDs given can be processed.
+    The stacks (layers with bands, like a decade of NDVI) are computed for every band with the same windows. In the
+    wide layout, each column of a stack is suffixed by the label of the band. In the long layout, each village has a
+    row per band, with the label in a band column (see ***to_long_format***).
+    The k nearest parks of each village can be added to the profile, and the villages can be aggregated by park and
+    distance ring as the chunks are done (see ***ParkAggregator***).
+    With the spatial order, the chunks are made of villages following each other along a Hilbert curve instead of the
+    order of the shapefile, so the windows of the neighbouring villages are read together from the same blocks of the
+    rasters. The chunks are then yielded in the order of the curve (each one sorted by village).
+    With a cache, only the statistics of the villages and rasters that changed since the last run are computed. The
+    number of statistics found in the cache (hits) and computed (misses) is printed at the end.
+    With a checkpoint, each chunk is written as soon as it is done and a run that crashed or was killed is resumed from
+    the villages missing in it. The villages that failed are written in an errors.csv file next to the chunks so they
+    can be retried on their own.
 
     :param datasets: Path to the datasets
     :type datasets: AnyStr
@@ -159,31 +942,49 @@ def get_urban_profile(
     :type villages: AnyStr
     :param parks: Path to the shapefile
     :type parks: AnyStr
-    :param population: A Dataset with every type of data in it
-    :type population: xr.Dataset
-    :param population: A Dataset with every type of data in it
-    :type population: xr.Dataset
-    :param landuse: A Dataset with every type of data in it
-    :type landuse: xr.Dataset
-    :param ndvi: A Dataset with every type of data in it
-    :type ndvi: xr.Dataset
-    :param swi: A Dataset with every type of data in it
-    :type swi: xr.Dataset
-    :param gws: A Dataset with every type of data in it
-    :type gws: xr.Dataset
-    :param prevalence: A Dataset with every type of data in it
-    :type prevalence: xr.Dataset
-    :return: A DataFrame of the processed values
-    :rtype: DataFrame
+    :param rasters: The rasters opened with a RasterReader, named after the keys of the layers
+    :type rasters: list[RasterReader]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param workers: Number of worker processes, 1 to process the villages in the main process
+    :type workers: int
+    :param chunksize: Number of villages processed at once by a worker
+    :type chunksize: int
+    :param cache: Path to the SQLite file caching the statistics between runs
+    :type cache: str | None
+    :param checkpoint: Path to the directory where the chunks are written as they are done
+    :type checkpoint: str | None
+    :param spatial_order: Whether to process the villages along a Hilbert curve
+    :type spatial_order: bool
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param report: Report of the run, filled with the time spent in each stage and the counters of what was processed
+    :type report: RunReport | None
+    :param layers: Registry of the rasters (legend, statistics, scale, offset, nodata and dtype), LAYERS by default
+    :type layers: dict[str, Layer] | None
+    :param bbox: Bounds (xmin, ymin, xmax, ymax) of the villages to process, in the CRS of the shapefile
+    :type bbox: tuple[float, float, float, float] | None
+    :param ids: IDs of the villages to process
+    :type ids: list[str] | None
+    :param stack_layout: Layout of the statistics of the stacks, one of STACK_LAYOUTS
+    :type stack_layout: str
+    :param nearest: Number of nearest parks of each village added to the profile (see ***get_nearest_parks***), 0 to
+        only keep the nearest one
+    :type nearest: int
+    :param max_distance: Distance beyond which the parks are not among the nearest ones, unless they contain the village
+    :type max_distance: float
+    :param aggregator: Profile of the parks, filled with the villages as they are processed
+    :type aggregator: ParkAggregator | None
+    :param min_pixels: Minimum number of pixels of the smallest buffer below which a village is flagged
+    :type min_pixels: int
+    :return: DataFrames of the processed values of each chunk of villages
+    :rtype: Iterator[DataFrame]
     """
-    buffer_500 = 500
-    buffer_2000 = 2000
+    report = report if report is not None else RunReport()
     # Read the shapefiles as GeoDataFrames
-    gdf_villages = gpd.read_file(villages)
-    gdf_parks = gpd.read_file(parks)
-    # Set the projection to 3857 to have distance, etc as meters
-    # Retrieves buffer size for the villages patches
-    # Create a blank DataFrame to receive the result when iterating below
+    with report.timer("shapefiles"):
+        gdf_villages = read_villages(villages, bbox, ids)
+        gdf_parks = gpd.read_file(parks)
     cols = [
         "ID",
         "x",
@@ -192,104 +993,337 @@ def get_urban_profile(
         "loc_NP",
         "dist_NP",
         "ANO_DIV",
-        "POP_500",
-        "PREVALENCE_500",
-        "SWI_500",
-        "NDVI_min_500",
-        "NDVI_mean_500",
-        "NDVI_max_500",
-        "HAB_DIV_500",
-        "POP_2000",
-        "PREVALENCE_2000",
-        "SWI_2000",
-        "NDVI_min_2000",
-        "NDVI_mean_2000",
-        "NDVI_max_2000",
-        "HAB_DIV_2000",
     ]
-    result = pd.DataFrame(columns=cols)
-        # Retrieve the legend file's path
-    hd_qml = read_qml(path_qml=os.path.join(datasets, 'LANDUSE_ESACCI-LC-L4-LC10-Map-300m-P1Y-2016-v1.0_reprj3857-2.qml'), item_type='item')
-    gws_qml = read_qml(path_qml=os.path.join(datasets, 'GWS_seasonality_AFRICA_reprj3857.qml'), item_type='paletteEntry')
-    # Create the progress and the temporary directory used to save some temporary files
-    with alive_bar(total=len(gdf_villages)) as pbar:
-        for i in range(len(gdf_villages)):
-            try:
-                _, village_id = strip(gdf_villages.loc[i, "Full_Name"])
-                result.loc[i, "ID"] = village_id
-                if (other_ano := gdf_villages.loc[i, 'Other Anop']) is not None:
-                    ano_div = int(gdf_villages.iloc[i].str.count("Y").sum()) + len(other_ano.split(','))
-                else:
-                    ano_div = int(gdf_villages.iloc[i].str.count("Y").sum())
-                result.loc[i, "ANO_DIV"] = ano_div
-
-                # Geometry
-                geom = gdf_villages.loc[i, "geometry"]
-                geom_500 = geom.buffer(buffer_500)
-                geom_2000 = geom.buffer(buffer_2000)
-
-                # Get the minimum distance from the village the park edge border and return the said distance and the
-                # park's name
-                res_dist, loc_np, np_name = get_nearest_park(parks=gdf_parks, geom_villages=geom_2000)
-                result.loc[i, "NP"] = np_name
-                result.loc[i, "loc_NP"] = loc_np
-                result.loc[i, "dist_NP"] = round(res_dist, 3)
-
-                # Coordinates
-                result.loc[i, "x"] = geom_500.centroid.x
-                result.loc[i, "y"] = geom_500.centroid.y
-                # DATASETS
-                # 500
-                population_500 = clip(population, geom_500)
-                landuse_500 = clip(landuse, geom_500)
-                ndvi_500 = clip(ndvi, geom_500)
-                swi_500 = clip(swi, geom_500)
-                gws_500 = clip(gws, geom_500)
-                prevalence_500 = clip(prevalence, geom_500)
-                # 2000
-                population_2000 = clip(population, geom_2000)
-                landuse_2000 = clip(landuse, geom_2000)
-                ndvi_2000 = clip(ndvi, geom_2000)
-                swi_2000 = clip(swi, geom_2000)
-                gws_2000 = clip(gws, geom_2000)
-                prevalence_2000 = clip(prevalence, geom_2000)
-                # POPULATION
-                result.loc[i, "POP_500"] = population_500.sum(skipna=True).values
-                result.loc[i, "POP_2000"] = population_2000.sum(skipna=True).values
-                # NDVI
-                # I divide by 10 000 because Normalized Difference Vegetation
-                # Index is usually between -1 and 1.
-                # For 500 meters
-                result.loc[i, "NDVI_min_500"] = ndvi_500.min(skipna=True).values / 10000
-                result.loc[i, "NDVI_mean_500"] = ndvi_500.min(skipna=True).values / 10000
-                result.loc[i, "NDVI_max_500"] = ndvi_500.min(skipna=True).values / 10000
-                # For 2000 meters
-                result.loc[i, "NDVI_min_2000"] = ndvi_2000.min(skipna=True).values / 10000
-                result.loc[i, "NDVI_mean_2000"] = ndvi_2000.mean(skipna=True).values / 10000
-                result.loc[i, "NDVI_max_2000"] = ndvi_2000.max(skipna=True).values / 10000
-                # SWI
-                # https://land.copernicus.eu/global/products/SWI I divide by a 2
-                # because SWI data must be between 0 and 100.
-                result.loc[i, "SWI_500"] = swi_500.sum(skipna=True).values / 2
-                result.loc[i, "SWI_2000"] = swi_2000.sum(skipna=True).values / 2
-                # PREVALENCE
-                # https://malariaatlas.org/explorer/#/ I multiply by 100 because PREVALENCE is a percentage between 0
-                # and 100.
-                result.loc[i, "PREVALENCE_500"] = prevalence_500.where(prevalence_500 != -9999.).mean(skipna=True).values * 100
-                result.loc[i, "PREVALENCE_2000"] = prevalence_2000.where(prevalence_500 != -9999.).mean(skipna=True).values * 100
-                # LANDUSE
-                df_hd_500, len_ctr_500 = get_landuse(landuse_500, hd_qml)
-                result.loc[i, "HAB_DIV_500"] = len_ctr_500
-                result.loc[i, df_hd_500.columns] = df_hd_500.values[0]
-                df_hd_2000, len_ctr_2000 = get_landuse(landuse_2000, hd_qml)
-                result.loc[i, "HAB_DIV_2000"] = len_ctr_2000
-                result.loc[i, df_hd_2000.columns] = df_hd_2000.values[0]
-                # GWS
-                df_gws_500, _ = get_landuse(gws_500, gws_qml)
-                result.loc[i, df_gws_500.columns] = df_gws_500.values[0]
-                df_gws_2000, _ = get_landuse(gws_2000, gws_qml)
-                result.loc[i, df_gws_2000.columns] = df_gws_2000.values[0]
-            except IndexError:
-                print(village_id, np_name, geom_2000.wkt)
-            pbar()
-    return result
+    # Only the layers of the rasters given are processed, in the order of the registry
+    names = {dataset.name for dataset in rasters}
+    layers = {name: layer for name, layer in (LAYERS if layers is None else layers).items() if name in names}
+    rasters = [dataset for dataset in rasters if dataset.name in layers]
+    for radius in sorted(radii):
+        cols += [name for layer in layers.values() for name in layer.get_columns([c for c, _ in layer.statistics], radius)]
+    lookup_tables = get_lookup_tables(datasets, layers)
+    for radius in sorted(radii):
+        cols += [name for key, (_, _, labels) in lookup_tables.items() for name in layers[key].get_columns(labels, radius)]
+    if stack_layout not in STACK_LAYOUTS:
+        raise UserWarning(f"Unknown stack layout {stack_layout}, choose one of {STACK_LAYOUTS}")
+    bands = get_band_columns(layers, lookup_tables, radii) if stack_layout == "long" else {}
+    geom_villages = gdf_villages.geometry
+    result = ResultAccumulator(
+        index=gdf_villages.index,
+        columns={column: DTYPES.get(column, np.float64) for column in cols[:7]}
+    )
+    result.set("ID", slice(None), gdf_villages["Full_Name"].map(lambda name: strip(name)[1]).to_numpy())
+    # Coordinates
+    result.set("x", slice(None), geom_villages.centroid.x.to_numpy())
+    result.set("y", slice(None), geom_villages.centroid.y.to_numpy())
+
+    # Get the minimum distance from the village the park edge border and return the said distance and the park's name
+    with report.timer("nearest_park"):
+        buffers = geom_villages.buffer(2000)
+        nearest_parks = get_nearest_park(parks=gdf_parks, geom_villages=buffers)
+        if nearest:
+            k_nearest_parks = get_nearest_parks(gdf_parks, buffers, nearest, max_distance)
+    result.set("NP", slice(None), nearest_parks["NP"].to_numpy())
+    result.set("loc_NP", slice(None), nearest_parks["loc_NP"].to_numpy())
+    result.set("dist_NP", slice(None), nearest_parks["dist_NP"].astype(float).round(3).to_numpy())
+
+    # Count the "Y" of the attributes and the other anopheles of each village
+    attributes = gdf_villages.drop(columns="geometry").select_dtypes(include=["object", "string"])
+    # The counts are cast explicitly since the columns of an empty subset keep the dtype of the strings
+    ano_div = attributes.apply(lambda column: column.str.count("Y")).sum(axis=1).astype(np.int64)
+    other_ano = gdf_villages["Other Anop"].str.split(",").str.len().fillna(0).astype(np.int64)
+    result.set("ANO_DIV", slice(None), (ano_div + other_ano).to_numpy())
+    villages_profile = result.to_dataframe()
+    with report.timer("validation"):
+        villages_profile["flag"] = validate_villages(geom_villages, rasters, radii, buffer_mask, min_pixels)
+    report.count("villages_flagged", villages_profile["flag"].notna().sum())
+    if nearest:
+        # The distances to the k nearest parks are rounded like the one to the nearest park
+        distances = {f"dist_NP_{n}": 3 for n in range(1, nearest + 1)}
+        villages_profile = villages_profile.join(k_nearest_parks.round(distances))
+
+    # DATASETS
+    # The parts of the checkpoint are matched to the villages by the hash of their geometry as well as their index, and
+    # the whole checkpoint to the rasters and their settings by their fingerprints
+    keys, fingerprints, done = None, None, None
+    if checkpoint is not None:
+        keys = pd.Series(get_geometry_keys(geom_villages), index=geom_villages.index)
+        fingerprints = {
+            dataset.name: get_fingerprint(dataset, get_layer_settings(
+                layers[dataset.name].resolve(dataset), lookup_tables.get(dataset.name), buffer_mask
+            ))
+            for dataset in rasters
+        }
+        done = read_checkpoint(checkpoint, keys, fingerprints)
+    if done is not None and set(done.columns) != set(cols[7:]):
+        raise ValueError(f"The checkpoint {checkpoint} was written with other buffer sizes or legends")
+    if spatial_order:
+        # Process the neighbouring villages together so they share the blocks of the rasters they read
+        ordered = geom_villages.iloc[get_hilbert_order(villages_profile["x"], villages_profile["y"])]
+    else:
+        ordered = geom_villages
+    # A subset without any village still gives an empty chunk, so the profile keeps its columns
+    chunks = [ordered.iloc[i:i + chunksize] for i in range(0, len(ordered), chunksize)] or [ordered]
+    # Resume the run where it stopped by only processing the villages missing in the checkpoint
+    todos = [chunk if done is None else chunk[~chunk.index.isin(done.index)] for chunk in chunks]
+    # The villages without a geometry or outside every raster have nothing to compute, the other flagged villages stay
+    # in the batches since their windows are clipped to the rasters
+    reasons = villages_profile["flag"].fillna("").str.split(";")
+    outside = [f"outside {dataset.name}" for dataset in rasters]
+    skipped = villages_profile.index[reasons.map(
+        lambda flags: "geometry" in flags or bool(outside) and all(reason in flags for reason in outside)
+    ).astype(bool)]
+    batches = [todo[~todo.index.isin(skipped)] for todo in todos]
+    dtypes = get_dtypes(layers, radii)
+    errors: list[tuple[int, str]] = []
+    zonal_cache = None
+    with ExitStack() as stack:
+        # The workers open the cache themselves, the main process keeps its own for the villages it computes
+        if cache is not None:
+            zonal_cache = ZonalCache(cache)
+            stack.callback(zonal_cache.close)
+        pbar = stack.enter_context(alive_bar(total=len(geom_villages)))
+        futures: dict[int, Future] = {}
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            sources = [(dataset.name, dataset.path) for dataset in rasters]
+            for n in range(len(chunks)):
+                # Keep the workers busy with the next chunks without holding every result in memory
+                if len(futures) < 2 * workers and len(batches[n]):
+                    futures[n] = executor.submit(
+                        get_zonal_stats_chunk, sources, batches[n], radii, lookup_tables, cache, buffer_mask, layers
+                    )
+        for n, (chunk, todo) in enumerate(zip(chunks, todos)):
+            profiles = [] if done is None else [done[done.index.isin(chunk.index)]]
+            if len(todo):
+                try:
+                    profile, chunk_errors = pd.DataFrame(index=todo.index[:0]), []
+                    if len(batches[n]):
+                        if workers > 1:
+                            profile, chunk_errors, chunk_report = futures.pop(n).result()
+                            report.merge(chunk_report)
+                        else:
+                            with report.timer("zonal_stats"):
+                                profile, chunk_errors = get_zonal_stats_isolated(
+                                    batches[n], rasters, radii, lookup_tables, zonal_cache, buffer_mask, report, layers
+                                )
+                    if checkpoint is not None and len(profile):
+                        with report.timer("checkpoint"):
+                            write_checkpoint(checkpoint, profile, keys, fingerprints)
+                    profiles.append(profile)
+                    errors += chunk_errors
+                    report.count("villages_processed", len(profile))
+                    report.count("villages_failed", len(chunk_errors))
+                    report.count("villages_skipped", todo.index.isin(skipped).sum())
+                except Exception as e:
+                    # The chunk could not be done at all (a worker process died, the checkpoint failed...)
+                    errors += [(i, repr(e)) for i in todo.index]
+                    report.count("villages_failed", len(todo))
+            report.count("villages_resumed", len(chunk) - len(todo))
+            if workers > 1:
+                for m in range(max(futures, default=n) + 1, len(chunks)):
+                    if len(futures) >= 2 * workers:
+                        break
+                    if len(batches[m]):
+                        futures[m] = executor.submit(
+                            get_zonal_stats_chunk, sources, batches[m], radii, lookup_tables, cache, buffer_mask, layers
+                        )
+            pbar(len(chunk))
+            stats = pd.concat(profiles) if profiles else pd.DataFrame(index=chunk.index)
+            stats = stats.reindex(columns=cols[7:]).astype({column: dtypes.get(column, np.float64) for column in cols[7:]})
+            profile = villages_profile.loc[chunk.index.sort_values()].join(stats)
+            if aggregator is not None:
+                with report.timer("aggregate"):
+                    aggregator.add(profile)
+            yield to_long_format(profile, bands) if bands else profile
+    errors_df = pd.DataFrame(errors, columns=["index", "error"])
+    errors_df.insert(1, "ID", villages_profile.loc[errors_df["index"], "ID"].to_numpy())
+    errors_df.insert(2, "NP", villages_profile.loc[errors_df["index"], "NP"].to_numpy())
+    for _, row in errors_df.iterrows():
+        print(row["ID"], row["NP"], row["error"])
+    if checkpoint is not None:
+        write_errors(checkpoint, errors_df)
+    if cache is not None:
+        print(f"Cache: {report.counters.get('cache_hits', 0)} hits, {report.counters.get('cache_misses', 0)} misses")
+
+
+def get_urban_profile(
+    datasets: str,
+    villages: AnyStr,
+    parks: AnyStr,
+    rasters: list[RasterReader],
+    radii: list[int] = (500, 2000),
+    workers: int = 1,
+    chunksize: int = 1000,
+    cache: str | None = None,
+    checkpoint: str | None = None,
+    spatial_order: bool = False,
+    buffer_mask: str = "circle",
+    report: RunReport | None = None,
+    layers: dict[str, Layer] | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    ids: list[str] | None = None,
+    stack_layout: str = "wide",
+    nearest: int = 0,
+    max_distance: float = 50000.,
+    aggregator: ParkAggregator | None = None,
+    min_pixels: int = 1,
+) -> DataFrame:
+    """
+    Process every village with the ***iter_urban_profile*** function and gather the chunks in a single DataFrame, in
+    the order of the shapefile whatever the order the villages were processed in.
+
+    :param datasets: Path to the datasets
+    :type datasets: AnyStr
+    :param villages: Path to the shapefile
+    :type villages: AnyStr
+    :param parks: Path to the shapefile
+    :type parks: AnyStr
+    :param rasters: The rasters opened with a RasterReader, named after the keys of the layers
+    :type rasters: list[RasterReader]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param workers: Number of worker processes, 1 to process the villages in the main process
+    :type workers: int
+    :param chunksize: Number of villages processed at once by a worker
+    :type chunksize: int
+    :param cache: Path to the SQLite file caching the statistics between runs
+    :type cache: str | None
+    :param checkpoint: Path to the directory where the chunks are written as they are done
+    :type checkpoint: str | None
+    :param spatial_order: Whether to process the villages along a Hilbert curve
+    :type spatial_order: bool
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param report: Report of the run, filled with the time spent in each stage and the counters of what was processed
+    :type report: RunReport | None
+    :param layers: Registry of the rasters (legend, statistics, scale, offset, nodata and dtype), LAYERS by default
+    :type layers: dict[str, Layer] | None
+    :param bbox: Bounds (xmin, ymin, xmax, ymax) of the villages to process, in the CRS of the shapefile
+    :type bbox: tuple[float, float, float, float] | None
+    :param ids: IDs of the villages to process
+    :type ids: list[str] | None
+    :param stack_layout: Layout of the statistics of the stacks, one of STACK_LAYOUTS
+    :type stack_layout: str
+    :param nearest: Number of nearest parks of each village added to the profile (see ***get_nearest_parks***), 0 to
+        only keep the nearest one
+    :type nearest: int
+    :param max_distance: Distance beyond which the parks are not among the nearest ones, unless they contain the village
+    :type max_distance: float
+    :param aggregator: Profile of the parks, filled with the villages as they are processed
+    :type aggregator: ParkAggregator | None
+    :param min_pixels: Minimum number of pixels of the smallest buffer below which a village is flagged
+    :type min_pixels: int
+    :return: A DataFrame of the processed values
+    :rtype: DataFrame
+    """
+    return pd.concat(iter_urban_profile(
+        datasets=datasets,
+        villages=villages,
+        parks=parks,
+        rasters=rasters,
+        radii=radii,
+        workers=workers,
+        chunksize=chunksize,
+        cache=cache,
+        checkpoint=checkpoint,
+        spatial_order=spatial_order,
+        buffer_mask=buffer_mask,
+        report=report,
+        layers=layers,
+        bbox=bbox,
+        ids=ids,
+        stack_layout=stack_layout,
+        nearest=nearest,
+        max_distance=max_distance,
+        aggregator=aggregator,
+        min_pixels=min_pixels,
+    )).sort_index(kind="stable")
+
+
+def estimate_urban_profile(
+    datasets: str,
+    villages: AnyStr,
+    rasters: list[RasterReader],
+    radii: list[int] = (500, 2000),
+    workers: int = 1,
+    chunksize: int = 1000,
+    buffer_mask: str = "circle",
+    layers: dict[str, Layer] | None = None,
+    bbox: tuple[float, float, float, float] | None = None,
+    ids: list[str] | None = None,
+    sample: int = 100,
+) -> DataFrame:
+    """
+    Estimate what a run of the ***iter_urban_profile*** function would read and how long it would take, without
+    processing the villages.
+    The pixels read around each village come from the windows of the largest buffer in each raster, computed from
+    the metadata of the raster: the window is read once per village and raster, for every band of the stacks. The
+    memory of a chunk is the one of the windows of its villages, held at once by each worker. The time is extrapolated
+    from the statistics of a sample of villages, spread over the subset and processed in the main process, so it
+    includes the time to read them cold.
+
+    :param datasets: Path to the datasets
+    :type datasets: str
+    :param villages: Path to the shapefile
+    :type villages: AnyStr
+    :param rasters: The rasters opened with a RasterReader, named after the keys of the layers
+    :type rasters: list[RasterReader]
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param workers: Number of worker processes
+    :type workers: int
+    :param chunksize: Number of villages processed at once by a worker
+    :type chunksize: int
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :param layers: Registry of the rasters, LAYERS by default
+    :type layers: dict[str, Layer] | None
+    :param bbox: Bounds (xmin, ymin, xmax, ymax) of the villages to process, in the CRS of the shapefile
+    :type bbox: tuple[float, float, float, float] | None
+    :param ids: IDs of the villages to process
+    :type ids: list[str] | None
+    :param sample: Number of villages processed to time the statistics, 0 to skip the time
+    :type sample: int
+    :return: A DataFrame with, for each raster and in total, the number of villages, the pixels and bytes read, the
+        memory of the windows of a chunk and the estimated time in seconds
+    :rtype: DataFrame
+    """
+    geom_villages = read_villages(villages, bbox, ids).geometry
+    names = {dataset.name for dataset in rasters}
+    layers = {name: layer for name, layer in (LAYERS if layers is None else layers).items() if name in names}
+    rasters = [dataset for dataset in rasters if dataset.name in layers]
+    geom_villages = geom_villages[~(geom_villages.isna() | geom_villages.is_empty)]
+    radius = max(radii)
+    rows = []
+    for dataset in rasters:
+        _, windows = get_buffer_windows(dataset, geom_villages, [radius], buffer_mask)
+        outer = windows[radius][0]
+        pixels = (outer[:, 1] - outer[:, 0]) * (outer[:, 3] - outer[:, 2]) * max(len(layers[dataset.name].bands), 1)
+        chunk = pixels.mean() * min(chunksize, len(pixels)) if len(pixels) else 0
+        rows.append({
+            "raster": dataset.name,
+            "villages": len(geom_villages),
+            "pixels": int(pixels.sum()),
+            "bytes": int(pixels.sum()) * dataset.dtype.itemsize,
+            "chunk_bytes": int(chunk * dataset.dtype.itemsize),
+            "seconds": np.nan,
+        })
+    estimate = pd.DataFrame(rows, columns=["raster", "villages", "pixels", "bytes", "chunk_bytes", "seconds"])
+    if sample and len(geom_villages):
+        lookup_tables = get_lookup_tables(datasets, layers)
+        positions = np.linspace(0, len(geom_villages) - 1, min(sample, len(geom_villages))).astype(int)
+        sampled = geom_villages.iloc[positions]
+        for n, dataset in enumerate(rasters):
+            report = RunReport()
+            with report.timer("zonal_stats"):
+                get_zonal_stats(
+                    sampled, [dataset], radii, {k: v for k, v in lookup_tables.items() if k == dataset.name},
+                    None, buffer_mask, report, layers
+                )
+            per_village = report.timers["zonal_stats"] / len(sampled)
+            estimate.loc[n, "seconds"] = per_village * len(geom_villages) / max(workers, 1)
+    total = estimate.drop(columns="raster").sum(min_count=1)
+    # The rasters are processed one after the other, so a chunk only holds the windows of one of them at once
+    total["villages"], total["chunk_bytes"] = len(geom_villages), estimate["chunk_bytes"].max()
+    estimate.loc[len(estimate)] = {"raster": "total", **total.to_dict()}
+    return estimate.astype({"villages": int, "pixels": int, "bytes": int, "chunk_bytes": int}).set_index("raster")
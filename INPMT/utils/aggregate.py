@@ -0,0 +1,115 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Profile of the parks, aggregated from the villages by distance ring while they are processed
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+warnings.filterwarnings("ignore")
+
+# Limits of the distance rings around the parks, in meters. The villages inside the parks have their own ring.
+RINGS = (0, 1000, 5000, 10000, 20000, 50000)
+
+
+def get_ring_labels(rings: tuple[float, ...]) -> list[str]:
+    """
+    :param rings: Limits of the distance rings, in increasing order and starting at 0
+    :type rings: tuple[float, ...]
+    :return: The label of each ring: 'inside', then 'start-stop' and '>last' in meters
+    :rtype: list[str]
+    """
+    labels = ["inside"]
+    labels += [f"{start:g}-{stop:g}" for start, stop in zip(rings[:-1], rings[1:])]
+    return labels + [f">{rings[-1]:g}"]
+
+
+class ParkAggregator:
+    """
+    Aggregate the profile of the villages by park and distance ring (the villages inside the park, then the rings of
+    the distance to its boundary) as the chunks of villages are processed, so the profile of the parks comes with the
+    one of the villages instead of reading the whole output again.
+    With the k nearest parks of each village, a village counts in the ring of every one of its k parks, so a park keeps
+    the villages closer to a neighbouring park. Otherwise, it only counts for its nearest park.
+    Only the sums and the counts of each chunk are kept, which means the memory used doesn't grow with the number of
+    villages. The villages without a park are ignored.
+    """
+    def __init__(self, columns: list[str], rings: tuple[float, ...] = RINGS, nearest: int = 0):
+        """
+        :param columns: Columns of the profile averaged by park and ring, the ones missing in the profile are ignored
+        :type columns: list[str]
+        :param rings: Limits of the distance rings, in increasing order and starting at 0
+        :type rings: tuple[float, ...]
+        :param nearest: Number of nearest parks of each village in the profile (the NP_n and dist_NP_n columns), 0 to
+            only use the nearest one (the NP and dist_NP columns)
+        :type nearest: int
+        """
+        if list(rings) != sorted(rings) or rings[0] != 0:
+            raise UserWarning(f"The rings {rings} must be increasing and start at 0")
+        self.columns = columns
+        self.rings = tuple(rings)
+        self.labels = get_ring_labels(self.rings)
+        self.parks = [("NP", "dist_NP")] if not nearest else [(f"NP_{n}", f"dist_NP_{n}") for n in range(1, nearest + 1)]
+        self.villages: pd.Series | None = None
+        self.sums: DataFrame | None = None
+        self.counts: DataFrame | None = None
+
+    def add(self, profile: DataFrame) -> None:
+        """
+        Add the villages of a chunk of the profile, in the wide layout.
+
+        :param profile: Chunk of the profile with the columns of the parks (NP and dist_NP, or NP_n and dist_NP_n)
+        :type profile: DataFrame
+        """
+        columns = [column for column in self.columns if column in profile.columns]
+        # One row per village and park, the villages being repeated for each of their parks
+        profile = pd.concat([
+            profile[columns].assign(NP=profile[park].to_numpy(), dist_NP=profile[distance].to_numpy())
+            for park, distance in self.parks
+        ])
+        profile = profile[profile["NP"].notna()]
+        distances = profile["dist_NP"].to_numpy(dtype=np.float64)
+        # Negative distances are the villages inside the park
+        rings = np.where(distances < 0, 0, np.searchsorted(self.rings, distances, side="right"))
+        keys = [profile["NP"].to_numpy(), np.asarray(self.labels, dtype=object)[rings]]
+        values = profile[columns].astype(np.float64)
+        grouped = values.groupby(keys)
+        villages, sums, counts = grouped.size(), grouped.sum(), grouped.count()
+        if self.villages is None:
+            self.villages, self.sums, self.counts = villages, sums, counts
+        else:
+            self.villages = self.villages.add(villages, fill_value=0)
+            self.sums = self.sums.add(sums, fill_value=0)
+            self.counts = self.counts.add(counts, fill_value=0)
+
+    def to_dataframe(self) -> DataFrame:
+        """
+        :return: The number of villages and the mean of each column, by park and ring, the rings in increasing order
+        :rtype: DataFrame
+        """
+        if self.villages is None:
+            return pd.DataFrame(columns=["NP", "ring", "villages", *self.columns])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums / self.counts.where(self.counts > 0)
+        profile = means.assign(villages=self.villages.astype(np.int64))
+        profile = profile[["villages", *means.columns]].rename_axis(["NP", "ring"]).reset_index()
+        order = profile["ring"].map({label: n for n, label in enumerate(self.labels)})
+        return profile.assign(order=order).sort_values(["NP", "order"]).drop(columns="order").reset_index(drop=True)
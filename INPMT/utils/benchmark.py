@@ -0,0 +1,414 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Benchmark of the processing on synthetic datasets, to catch the regressions without the datasets of Africa
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from collections.abc import Callable
+from typing import Any, AnyStr
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from pandas import DataFrame
+from rasterio.transform import from_origin
+from shapely.geometry import Point, box
+
+try:
+    from processing import (
+        LAYERS,
+        get_landuse,
+        get_lookup_table,
+        get_nearest_park,
+        get_urban_profile,
+        get_zonal_stats,
+    )
+    from utils.raster import RasterReader
+    from utils.utils import read_qml
+    from utils.zonal import get_windows, group_windows, read_windows
+except ImportError:
+    from INPMT.processing import (
+        LAYERS,
+        get_landuse,
+        get_lookup_table,
+        get_nearest_park,
+        get_urban_profile,
+        get_zonal_stats,
+    )
+    from INPMT.utils.raster import RasterReader
+    from INPMT.utils.utils import read_qml
+    from INPMT.utils.zonal import get_windows, group_windows, read_windows
+
+try:
+    import resource
+except ImportError:
+    # The resource module only exists on Unix
+    resource = None
+
+warnings.filterwarnings("ignore")
+
+# Resolution, dtype and nodata of the synthetic raster of each layer, written in the file of the layer in LAYERS
+RASTERS = {
+    "population": (100, "float32", -99999.),
+    "landuse": (300, "uint8", 0),
+    "ndvi": (300, "int16", -3000),
+    "swi": (1000, "uint8", 255),
+    "gws": (300, "uint8", 255),
+    "prevalence": (500, "float32", -9999.),
+}
+# (value, label) of the items of the legends of the categorical layers
+LEGENDS = {
+    "landuse": [(0, "No data"), (10, "Cropland, rainfed"), (20, "Cropland, irrigated"), (30, "Mosaic cropland"),
+                (50, "Tree cover, broadleaved, evergreen"), (60, "Tree cover, broadleaved, deciduous"),
+                (190, "Urban areas"), (210, "Water bodies")],
+    "gws": [(0, "No water"), (1, "1 month"), (6, "6 months"), (12, "Permanent water")],
+}
+VILLAGES = "KYALO.shp"
+PARKS = "NATIONAL_PARKS_WDPA_Africa_anopheles.shp"
+
+
+def make_raster(path: AnyStr, name: str, origin: tuple[float, float], extent: float, rng: np.random.Generator) -> None:
+    """
+    Write a synthetic GeoTIFF in EPSG:3857 with about 5 % of nodata pixels. The categorical rasters take the values of
+    their legend and the continuous ones random values in the range of the real ones.
+
+    :param path: Path to the GeoTIFF
+    :type path: AnyStr
+    :param name: Name of the raster, one of the keys of RASTERS
+    :type name: str
+    :param origin: Coordinates of the lower left corner
+    :type origin: tuple[float, float]
+    :param extent: Width and height of the raster, in meters
+    :type extent: float
+    :param rng: Random generator
+    :type rng: np.random.Generator
+    """
+    resolution, dtype, nodata = RASTERS[name]
+    shape = (int(extent // resolution), int(extent // resolution))
+    if name in LEGENDS:
+        values = rng.choice([value for value, _ in LEGENDS[name]], shape)
+    elif name == "population":
+        values = rng.gamma(1., 3., shape)
+    elif name == "ndvi":
+        values = rng.integers(-2000, 10000, shape)
+    elif name == "swi":
+        values = rng.integers(0, 200, shape)
+    else:
+        values = rng.random(shape)
+    values = np.where(rng.random(shape) < .05, nodata, values).astype(dtype)
+    with rasterio.open(
+        path, "w", driver="GTiff", height=shape[0], width=shape[1], count=1, dtype=dtype, crs="EPSG:3857",
+        transform=from_origin(origin[0], origin[1] + extent, resolution, resolution), nodata=nodata,
+        tiled=True, blockxsize=256, blockysize=256,
+    ) as dataset:
+        dataset.write(values, 1)
+
+
+def make_legend(path: AnyStr, name: str) -> None:
+    """
+    Write the QGIS style of a categorical raster, with the tags read by the ***read_qml*** function.
+
+    :param path: Path to the .qml file
+    :type path: AnyStr
+    :param name: Name of the raster, one of the keys of LEGENDS
+    :type name: str
+    """
+    item_type = LAYERS[name].legend_item
+    entries = "".join(f'<{item_type} value="{value}" label="{label}"/>' for value, label in LEGENDS[name])
+    parent = "categories" if item_type == "item" else "colorPalette"
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(f"<!DOCTYPE qgis><qgis><pipe><rasterrenderer><{parent}>{entries}</{parent}></rasterrenderer></pipe></qgis>")
+
+
+def make_dataset(
+    path: AnyStr,
+    villages: int = 1000,
+    parks: int = 50,
+    extent: float = 300000.,
+    seed: int = 0
+) -> None:
+    """
+    Write a synthetic copy of the datasets: the six rasters, the legends of the categorical ones and the shapefiles of
+    the villages (points with the attributes of the mosquito counts) and of the parks (rectangles).
+
+    :param path: Path to the directory of the datasets, created if it doesn't exist
+    :type path: AnyStr
+    :param villages: Number of villages
+    :type villages: int
+    :param parks: Number of parks
+    :type parks: int
+    :param extent: Width and height of the area covered, in meters
+    :type extent: float
+    :param seed: Seed of the random generator, so the same arguments always give the same datasets
+    :type seed: int
+    """
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    origin = (1000000., -500000.)
+    for name in RASTERS:
+        make_raster(os.path.join(path, LAYERS[name].file), name, origin, extent, rng)
+    for name in LEGENDS:
+        make_legend(os.path.join(path, LAYERS[name].legend), name)
+
+    # Keep the villages far enough from the edges for their largest buffers to be inside the rasters
+    margin = min(5000., extent / 4)
+    points = rng.uniform(
+        [origin[0] + margin, origin[1] + margin], [origin[0] + extent - margin, origin[1] + extent - margin], (villages, 2)
+    )
+    gpd.GeoDataFrame(
+        {
+            "Full_Name": [f"Village {i}" for i in range(villages)],
+            "An gambiae": rng.choice(["Y", "N"], villages),
+            "An funestu": rng.choice(["Y", "N"], villages),
+            "Other Anop": np.where(rng.random(villages) < .5, None, "An. coustani, An. ziemanni"),
+        },
+        geometry=[Point(x, y) for x, y in points],
+        crs="EPSG:3857",
+    ).to_file(os.path.join(path, VILLAGES))
+    corners = rng.uniform(origin, [origin[0] + extent, origin[1] + extent], (parks, 2))
+    sizes = rng.uniform(5000., extent / 10, (parks, 2))
+    gpd.GeoDataFrame(
+        {"NAME": [f"Park {i}" for i in range(parks)]},
+        geometry=[box(x, y, x + width, y + height) for (x, y), (width, height) in zip(corners, sizes)],
+        crs="EPSG:3857",
+    ).to_file(os.path.join(path, PARKS))
+
+
+def measure(
+    stage: str, function: Callable[[], Any], villages: int, memory: bool = True
+) -> tuple[dict[str, Any], Any]:
+    """
+    Time a stage of the processing and measure the peak of the memory it allocated (as traced by tracemalloc, which
+    includes the arrays of NumPy but not the buffers of GDAL).
+    The stage is timed in a first run without tracemalloc, whose hooks on every allocation slow down the Python parts
+    of the stages, and its memory is measured in a second run.
+
+    :param stage: Name of the stage
+    :type stage: str
+    :param function: Function running the stage
+    :type function: Callable[[], Any]
+    :param villages: Number of villages processed by the stage
+    :type villages: int
+    :param memory: Whether to run the stage a second time to measure its memory
+    :type memory: bool
+    :return: The measures of the stage and the result of the function
+    :rtype: tuple[dict[str, Any], Any]
+    """
+    start = time.perf_counter()
+    value = function()
+    seconds = time.perf_counter() - start
+    peak = np.nan
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {
+        "stage": stage,
+        "villages": villages,
+        "seconds": seconds,
+        "villages_per_sec": villages / seconds if seconds > 0 else np.inf,
+        "peak_memory_mb": peak / 2 ** 20,
+    }, value
+
+
+def run_benchmark(
+    path: AnyStr,
+    radii: list[int] = (500, 2000),
+    workers: int = 1,
+    buffer_mask: str = "circle"
+) -> DataFrame:
+    """
+    Time each stage of the processing on the datasets of a directory (usually written by ***make_dataset***):
+    the nearest parks, the windowed reads of the rasters, the landuse labels, the zonal statistics of every raster and
+    the whole profile of the villages.
+
+    :param path: Path to the directory of the datasets
+    :type path: AnyStr
+    :param radii: Sizes of the buffers around the villages
+    :type radii: list[int]
+    :param workers: Number of worker processes used to process the whole profile
+    :type workers: int
+    :param buffer_mask: Shape of the buffers, one of BUFFER_MASKS
+    :type buffer_mask: str
+    :return: The time, throughput and peak memory of each stage
+    :rtype: DataFrame
+    """
+    gdf_villages = gpd.read_file(os.path.join(path, VILLAGES))
+    gdf_parks = gpd.read_file(os.path.join(path, PARKS))
+    n = len(gdf_villages)
+    rasters = {name: RasterReader(os.path.join(path, LAYERS[name].file), name=name) for name in RASTERS}
+    lookup_tables = {
+        name: get_lookup_table(
+            read_qml(os.path.join(path, LAYERS[name].legend), LAYERS[name].legend_item), unknown=f"Unknown {name}"
+        )
+        for name in LEGENDS
+    }
+    bounds = gdf_villages.geometry.buffer(max(radii)).bounds.to_numpy()
+    landuse = rasters["landuse"]
+    stages = []
+    try:
+        stage, _ = measure("nearest_park", lambda: get_nearest_park(gdf_parks, gdf_villages.geometry.buffer(2000)), n)
+        stages.append(stage)
+        stage, _ = measure("windows", lambda: [
+            read_windows(dataset, get_windows(dataset.transform, bounds, dataset.shape))
+            for dataset in rasters.values()
+        ], n)
+        stages.append(stage)
+        arrays = read_windows(landuse, get_windows(landuse.transform, bounds, landuse.shape))
+        stage, _ = measure("landuse", lambda: [
+            get_landuse(stack, lookup_tables["landuse"]) for _, stack, _ in group_windows(arrays)
+        ], n)
+        stages.append(stage)
+        stage, _ = measure("zonal_stats", lambda: get_zonal_stats(
+            gdf_villages.geometry,
+            list(rasters.values()),
+            list(radii),
+            lookup_tables,
+            buffer_mask=buffer_mask,
+        ), n)
+        stages.append(stage)
+        stage, _ = measure("profile", lambda: get_urban_profile(
+            datasets=path,
+            villages=os.path.join(path, VILLAGES),
+            parks=os.path.join(path, PARKS),
+            radii=radii,
+            workers=workers,
+            buffer_mask=buffer_mask,
+            rasters=list(rasters.values()),
+        ), n)
+        stages.append(stage)
+    finally:
+        for dataset in rasters.values():
+            dataset.close()
+    return pd.DataFrame(stages).set_index("stage")
+
+
+# Modules too slow to import to be loaded by 'import INPMT', which has to stay fast for the worker processes
+HEAVY_MODULES = ("alive_progress", "geopandas", "matplotlib", "pandas", "rasterio", "scipy")
+
+
+def measure_import(repeat: int = 5) -> tuple[float, list[str]]:
+    """
+    Time 'import INPMT' in a new interpreter, as a worker process or a call to print the version would, and list the
+    heavy modules it loads. The best of several imports is kept, the first ones also paying for the disk cache.
+
+    :param repeat: Number of imports
+    :type repeat: int
+    :return: The time of the import, in seconds, and the heavy modules loaded by it
+    :rtype: tuple[float, list[str]]
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import INPMT\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    seconds, modules = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        seconds.append(float(output[0]))
+        modules = [module for module in output[1].split(",") if module]
+    return min(seconds), modules
+
+
+def compare(report: DataFrame, baseline: DataFrame, tolerance: float = 1.5) -> list[str]:
+    """
+    Compare the time of each stage with a previous report.
+
+    :param report: The report of the current run
+    :type report: DataFrame
+    :param baseline: The report of a previous run
+    :type baseline: DataFrame
+    :param tolerance: Ratio of the times above which a stage is considered slower
+    :type tolerance: float
+    :return: The description of each stage slower than in the baseline
+    :rtype: list[str]
+    """
+    regressions = []
+    for stage in report.index.intersection(baseline.index):
+        ratio = report.loc[stage, "seconds"] / baseline.loc[stage, "seconds"]
+        if ratio > tolerance:
+            regressions.append(f"{stage}: {ratio:.2f}x slower than the baseline")
+    return regressions
+
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the processing of INPMT on synthetic datasets")
+    parser.add_argument("--villages", type=int, default=1000, help="Number of synthetic villages")
+    parser.add_argument("--parks", type=int, default=50, help="Number of synthetic parks")
+    parser.add_argument("--extent", type=float, default=300000., help="Size of the synthetic area, in meters")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic datasets")
+    parser.add_argument("--radii", type=int, nargs="+", default=[500, 2000], help="Sizes of the buffers")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for the profile")
+    parser.add_argument("--buffer-mask", default="circle", help="Shape of the buffers")
+    parser.add_argument("--datasets", help="Directory of the synthetic datasets, kept after the run (temporary if not set)")
+    parser.add_argument("--output", help="Path to the JSON report")
+    parser.add_argument("--baseline", help="Path to a previous JSON report to compare the times with")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="Ratio of the times considered as a regression")
+    parser.add_argument("--import-budget", type=float, default=0.5, help="Maximum time of 'import INPMT', in seconds")
+    options = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = options.datasets or directory
+        generation, _ = measure("dataset", lambda: make_dataset(
+            path, options.villages, options.parks, options.extent, options.seed
+        ), options.villages, memory=False)
+        report = run_benchmark(path, options.radii, options.workers, options.buffer_mask)
+    import_seconds, modules = measure_import()
+    print(f"Synthetic datasets written in {generation['seconds']:.2f} s")
+    print(f"Package imported in {import_seconds * 1000:.1f} ms")
+    print(report.to_string(float_format="{:.3f}".format))
+    if resource is not None:
+        # Maximum resident memory of the whole process, in kilobytes on Linux
+        print(f"Peak resident memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as file:
+            json.dump(report.reset_index().to_dict(orient="records"), file, indent=2)
+    regressions = []
+    if import_seconds > options.import_budget:
+        regressions.append(f"import: {import_seconds:.3f} s over the budget of {options.import_budget:.3f} s")
+    if modules:
+        regressions.append(f"import: loads {', '.join(modules)}")
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as file:
+            baseline = pd.DataFrame(json.load(file)).set_index("stage")
+        regressions += compare(report, baseline, options.tolerance)
+    for regression in regressions:
+        print(regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
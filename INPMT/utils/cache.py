@@ -0,0 +1,117 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Persistent cache of the zonal statistics of the villages
+import hashlib
+import json
+import sqlite3
+import warnings
+from typing import AnyStr
+
+from geopandas import GeoSeries
+
+warnings.filterwarnings("ignore")
+
+# Number of keys looked up per query, below the limit of parameters of old SQLite versions (999)
+BATCH_SIZE = 900
+
+
+def get_geometry_keys(geom_villages: GeoSeries) -> list[str]:
+    """
+    Hash the geometries of the villages so a village moved or reshaped is computed again.
+
+    :param geom_villages: A GeoSeries of the locations of the villages
+    :type geom_villages: GeoSeries
+    :return: The hash of each geometry, empty for the missing ones
+    :rtype: list[str]
+    """
+    return [hashlib.sha1(wkb).hexdigest() if wkb is not None else "" for wkb in geom_villages.to_wkb()]
+
+
+class ZonalCache:
+    """
+    SQLite store of the statistics of each village, for each buffer size and each raster.
+    The entries are keyed by the hash of the geometry of the village, the size of the buffer and the fingerprint of the
+    raster (see ***get_fingerprint***), so changing a raster or its settings invalidates only its own entries.
+    """
+    def __init__(self, path: AnyStr):
+        """
+        :param path: Path to the SQLite file, created if it doesn't exist
+        :type path: AnyStr
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS stats ("
+            "geometry TEXT, radius INTEGER, fingerprint TEXT, statistics TEXT, "
+            "PRIMARY KEY (geometry, radius, fingerprint))"
+        )
+        # The lookups filter on the raster and the buffer size first, then on the villages of a chunk
+        self.connection.execute("CREATE INDEX IF NOT EXISTS stats_lookup ON stats (fingerprint, radius, geometry)")
+
+    def get(self, keys: list[str], radius: int, fingerprint: str) -> dict[str, dict[str, float]]:
+        """
+        Retrieve the statistics stored for the villages, looking them up by key in batches of BATCH_SIZE.
+
+        :param keys: Hashes of the geometries of the villages
+        :type keys: list[str]
+        :param radius: Size of the buffer
+        :type radius: int
+        :param fingerprint: Fingerprint of the raster
+        :type fingerprint: str
+        :return: The statistics of the villages found, by hash
+        :rtype: dict[str, dict[str, float]]
+        """
+        wanted = list(dict.fromkeys(keys))
+        found = {}
+        for start in range(0, len(wanted), BATCH_SIZE):
+            batch = wanted[start:start + BATCH_SIZE]
+            rows = self.connection.execute(
+                "SELECT geometry, statistics FROM stats WHERE fingerprint = ? AND radius = ? "
+                f"AND geometry IN ({', '.join('?' * len(batch))})",
+                (fingerprint, radius, *batch),
+            )
+            found.update((key, json.loads(statistics)) for key, statistics in rows)
+        return found
+
+    def set(self, keys: list[str], radius: int, fingerprint: str, statistics: list[dict[str, float]]) -> None:
+        """
+        Store the statistics of the villages, replacing the ones already stored.
+
+        :param keys: Hashes of the geometries of the villages
+        :type keys: list[str]
+        :param radius: Size of the buffer
+        :type radius: int
+        :param fingerprint: Fingerprint of the raster
+        :type fingerprint: str
+        :param statistics: The statistics of each village
+        :type statistics: list[dict[str, float]]
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?)",
+                [(key, radius, fingerprint, json.dumps(values)) for key, values in zip(keys, statistics)],
+            )
+
+    def close(self) -> None:
+        """
+        Close the connection to the SQLite file.
+        """
+        self.connection.close()
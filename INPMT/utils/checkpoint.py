@@ -0,0 +1,110 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Checkpoints of the villages already processed, to resume a run that crashed or was killed
+import glob
+import json
+import os
+import warnings
+from typing import AnyStr
+
+import pandas as pd
+from pandas import DataFrame
+
+warnings.filterwarnings("ignore")
+
+# Column of the parts holding the hash of the geometry of each village (see ***get_geometry_keys***)
+KEY_COLUMN = "geometry_key"
+# File of the checkpoint holding the fingerprint of each raster, with the settings its statistics were computed with
+FINGERPRINTS = "fingerprints.json"
+
+
+def read_checkpoint(path: AnyStr, keys: pd.Series, fingerprints: dict[str, str]) -> DataFrame | None:
+    """
+    Read every part of the checkpoint written by the previous runs, keeping only the villages whose geometry is the
+    one they were computed for. The villages of another shapefile, or moved since, are left out to be computed again
+    instead of getting the statistics of the village that had their index.
+    The checkpoint is refused when the rasters or their settings (see ***get_fingerprint***) are not the ones it was
+    written with, since all its statistics would be stale.
+
+    :param path: Path to the checkpoint directory
+    :type path: AnyStr
+    :param keys: Hash of the geometry of each village of the run, indexed like the villages
+    :type keys: pd.Series
+    :param fingerprints: Fingerprint of each raster of the run, with its settings, by name
+    :type fingerprints: dict[str, str]
+    :return: The statistics of the villages already processed, or None if there is none yet
+    :rtype: DataFrame | None
+    """
+    parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+    if not parts:
+        return None
+    if not os.path.exists(os.path.join(path, FINGERPRINTS)):
+        raise ValueError(f"The checkpoint {path} doesn't hold the fingerprints of its rasters, start it again")
+    with open(os.path.join(path, FINGERPRINTS)) as file:
+        written = json.load(file)
+    changed = sorted(name for name in {*written, *fingerprints} if written.get(name) != fingerprints.get(name))
+    if changed:
+        raise ValueError(f"The checkpoint {path} was written with other rasters or settings for {', '.join(changed)}")
+    done = pd.concat([pd.read_parquet(part) for part in parts])
+    if KEY_COLUMN not in done.columns:
+        raise ValueError(f"The checkpoint {path} doesn't hold the geometries of its villages, start it again")
+    matching = keys.reindex(done.index).to_numpy() == done[KEY_COLUMN].to_numpy()
+    done = done[matching].drop(columns=KEY_COLUMN)
+    return done[~done.index.duplicated(keep="last")]
+
+
+def write_checkpoint(path: AnyStr, df: DataFrame, keys: pd.Series, fingerprints: dict[str, str]) -> None:
+    """
+    Write the statistics of a chunk of villages as a new part of the checkpoint, with the hash of their geometry, and
+    the fingerprints of the rasters they were computed with.
+    The part is named after the first and last index of the chunk and is written under a temporary name first, so a
+    run killed while writing never leaves a truncated part behind.
+
+    :param path: Path to the checkpoint directory
+    :type path: AnyStr
+    :param df: The statistics of the chunk of villages
+    :type df: DataFrame
+    :param keys: Hash of the geometry of each village of the run, indexed like the villages
+    :type keys: pd.Series
+    :param fingerprints: Fingerprint of each raster of the run, with its settings, by name
+    :type fingerprints: dict[str, str]
+    """
+    os.makedirs(path, exist_ok=True)
+    # The fingerprints are written before the part, so a part is never left without them
+    with open(os.path.join(path, f"{FINGERPRINTS}.tmp"), "w") as file:
+        json.dump(fingerprints, file, indent=4, sort_keys=True)
+    os.replace(os.path.join(path, f"{FINGERPRINTS}.tmp"), os.path.join(path, FINGERPRINTS))
+    output_path = os.path.join(path, f"part-{df.index[0]:09d}-{df.index[-1]:09d}.parquet")
+    df.assign(**{KEY_COLUMN: keys.loc[df.index].to_numpy()}).to_parquet(f"{output_path}.tmp")
+    os.replace(f"{output_path}.tmp", output_path)
+
+
+def write_errors(path: AnyStr, errors: DataFrame) -> None:
+    """
+    Write the villages that failed during the run, so they can be looked at and retried on their own.
+    The file is replaced at each run because the failed villages are retried when a run is resumed.
+
+    :param path: Path to the checkpoint directory
+    :type path: AnyStr
+    :param errors: The index, ID, nearest park and error of each village that failed
+    :type errors: DataFrame
+    """
+    os.makedirs(path, exist_ok=True)
+    errors.to_csv(os.path.join(path, "errors.csv"), index=False)
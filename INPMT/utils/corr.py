@@ -1,31 +1,316 @@
-import os
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
 
-import matplotlib.pyplot as plt
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Correlations between the columns of the profile of the villages
+import argparse
+import sys
+import warnings
+from pathlib import Path
+from typing import AnyStr
+
+import numpy as np
 import pandas as pd
+from pandas import DataFrame
+
+try:
+    from utils.utils import format_dataset_output
+    from utils.writer import FORMATS, INDEX_COLUMN
+except ImportError:
+    from INPMT.utils.utils import format_dataset_output
+    from INPMT.utils.writer import FORMATS, INDEX_COLUMN
+
+warnings.filterwarnings("ignore")
+
+METHODS = ("pearson", "spearman")
+
+
+def read_profile(path: AnyStr, columns: list[str] | None = None) -> DataFrame:
+    """
+    Read the profile written by a run, in CSV, Parquet or Arrow IPC depending on its extension (or an Excel export of
+    it), indexed by the row of each village. Only the columns given are read from the Parquet files.
+
+    :param path: Path to the profile
+    :type path: AnyStr
+    :param columns: Columns to read, all of them if None
+    :type columns: list[str] | None
+    :return: The profile
+    :rtype: DataFrame
+    """
+    extension = Path(path).suffix.lower()
+    if extension in (".xls", ".xlsx"):
+        df = pd.read_excel(path)
+    elif FORMATS.get(extension) == "parquet":
+        import pyarrow.parquet as pq
+
+        # The profiles written before the index was kept have no index column
+        index = [INDEX_COLUMN] if INDEX_COLUMN in pq.read_schema(path).names else []
+        df = pd.read_parquet(path, columns=None if columns is None else [*index, *columns])
+    elif FORMATS.get(extension) == "arrow":
+        df = pd.read_feather(path)
+    elif FORMATS.get(extension) == "csv":
+        df = pd.read_csv(path, index_col=0)
+    else:
+        raise UserWarning(f"Unknown format for {path}, choose one of {sorted(FORMATS)} or .xlsx")
+    if INDEX_COLUMN in df.columns:
+        df = df.set_index(INDEX_COLUMN)
+    return df if columns is None else df[columns]
+
+
+def get_ranks(values: np.ndarray) -> np.ndarray:
+    """
+    Rank the values of each column of one or several arrays of shape (rows, columns), the ties getting the average of
+    their ranks. The NaN are not ranked and stay NaN.
+
+    :param values: Array of shape (..., rows, columns)
+    :type values: np.ndarray
+    :return: The ranks, starting at 1, of the same shape
+    :rtype: np.ndarray
+    """
+    rows = values.shape[-2]
+    flat = np.swapaxes(values, -1, -2).reshape(-1, rows)
+    order = np.argsort(flat, axis=1, kind="stable")
+    ordered = np.take_along_axis(flat, order, axis=1)
+    # Each run of equal values gets the average of its first and last positions
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    stops = np.ones(ordered.shape, dtype=bool)
+    stops[:, :-1] = starts[:, 1:]
+    positions = np.arange(rows)
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(stops, positions, rows)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(flat.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=1)
+    ranks[np.isnan(flat)] = np.nan
+    return np.swapaxes(ranks.reshape(*values.shape[:-2], values.shape[-1], rows), -1, -2)
+
+
+def get_pearson(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the Pearson correlation of every pair of columns of one or several arrays of shape (rows, columns) with a
+    few matrix products, each pair using the rows where both values are known (like DataFrame.corr).
+
+    :param values: Array of shape (..., rows, columns)
+    :type values: np.ndarray
+    :return: The correlations and the number of rows used, of shape (..., columns, columns)
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    valid = ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Centring the columns first avoids losing the precision of the products of large values
+        values = np.where(valid, values - np.nanmean(values, axis=-2, keepdims=True), 0.)
+    mask = valid.astype(np.float64)
+    transpose = lambda array: np.swapaxes(array, -1, -2)
+    count = transpose(mask) @ mask
+    sums = transpose(values) @ mask
+    squares = transpose(values ** 2) @ mask
+    products = transpose(values) @ values
+    with np.errstate(invalid="ignore", divide="ignore"):
+        covariance = products - sums * transpose(sums) / count
+        variance = squares - sums ** 2 / count
+        correlation = covariance / np.sqrt(variance * transpose(variance))
+    correlation = np.where(count > 1, np.clip(correlation, -1., 1.), np.nan)
+    return correlation, count
+
+
+def get_correlation(values: np.ndarray, method: str = "pearson") -> tuple[np.ndarray, np.ndarray]:
+    """
+    :param values: Array of shape (..., rows, columns)
+    :type values: np.ndarray
+    :param method: One of METHODS. The Spearman correlation is the Pearson correlation of the ranks, computed on the
+        known values of each column.
+    :type method: str
+    :return: The correlations and the number of rows used, of shape (..., columns, columns)
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    if method not in METHODS:
+        raise UserWarning(f"Unknown method {method}, choose one of {METHODS}")
+    return get_pearson(get_ranks(values) if method == "spearman" else values)
+
+
+def get_bootstrap(
+    values: np.ndarray,
+    method: str = "pearson",
+    samples: int = 1000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    batch_size: int = 2 ** 25
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Estimate the confidence interval of the correlations by resampling the rows with replacement. The samples are
+    stacked and correlated by batches, each batch being a single computation on an array of shape
+    (samples, rows, columns).
+
+    :param values: Array of shape (rows, columns)
+    :type values: np.ndarray
+    :param method: One of METHODS
+    :type method: str
+    :param samples: Number of samples
+    :type samples: int
+    :param confidence: Level of the interval
+    :type confidence: float
+    :param seed: Seed of the samples
+    :type seed: int
+    :param batch_size: Maximum number of values of a batch of samples
+    :type batch_size: int
+    :return: The lower and upper bounds of the interval, of shape (columns, columns)
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    rng = np.random.default_rng(seed)
+    batch = max(batch_size // max(values.size, 1), 1)
+    correlations = []
+    for start in range(0, samples, batch):
+        rows = rng.integers(0, len(values), size=(min(batch, samples - start), len(values)))
+        correlations.append(get_correlation(values[rows], method)[0])
+    correlations = np.concatenate(correlations)
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanquantile(correlations, alpha, axis=0), np.nanquantile(correlations, 1 - alpha, axis=0)
+
+
+def get_correlations(
+    df: DataFrame,
+    method: str = "pearson",
+    columns: list[str] | None = None,
+    by: str | None = None,
+    bootstrap: int = 0,
+    confidence: float = 0.95,
+    seed: int = 0
+) -> DataFrame:
+    """
+    Correlate every pair of numeric columns of the profile, for the whole profile or for each of its groups (like the
+    villages inside and around the parks with by='loc_NP'). The numeric columns are selected once and correlated with
+    NumPy all at once.
+
+    :param df: The profile
+    :type df: DataFrame
+    :param method: One of METHODS
+    :type method: str
+    :param columns: Columns to correlate, every numeric column by default
+    :type columns: list[str] | None
+    :param by: Column grouping the villages
+    :type by: str | None
+    :param bootstrap: Number of samples of the confidence intervals, 0 to skip them
+    :type bootstrap: int
+    :param confidence: Level of the confidence intervals
+    :type confidence: float
+    :param seed: Seed of the samples
+    :type seed: int
+    :return: A row per group and pair of columns, with the correlation (r), the number of villages (n) and the bounds
+        of the confidence interval (low and high)
+    :rtype: DataFrame
+    """
+    if columns is None:
+        columns = [column for column in df.select_dtypes("number").columns if column != by]
+    values = df[columns].to_numpy(dtype=np.float64)
+    groups = [(None, np.arange(len(df)))] if by is None else [
+        (key, positions) for key, positions in df.groupby(by, sort=True).indices.items()
+    ]
+    x, y = np.triu_indices(len(columns), k=1)
+    results = []
+    for key, positions in groups:
+        correlation, count = get_correlation(values[positions], method)
+        result = pd.DataFrame({
+            "x": np.asarray(columns, dtype=object)[x],
+            "y": np.asarray(columns, dtype=object)[y],
+            "r": correlation[x, y],
+            "n": count[x, y].astype(np.int64),
+        })
+        if bootstrap:
+            low, high = get_bootstrap(values[positions], method, bootstrap, confidence, seed)
+            result["low"], result["high"] = low[x, y], high[x, y]
+        if by is not None:
+            result.insert(0, by, key)
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+
+def get_correlation_matrix(df: DataFrame, method: str = "pearson", columns: list[str] | None = None) -> DataFrame:
+    """
+    :param df: The profile
+    :type df: DataFrame
+    :param method: One of METHODS
+    :type method: str
+    :param columns: Columns to correlate, every numeric column by default
+    :type columns: list[str] | None
+    :return: The correlation matrix of the columns
+    :rtype: DataFrame
+    """
+    columns = list(df.select_dtypes("number").columns) if columns is None else columns
+    correlation, _ = get_correlation(df[columns].to_numpy(dtype=np.float64), method)
+    return pd.DataFrame(correlation, index=columns, columns=columns)
+
+
+def plot_correlation_matrix(matrix: DataFrame, path: AnyStr, title: str = "Correlation Matrix") -> None:
+    """
+    Draw the correlation matrix in an image file, without a display: the figure is rendered by the Agg canvas of
+    matplotlib, which is only imported here.
+
+    :param matrix: The correlation matrix, from the ***get_correlation_matrix*** function
+    :type matrix: DataFrame
+    :param path: Path to the image
+    :type path: AnyStr
+    :param title: Title of the figure
+    :type title: str
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(19, 15))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    image = ax.matshow(matrix.to_numpy(), vmin=-1, vmax=1, cmap="coolwarm")
+    ax.set_xticks(range(matrix.shape[1]), matrix.columns, fontsize=14, rotation=45, ha="left")
+    ax.set_yticks(range(matrix.shape[0]), matrix.index, fontsize=14)
+    colorbar = figure.colorbar(image)
+    colorbar.ax.tick_params(labelsize=14)
+    ax.set_title(title, fontsize=16)
+    figure.savefig(path, bbox_inches="tight")
+
+
+def main(args: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Correlations between the columns of the profile of the villages")
+    parser.add_argument("profile", help="Path to the profile written by a run (CSV, Parquet, Arrow or Excel)")
+    parser.add_argument("--method", choices=METHODS, default="pearson", help="Correlation method")
+    parser.add_argument("--columns", nargs="+", help="Columns to correlate, every numeric column by default")
+    parser.add_argument("--by", help="Column grouping the villages, like loc_NP")
+    parser.add_argument("--bootstrap", type=int, default=0, help="Number of samples of the confidence intervals")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Level of the confidence intervals")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the samples")
+    parser.add_argument("--output", help="Path to the CSV file of the correlations, next to the profile by default")
+    parser.add_argument("--plot", nargs="?", const="", help="Draw the correlation matrix, next to the profile by default")
+    options = parser.parse_args(args)
+
+    columns = None if options.columns is None else [*options.columns, *([options.by] if options.by else [])]
+    df = read_profile(options.profile, columns)
+    correlations = get_correlations(
+        df, options.method, options.columns, options.by, options.bootstrap, options.confidence, options.seed
+    )
+    output = options.output or format_dataset_output(dataset=options.profile, name="corr", ext=".csv")[2]
+    correlations.to_csv(output, index=False)
+    print(f"{len(correlations)} correlations written in {output}")
+    if options.plot is not None:
+        path = options.plot or format_dataset_output(dataset=options.profile, name="corr_plot", ext=".png")[2]
+        plot_correlation_matrix(get_correlation_matrix(df, options.method, options.columns), path)
+        print(f"Correlation matrix drawn in {path}")
+    return 0
+
 
-from INPMT.utils.utils import format_dataset_output
-
-datasets = 'H:\\Cours\\M2\\Cours\\HGADU03 - Memoire\\Projet Impact PN Anopheles\\datasets'
-export = os.path.join(datasets, "result")
-result = os.path.join(datasets, "results_urban_profiles.xlsx")
-_, _, output_path = format_dataset_output(dataset=result, name="corr_plot", ext=".png")
-df = pd.read_excel(result)
-
-f = plt.figure(figsize=(19, 15))
-plt.matshow(df.corr(), fignum=f.number)
-plt.xticks(
-    range(df.select_dtypes(["number"]).shape[1]),
-    df.select_dtypes(["number"]).columns,
-    fontsize=14,
-    rotation=45,
-)
-plt.yticks(
-    range(df.select_dtypes(["number"]).shape[1]),
-    df.select_dtypes(["number"]).columns,
-    fontsize=14,
-)
-cb = plt.colorbar()
-cb.ax.tick_params(labelsize=14)
-plt.title("Correlation Matrix", fontsize=16)
-f.show()
-f.savefig(output_path)
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Registry of the rasters processed around the villages: their file, legend, statistics, scale and nodata
+import json
+import warnings
+from dataclasses import dataclass, fields, replace
+from typing import AnyStr
+
+try:
+    from utils.raster import RasterReader
+except ImportError:
+    from INPMT.utils.raster import RasterReader
+
+warnings.filterwarnings("ignore")
+
+# Types of rasters: continuous values reduced to statistics, or categories counted with the labels of a legend
+KINDS = ("continuous", "categorical")
+
+
+@dataclass(frozen=True)
+class Layer:
+    """
+    A raster processed around the villages: its file in the datasets directory, its kind (one of KINDS), the legend
+    of a categorical raster (a .qml file and the tag of its items), the statistics computed as (column, statistic), the
+    scale and offset turning the raw values into real ones (value = raw * scale + offset), the value of the nodata
+    pixels, the dtype of the columns of the profile and the labels of the bands of a stack (dates, years...).
+    The scale, the offset and the nodata left to None are read from the metadata of the raster.
+    Without bands, only the first band of the raster is processed. With bands, every band is read at once and each
+    column is computed for every band, suffixed by its label.
+    """
+    name: str
+    file: str | None = None
+    kind: str = "continuous"
+    legend: str | None = None
+    legend_item: str = "item"
+    statistics: tuple[tuple[str, str], ...] = ()
+    scale: float | None = None
+    offset: float | None = None
+    nodata: float | None = None
+    dtype: str = "float64"
+    bands: tuple[str, ...] = ()
+
+    def __post_init__(self):
+        if self.kind not in KINDS:
+            raise UserWarning(f"Unknown kind {self.kind} for the layer {self.name}, choose one of {KINDS}")
+        if self.kind == "categorical" and self.legend is None:
+            raise UserWarning(f"The categorical layer {self.name} needs a legend")
+        if self.kind == "continuous" and any(statistic == "distinct" for _, statistic in self.statistics):
+            raise UserWarning(f"The distinct statistic of the layer {self.name} needs a categorical layer")
+        if len(set(self.bands)) != len(self.bands):
+            raise UserWarning(f"The bands of the layer {self.name} must have different labels")
+
+    def get_columns(self, columns: list[str], radius: int) -> list[str]:
+        """
+        Name the columns of the profile computed for a buffer size, once per band for a stack.
+
+        :param columns: Columns of the layer (its statistics or the labels of its legend)
+        :type columns: list[str]
+        :param radius: Size of the buffer
+        :type radius: int
+        :return: The columns suffixed by the label of the band, if any, and by the size of the buffer
+        :rtype: list[str]
+        """
+        if not self.bands:
+            return [f"{column}_{radius}" for column in columns]
+        return [f"{column}_{band}_{radius}" for column in columns for band in self.bands]
+
+    def resolve(self, dataset: RasterReader) -> "Layer":
+        """
+        Fill the settings left to None with the metadata of the raster.
+
+        :param dataset: The raster of the layer
+        :type dataset: RasterReader
+        :return: The layer with every setting known
+        :rtype: Layer
+        """
+        if self.bands and len(self.bands) != dataset.count:
+            raise UserWarning(f"The layer {self.name} has {len(self.bands)} bands but its raster has {dataset.count}")
+        return replace(
+            self,
+            scale=self.scale if self.scale is not None else dataset.scale,
+            offset=self.offset if self.offset is not None else dataset.offset,
+            nodata=self.nodata if self.nodata is not None else dataset.nodata,
+        )
+
+
+def read_layers(path: AnyStr | None, defaults: dict[str, Layer]) -> dict[str, Layer]:
+    """
+    Read the configuration of the layers from a JSON file, the settings missing in the file being the default ones.
+    The file maps the name of each raster to its settings, so a new raster is added by giving its file and statistics,
+    for example:
+    {
+        "ndvi": {"statistics": [["NDVI_mean", "mean"], ["NDVI_std", "std"]], "scale": 0.0001},
+        "elevation": {"file": "ELEVATION_AFRICA_reprj3857.tif", "statistics": [["ELEVATION", "mean"]]},
+        "ndvi_decade": {"file": "NDVI_2007_2016.tif", "statistics": [["NDVI_mean", "mean"]], "bands": ["2007", ...]}
+    }
+    A layer given as null in the file is removed.
+
+    :param path: Path to the JSON file, or None to keep the default layers
+    :type path: AnyStr | None
+    :param defaults: The default layers, by name
+    :type defaults: dict[str, Layer]
+    :return: The layers, by name
+    :rtype: dict[str, Layer]
+    """
+    layers = dict(defaults)
+    if path is None:
+        return layers
+    with open(path, encoding="utf-8") as file:
+        config = json.load(file)
+    names = {f.name for f in fields(Layer)} - {"name"}
+    for name, settings in config.items():
+        if settings is None:
+            layers.pop(name, None)
+            continue
+        unknown = set(settings) - names
+        if unknown:
+            raise UserWarning(f"Unknown settings {sorted(unknown)} for the layer {name}, choose among {sorted(names)}")
+        if "statistics" in settings:
+            settings = {**settings, "statistics": tuple(tuple(statistic) for statistic in settings["statistics"])}
+        if "bands" in settings:
+            settings = {**settings, "bands": tuple(str(band) for band in settings["bands"])}
+        layers[name] = replace(layers.get(name, Layer(name)), **settings)
+    return layers
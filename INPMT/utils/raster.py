@@ -18,19 +18,286 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import hashlib
+import json
+import os
 import warnings
+from collections import OrderedDict
+from typing import Any, AnyStr
 
 import numpy as np
-import pandas as pd
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.windows import Window
 
 warnings.filterwarnings("ignore")
 
 
-def get_pixel_count(dataset):
-    values, count = np.unique(dataset.values, return_counts=True)
-    res = dataset.x.values[1] - dataset.x.values[0]
-    pxl_area = res * res
-    area = count * pxl_area
-    area_total = area.sum()
-    percentage = area * 100 / area_total
-    return pd.DataFrame(data={"cat": values, "Proportion (%)": percentage})
+class RasterReader:
+    """
+    Keep a raster file open and serve windows of it read directly from the file, instead of loading the raster (or
+    building a dask graph for each window) with rioxarray.
+    The blocks of the file read for a window are kept in a small LRU cache, so the windows of neighbouring villages
+    sharing blocks don't decode them again.
+    """
+    def __init__(self, path: AnyStr, name: str | None = None, cache_size: int = 64):
+        """
+        :param path: Path to the raster
+        :type path: AnyStr
+        :param name: Name of the raster, the name of the file by default
+        :type name: str | None
+        :param cache_size: Size of the cache of blocks, in MB
+        :type cache_size: int
+        """
+        self.path = path
+        self.dataset = rasterio.open(path)
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        self.transform: Affine = self.dataset.transform
+        self.crs = self.dataset.crs
+        self.nodata = self.dataset.nodata
+        self.scale = self.dataset.scales[0]
+        self.offset = self.dataset.offsets[0]
+        self.dtype = np.dtype(self.dataset.dtypes[0])
+        self.count = self.dataset.count
+        self.shape = (self.dataset.height, self.dataset.width)
+        self.block_shape = self.dataset.block_shapes[0]
+        self.cache_size = cache_size * 1024 * 1024
+        self.blocks: OrderedDict[tuple[int, int, int], np.ndarray] = OrderedDict()
+        self.cached = 0
+
+    def read_block(self, band: int | None, row: int, col: int) -> np.ndarray:
+        """
+        Read a block of the file, from the cache if it was read recently.
+
+        :param band: Band of the block, starting at 1, or None for every band
+        :type band: int | None
+        :param row: Row of the block
+        :type row: int
+        :param col: Column of the block
+        :type col: int
+        :return: The pixels of the block
+        :rtype: np.ndarray
+        """
+        key = (band, row, col)
+        if key in self.blocks:
+            self.blocks.move_to_end(key)
+            return self.blocks[key]
+        height, width = self.block_shape
+        window = Window(col * width, row * height, min(width, self.shape[1] - col * width), min(height, self.shape[0] - row * height))
+        block = self.dataset.read(band, window=window)
+        self.blocks[key] = block
+        self.cached += block.nbytes
+        while self.cached > self.cache_size and len(self.blocks) > 1:
+            _, evicted = self.blocks.popitem(last=False)
+            self.cached -= evicted.nbytes
+        return block
+
+    def read(self, window: tuple[int, int, int, int], band: int | None = 1) -> np.ndarray:
+        """
+        Read a window of the raster from the blocks covering it. Every band of a stack is read with a single read of
+        each block.
+
+        :param window: Window (row_start, row_stop, col_start, col_stop), inside the raster
+        :type window: tuple[int, int, int, int]
+        :param band: Band to read, starting at 1, or None to read every band
+        :type band: int | None
+        :return: The pixels of the window, of shape (height, width) or (bands, height, width)
+        :rtype: np.ndarray
+        """
+        row_start, row_stop, col_start, col_stop = (int(value) for value in window)
+        bands = () if band is not None else (self.count,)
+        pixels = np.empty((*bands, max(row_stop - row_start, 0), max(col_stop - col_start, 0)), dtype=self.dtype)
+        if pixels.size == 0:
+            return pixels
+        height, width = self.block_shape
+        for row in range(row_start // height, (row_stop - 1) // height + 1):
+            for col in range(col_start // width, (col_stop - 1) // width + 1):
+                block = self.read_block(band, row, col)
+                y, x = row * height, col * width
+                r0, r1 = max(row_start, y), min(row_stop, y + block.shape[-2])
+                c0, c1 = max(col_start, x), min(col_stop, x + block.shape[-1])
+                pixels[..., r0 - row_start:r1 - row_start, c0 - col_start:c1 - col_start] = block[..., r0 - y:r1 - y, c0 - x:c1 - x]
+        return pixels
+
+    def window_transform(self, window: tuple[int, int, int, int]) -> Affine:
+        """
+        Compute the affine transform of a window of the raster.
+
+        :param window: Window (row_start, row_stop, col_start, col_stop)
+        :type window: tuple[int, int, int, int]
+        :return: The affine transform of the window
+        :rtype: Affine
+        """
+        return self.transform * Affine.translation(int(window[2]), int(window[0]))
+
+    def close(self) -> None:
+        """
+        Close the raster file.
+        """
+        self.dataset.close()
+
+
+def get_fingerprint(dataset: RasterReader, settings: Any = None) -> str:
+    """
+    Identify the content of a raster by the path, the modification time and the size of its file and by its affine
+    transform, plus the settings used to process it, so a raster which changed is never mistaken for the old one.
+
+    :param dataset: Raster opened from a file
+    :type dataset: RasterReader
+    :param settings: Anything JSON serializable which changes the processing of the raster
+    :type settings: Any
+    :return: The fingerprint of the raster
+    :rtype: str
+    """
+    path = os.path.abspath(dataset.path)
+    stat = os.stat(path)
+    description = [path, stat.st_mtime_ns, stat.st_size, list(dataset.transform)[:6], settings]
+    return hashlib.sha1(json.dumps(description, default=str).encode()).hexdigest()
+
+
+def get_source(path: AnyStr) -> dict[str, Any]:
+    """
+    Describe the file a raster was prepared from, to know whether the prepared raster is still up to date.
+
+    :param path: Path to the raster
+    :type path: AnyStr
+    :return: The absolute path, the modification time and the size of the file
+    :rtype: dict[str, Any]
+    """
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def is_prepared(path: AnyStr, output_path: AnyStr) -> bool:
+    """
+    Check whether a raster was prepared with the ***prepare_raster*** function since the last change of its file.
+
+    :param path: Path to the raster
+    :type path: AnyStr
+    :param output_path: Path to the prepared raster (.npy)
+    :type output_path: AnyStr
+    :return: Whether the prepared raster exists and is up to date
+    :rtype: bool
+    """
+    metadata_path = f"{os.path.splitext(output_path)[0]}.json"
+    if not os.path.exists(output_path) or not os.path.exists(metadata_path):
+        return False
+    with open(metadata_path, encoding="utf-8") as file:
+        return json.load(file)["source"] == get_source(path)
+
+
+def prepare_raster(path: AnyStr, output_path: AnyStr, rows: int = 1024) -> None:
+    """
+    Convert a raster once into an uncompressed NumPy array (.npy) of shape (bands, height, width) that can be memory
+    mapped, with its affine transform, CRS, nodata, scales and offsets in a JSON file next to it. The array is written
+    by strips of rows so the raster never has to fit in memory, and under temporary names first so an interrupted
+    preparation never leaves a truncated array behind.
+    The array is kept in row order rather than tiled, so any window is a view of the file mapped in memory.
+
+    :param path: Path to the raster
+    :type path: AnyStr
+    :param output_path: Path to the prepared raster (.npy)
+    :type output_path: AnyStr
+    :param rows: Number of rows converted at once
+    :type rows: int
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    metadata_path = f"{os.path.splitext(output_path)[0]}.json"
+    with rasterio.open(path) as dataset:
+        shape = (dataset.count, dataset.height, dataset.width)
+        array = np.lib.format.open_memmap(f"{output_path}.tmp", mode="w+", dtype=dataset.dtypes[0], shape=shape)
+        for row in range(0, dataset.height, rows):
+            height = min(rows, dataset.height - row)
+            array[:, row:row + height] = dataset.read(window=Window(0, row, dataset.width, height))
+        array.flush()
+        del array
+        metadata = {
+            "source": get_source(path),
+            "transform": list(dataset.transform)[:6],
+            "crs": dataset.crs.to_wkt() if dataset.crs is not None else None,
+            "nodata": dataset.nodata,
+            "scales": list(dataset.scales),
+            "offsets": list(dataset.offsets),
+        }
+    with open(f"{metadata_path}.tmp", "w", encoding="utf-8") as file:
+        json.dump(metadata, file, indent=2)
+    os.replace(f"{output_path}.tmp", output_path)
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+
+
+class MemmapReader:
+    """
+    Serve windows of a raster prepared with the ***prepare_raster*** function, with the same interface as the
+    RasterReader. The array is memory mapped, so a window is a view of the file that is never decompressed nor copied
+    and the reads are only limited by the page cache of the system.
+    """
+    def __init__(self, path: AnyStr, name: str | None = None):
+        """
+        :param path: Path to the prepared raster (.npy)
+        :type path: AnyStr
+        :param name: Name of the raster, the name of the file by default
+        :type name: str | None
+        """
+        self.path = path
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        with open(f"{os.path.splitext(path)[0]}.json", encoding="utf-8") as file:
+            metadata = json.load(file)
+        self.array = np.load(path, mmap_mode="r")
+        self.transform = Affine(*metadata["transform"])
+        self.crs = CRS.from_wkt(metadata["crs"]) if metadata["crs"] is not None else None
+        self.nodata = metadata["nodata"]
+        self.scale = metadata["scales"][0]
+        self.offset = metadata["offsets"][0]
+        self.dtype = self.array.dtype
+        self.count = self.array.shape[0]
+        self.shape = self.array.shape[1:]
+
+    def read(self, window: tuple[int, int, int, int], band: int | None = 1) -> np.ndarray:
+        """
+        Read a window of the raster.
+
+        :param window: Window (row_start, row_stop, col_start, col_stop), inside the raster
+        :type window: tuple[int, int, int, int]
+        :param band: Band to read, starting at 1, or None to read every band
+        :type band: int | None
+        :return: The pixels of the window, of shape (height, width) or (bands, height, width), as a read-only view of
+            the file
+        :rtype: np.ndarray
+        """
+        row_start, row_stop, col_start, col_stop = (int(value) for value in window)
+        bands = slice(None) if band is None else band - 1
+        return self.array[bands, row_start:max(row_stop, row_start), col_start:max(col_stop, col_start)]
+
+    def window_transform(self, window: tuple[int, int, int, int]) -> Affine:
+        """
+        Compute the affine transform of a window of the raster.
+
+        :param window: Window (row_start, row_stop, col_start, col_stop)
+        :type window: tuple[int, int, int, int]
+        :return: The affine transform of the window
+        :rtype: Affine
+        """
+        return self.transform * Affine.translation(int(window[2]), int(window[0]))
+
+    def close(self) -> None:
+        """
+        Unmap the file.
+        """
+        self.array = None
+
+
+def open_dataset(path: AnyStr, name: str | None = None) -> RasterReader | MemmapReader:
+    """
+    Open a raster with a MemmapReader if it was prepared (.npy), with a RasterReader otherwise.
+
+    :param path: Path to the raster
+    :type path: AnyStr
+    :param name: Name of the raster
+    :type name: str | None
+    :return: The raster opened
+    :rtype: RasterReader | MemmapReader
+    """
+    if os.path.splitext(path)[1].lower() == ".npy":
+        return MemmapReader(path, name=name)
+    return RasterReader(path, name=name)
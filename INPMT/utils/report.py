@@ -0,0 +1,94 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Timers and counters of the stages of a run
+import json
+import time
+import warnings
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any, AnyStr
+
+warnings.filterwarnings("ignore")
+
+
+class RunReport:
+    """
+    Time spent in each stage of a run and counters of what was processed (pixels read, windows clipped, villages
+    failed...). A timer only costs two calls to perf_counter, so the report can stay on for the real runs.
+    The reports of the worker processes are merged into the one of the main process, which means the time of a stage
+    is the sum of the time spent in it by every process and can be longer than the run itself.
+    """
+    def __init__(self):
+        self.timers: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """
+        Add the time spent in the block to the timer of a stage.
+
+        :param stage: Name of the stage
+        :type stage: str
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] = self.timers.get(stage, 0.) + time.perf_counter() - start
+
+    def count(self, counter: str, value: int = 1) -> None:
+        """
+        Add a value to a counter.
+
+        :param counter: Name of the counter
+        :type counter: str
+        :param value: Value to add
+        :type value: int
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + int(value)
+
+    def merge(self, other: "RunReport") -> None:
+        """
+        Add the timers and counters of another report, usually the one of a worker process.
+
+        :param other: The other report
+        :type other: RunReport
+        """
+        for stage, seconds in other.timers.items():
+            self.timers[stage] = self.timers.get(stage, 0.) + seconds
+        for counter, value in other.counters.items():
+            self.count(counter, value)
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        :return: The timers, in seconds, and the counters
+        :rtype: dict[str, Any]
+        """
+        return {"timers": dict(self.timers), "counters": dict(self.counters)}
+
+    def write(self, path: AnyStr) -> None:
+        """
+        Write the report as JSON.
+
+        :param path: Path to the JSON file
+        :type path: AnyStr
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2)
@@ -23,10 +23,12 @@ import unicodedata
 import xml.dom.minidom
 from datetime import datetime
 from pathlib import Path
-from typing import AnyStr
+from typing import Any, AnyStr
 from warnings import filterwarnings
 
 import numpy as np
+import pandas as pd
+from pandas import DataFrame
 
 filterwarnings("ignore")
 config_file_path = 'INPMT/config.cfg'
@@ -95,13 +97,88 @@ def read_qml(path_qml: AnyStr, item_type: AnyStr) -> list:
     return legend
 
 
-def clip(ds, geom):
-    x_min, y_min, x_max, y_max = geom.bounds
-    row_start = float(ds.sel(x=x_min, method='nearest').x.values)
-    col_start = float(ds.sel(y=y_max, method='nearest').y.values)
-    row_stop = float(ds.sel(x=x_max, method='nearest').x.values)
-    col_stop = float(ds.sel(y=y_min, method='nearest').y.values)
-    da = ds.sel(x=slice(row_start, row_stop), y=slice(col_start, col_stop)).chunk()
-    # Change dtype to avoid -inf errors on aggregations
-    # https://stackoverflow.com/a/24313860
-    return da.astype(np.float64)
+def get_hilbert_order(x: np.ndarray, y: np.ndarray, bits: int = 16) -> np.ndarray:
+    """
+    Sort points along a Hilbert curve, so that points close to each other in space are close to each other in the
+    order too. The points without finite coordinates (the centroid of a missing or empty geometry) come last.
+    https://en.wikipedia.org/wiki/Hilbert_curve#Applications_and_mapping_algorithms
+
+    :param x: X coordinates of the points
+    :type x: np.ndarray
+    :param y: Y coordinates of the points
+    :type y: np.ndarray
+    :param bits: Number of bits used to quantize the coordinates on each axis
+    :type bits: int
+    :return: The positions of the points sorted along the curve
+    :rtype: np.ndarray
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) == 0:
+        return np.arange(0)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.any():
+        return np.arange(len(x))
+    n = 1 << bits
+    x_min, y_min = x[finite].min(), y[finite].min()
+    span = max(x[finite].max() - x_min, y[finite].max() - y_min) or 1.
+    x = ((np.where(finite, x, x_min) - x_min) / span * (n - 1)).astype(np.int64)
+    y = ((np.where(finite, y, y_min) - y_min) / span * (n - 1)).astype(np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    # The curve fills [0, n * n), the points without coordinates are put after it
+    d[~finite] = n * n
+    return np.argsort(d, kind="stable")
+
+
+class ResultAccumulator:
+    """
+    Accumulate the values of a result in preallocated arrays and build the DataFrame only once at the end, instead of
+    writing the values of each row in a DataFrame that has to grow (and may be reallocated or upcast) every time.
+    The columns are typed arrays of the size of the index, all of them known before the first value is set.
+    """
+    def __init__(self, index: pd.Index, columns: dict[str, Any]):
+        """
+        :param index: Index of the rows of the result
+        :type index: pd.Index
+        :param columns: Columns with their dtype
+        :type columns: dict[str, Any]
+        """
+        self.index = index
+        self.columns = {column: np.zeros(len(index), dtype=dtype) for column, dtype in columns.items()}
+        for column, values in self.columns.items():
+            if values.dtype.kind == "f":
+                values[:] = np.nan
+            elif values.dtype.kind == "O":
+                values[:] = None
+
+    def set(self, column: str, positions: Any, values: Any) -> None:
+        """
+        Set the values of a column at the given positions.
+
+        :param column: Name of the column
+        :type column: str
+        :param positions: Positions of the rows (array of integers, boolean mask or slice)
+        :type positions: Any
+        :param values: Values to set
+        :type values: Any
+        """
+        self.columns[column][positions] = values
+
+    def to_dataframe(self) -> DataFrame:
+        """
+        Build the DataFrame of the result, the columns in the order they were declared.
+
+        :return: The result
+        :rtype: DataFrame
+        """
+        return pd.DataFrame(self.columns, index=self.index)
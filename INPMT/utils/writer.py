@@ -0,0 +1,128 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Writer of the profile of the villages, batch after batch
+import warnings
+from pathlib import Path
+from typing import Any, AnyStr
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+warnings.filterwarnings("ignore")
+
+# Format of the output file by extension
+FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+}
+# Column holding the index of the rows (the row of each village in the shapefile)
+INDEX_COLUMN = "index"
+
+
+def get_schema(columns: list[str], dtypes: dict[str, Any], default: Any = np.float64) -> pa.Schema:
+    """
+    Build the Arrow schema of the profile from the dtype of its columns, the object columns being strings.
+
+    :param columns: Columns of the profile
+    :type columns: list[str]
+    :param dtypes: Dtype of the columns
+    :type dtypes: dict[str, Any]
+    :param default: Dtype of the columns missing in dtypes
+    :type default: Any
+    :return: The schema
+    :rtype: pa.Schema
+    """
+    fields = []
+    for column in columns:
+        dtype = np.dtype(dtypes.get(column, default))
+        fields.append(pa.field(column, pa.string() if dtype.kind == "O" else pa.from_numpy_dtype(dtype)))
+    return pa.schema(fields)
+
+
+class ProfileWriter:
+    """
+    Write the batches of the profile as they are produced in a CSV, Parquet or Arrow IPC file, so the whole profile
+    never has to be held in memory. The schema is taken from the columns of the first batch and the dtypes given, and
+    every batch is cast to it.
+    The index is written as the first column in every format, so the rows keep their identity whatever their order.
+    """
+    def __init__(
+        self, path: AnyStr, dtypes: dict[str, Any] | None = None, file_format: str | None = None, index: bool = True
+    ):
+        """
+        :param path: Path to the output file
+        :type path: AnyStr
+        :param dtypes: Dtype of the columns which are not floats
+        :type dtypes: dict[str, Any] | None
+        :param file_format: 'csv', 'parquet' or 'arrow'. If None, the extension of the output file is used.
+        :type file_format: str | None
+        :param index: Whether to write the index as the INDEX_COLUMN column
+        :type index: bool
+        """
+        self.path = path
+        self.dtypes = dtypes or {}
+        self.index = index
+        self.file_format = file_format or FORMATS.get(Path(path).suffix.lower())
+        if self.file_format not in FORMATS.values():
+            raise UserWarning(f"Unknown output format for {path}, choose one of {sorted(set(FORMATS.values()))}")
+        self.schema: pa.Schema | None = None
+        self.writer: Any = None
+        self.rows = 0
+
+    def write(self, df: DataFrame) -> None:
+        """
+        Append a batch of the profile to the output file.
+
+        :param df: Batch of the profile
+        :type df: DataFrame
+        """
+        if self.index:
+            self.dtypes.setdefault(INDEX_COLUMN, df.index.dtype)
+            df = df.rename_axis(INDEX_COLUMN).reset_index()
+        if self.schema is None:
+            self.schema = get_schema(list(df.columns), self.dtypes)
+            if self.file_format == "parquet":
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            elif self.file_format == "arrow":
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+        if self.file_format == "csv":
+            df = df.astype({field.name: field.type.to_pandas_dtype() for field in self.schema if field.type != pa.string()})
+            df.to_csv(self.path, mode="a" if self.rows else "w", header=not self.rows, index=False)
+        else:
+            self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        self.rows += len(df)
+
+    def close(self) -> None:
+        """
+        Close the output file.
+        """
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self) -> "ProfileWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
@@ -0,0 +1,386 @@
+"""
+INPMT
+A tool to process data to learn more about Impact of National Parks on Malaria Transmission
+
+Copyright (C) <2021>  <Manchon Pierre>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+# Functions to compute zonal statistics on windows of a raster for many geometries at once
+import warnings
+from collections.abc import Iterator
+from functools import cache
+from typing import Any
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+try:
+    from utils.raster import RasterReader
+except ImportError:
+    from INPMT.utils.raster import RasterReader
+
+warnings.filterwarnings("ignore")
+
+# Statistics computed by the ***reduce_windows*** function
+REDUCTIONS = ("sum", "min", "mean", "max", "count", "std")
+# Number of bins per side of a pixel the position of the villages inside their pixel is quantized into, for the masks
+SUBPIXEL_BINS = 4
+
+
+def get_windows(transform, bounds: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    """
+    Convert the bounds of many geometries to pixel windows using the affine transform of the raster.
+    The window covers every pixel whose centre is the nearest to the bounds (like a nearest selection would do) and is
+    clipped to the extent of the raster, which means geometries outside the raster get empty windows.
+
+    :param transform: Affine transform of the raster
+    :type transform: Affine
+    :param bounds: Array of shape (n, 4) of the bounds (x_min, y_min, x_max, y_max) of each geometry
+    :type bounds: np.ndarray
+    :param shape: Height and width of the raster
+    :type shape: tuple[int, int]
+    :return: Array of shape (n, 4) of the windows (row_start, row_stop, col_start, col_stop)
+    :rtype: np.ndarray
+    """
+    height, width = shape
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    col_start = np.floor((bounds[:, 0] - transform.c) / transform.a)
+    col_stop = np.floor((bounds[:, 2] - transform.c) / transform.a) + 1
+    row_start = np.floor((bounds[:, 3] - transform.f) / transform.e)
+    row_stop = np.floor((bounds[:, 1] - transform.f) / transform.e) + 1
+    windows = np.stack([row_start, row_stop, col_start, col_stop], axis=1)
+    windows[:, :2] = np.clip(windows[:, :2], 0, height)
+    windows[:, 2:] = np.clip(windows[:, 2:], 0, width)
+    return windows.astype(np.int64)
+
+
+@cache
+def get_buffer_mask(
+    resolution: tuple[float, float],
+    radius: float,
+    coverage: bool = False,
+    offset: tuple[float, float] = (0., 0.),
+    samples: int = 8
+) -> np.ndarray:
+    """
+    Rasterize a circular buffer once for a given size of buffer, resolution of raster and position of the village inside
+    its pixel, so the same mask is reused for every village in the same part of its pixel instead of rasterizing the
+    buffer of each one.
+    The circle is centred on the central pixel of the mask moved by the offset, the position of the village relative to
+    the centre of its pixel. Quantized in SUBPIXEL_BINS bins per side (see ***get_subpixel_offsets***), it puts the
+    centre of the buffer half a bin away from the village at most, instead of half a pixel.
+    Without coverage, a pixel is in the buffer when its centre is, and a buffer smaller than the pixels holding no
+    centre at all keeps the pixel of the village, the central one. With coverage, each pixel is weighted by the fraction
+    of its area inside the buffer, estimated on a grid of samples x samples points.
+
+    :param resolution: Width and height of the pixels
+    :type resolution: tuple[float, float]
+    :param radius: Size of the buffer
+    :type radius: float
+    :param coverage: Whether to weight the pixels by the fraction of their area inside the buffer
+    :type coverage: bool
+    :param offset: Position of the centre of the buffer relative to the centre of the central pixel, in pixels along
+        the columns and the rows, between -0.5 and 0.5
+    :type offset: tuple[float, float]
+    :param samples: Number of points per side of a pixel used to estimate the coverage
+    :type samples: int
+    :return: The weights of the pixels of shape (2 * rows + 1, 2 * cols + 1), as 0 and 1 without coverage
+    :rtype: np.ndarray
+    """
+    width, height = abs(resolution[0]), abs(resolution[1])
+    # The mask stays centred on the pixel of the village, so it grows on both sides to hold the moved circle
+    rows, cols = int(np.ceil(radius / height + abs(offset[1]))), int(np.ceil(radius / width + abs(offset[0])))
+    y = (np.arange(-rows, rows + 1)[:, None] - offset[1]) * height
+    x = (np.arange(-cols, cols + 1)[None, :] - offset[0]) * width
+    if not coverage:
+        mask = (x ** 2 + y ** 2 <= radius ** 2).astype(np.float64)
+        if not mask.any():
+            mask[rows, cols] = 1.
+        return mask
+    offsets = (np.arange(samples) + 0.5) / samples - 0.5
+    weights = np.zeros((len(y), x.shape[1]))
+    for dy in offsets * height:
+        for dx in offsets * width:
+            weights += (x + dx) ** 2 + (y + dy) ** 2 <= radius ** 2
+    return weights / samples ** 2
+
+
+def get_subpixel_offsets(transform, x: np.ndarray, y: np.ndarray, bins: int = SUBPIXEL_BINS) -> np.ndarray:
+    """
+    Locate each village inside its pixel, quantized in bins x bins parts of the pixel so the villages in the same part
+    share the same buffer mask (see ***get_buffer_mask***).
+
+    :param transform: Affine transform of the raster
+    :type transform: Affine
+    :param x: Coordinates of the villages along the x axis
+    :type x: np.ndarray
+    :param y: Coordinates of the villages along the y axis
+    :type y: np.ndarray
+    :param bins: Number of bins per side of a pixel
+    :type bins: int
+    :return: Array of shape (n, 2) of the position of each village relative to the centre of its pixel, in pixels along
+        the columns and the rows, as the centre of its bin
+    :rtype: np.ndarray
+    """
+    col = (np.asarray(x, dtype=np.float64) - transform.c) / transform.a
+    row = (np.asarray(y, dtype=np.float64) - transform.f) / transform.e
+    fractions = np.stack([col - np.floor(col), row - np.floor(row)], axis=1)
+    quantized = np.clip(np.floor(np.nan_to_num(fractions, nan=0.5) * bins), 0, bins - 1)
+    return (quantized + 0.5) / bins - 0.5
+
+
+def is_reprojected(source: Any, target: Any) -> bool:
+    """
+    :param source: CRS of the villages (anything understood by pyproj), or None if unknown
+    :type source: Any
+    :param target: CRS of the raster, or None if unknown
+    :type target: Any
+    :return: Whether the coordinates of the villages must be reprojected to be read in the raster, which is assumed not
+        to be the case when one of the CRS is unknown
+    :rtype: bool
+    """
+    if source is None or target is None:
+        return False
+    return not CRS.from_user_input(source).equals(CRS.from_user_input(target), ignore_axis_order=True)
+
+
+def reproject_points(x: np.ndarray, y: np.ndarray, source: Any, target: Any) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reproject many points at once.
+
+    :param x: Coordinates of the points along the x axis
+    :type x: np.ndarray
+    :param y: Coordinates of the points along the y axis
+    :type y: np.ndarray
+    :param source: CRS of the points
+    :type source: Any
+    :param target: CRS to reproject them to
+    :type target: Any
+    :return: The coordinates of the points in the target CRS
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    transformer = Transformer.from_crs(CRS.from_user_input(source), CRS.from_user_input(target), always_xy=True)
+    return transformer.transform(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+
+def get_local_resolution(transform, crs: Any, x: np.ndarray, y: np.ndarray, source: Any, digits: int = 3) -> np.ndarray:
+    """
+    Measure the width and the height of the pixel of a raster containing each village in the units of the CRS of the
+    villages, by reprojecting its edges, so the buffers keep their size in a raster of another CRS (in degrees, for
+    instance) without reprojecting the raster. The pixels are assumed to stay aligned with the axes of the CRS of the
+    villages around a village.
+    The sizes are rounded to a few significant digits, so the villages at similar latitudes share the same buffer mask.
+
+    :param transform: Affine transform of the raster
+    :type transform: Affine
+    :param crs: CRS of the raster
+    :type crs: Any
+    :param x: Coordinates of the villages along the x axis, in the CRS of the raster
+    :type x: np.ndarray
+    :param y: Coordinates of the villages along the y axis, in the CRS of the raster
+    :type y: np.ndarray
+    :param source: CRS of the villages
+    :type source: Any
+    :param digits: Number of significant digits of the sizes
+    :type digits: int
+    :return: Array of shape (n, 2) of the width and height of the pixels, signed like the ones of the transform
+    :rtype: np.ndarray
+    """
+    half_width, half_height = transform.a / 2, transform.e / 2
+    left = reproject_points(x - half_width, y, crs, source)
+    right = reproject_points(x + half_width, y, crs, source)
+    top = reproject_points(x, y - half_height, crs, source)
+    bottom = reproject_points(x, y + half_height, crs, source)
+    width = np.hypot(right[0] - left[0], right[1] - left[1])
+    height = np.hypot(bottom[0] - top[0], bottom[1] - top[1])
+    sizes = np.stack([width, height], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = 10 ** (np.floor(np.log10(sizes)) - digits + 1)
+    sizes = np.where(np.isfinite(scale) & (scale > 0), np.round(sizes / scale) * scale, sizes)
+    return sizes * np.sign([transform.a, transform.e])
+
+
+def get_centred_windows(transform, x: np.ndarray, y: np.ndarray, mask_shape: tuple[int, int],
+                        shape: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Centre a window of the shape of a buffer mask on the pixel containing each village.
+    The windows are clipped to the extent of the raster and the part of the mask matching each clipped window is given
+    along with it, so the villages near the edges of the raster keep only the pixels which exist.
+
+    :param transform: Affine transform of the raster
+    :type transform: Affine
+    :param x: Coordinates of the villages along the x axis
+    :type x: np.ndarray
+    :param y: Coordinates of the villages along the y axis
+    :type y: np.ndarray
+    :param mask_shape: Shape of the mask of the buffer, from the ***get_buffer_mask*** function
+    :type mask_shape: tuple[int, int]
+    :param shape: Height and width of the raster
+    :type shape: tuple[int, int]
+    :return: Arrays of shape (n, 4) of the windows (row_start, row_stop, col_start, col_stop) in the raster and in the
+        mask
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    rows, cols = mask_shape[0] // 2, mask_shape[1] // 2
+    row = np.floor((np.asarray(y, dtype=np.float64) - transform.f) / transform.e).astype(np.int64)
+    col = np.floor((np.asarray(x, dtype=np.float64) - transform.c) / transform.a).astype(np.int64)
+    unclipped = np.stack([row - rows, row + rows + 1, col - cols, col + cols + 1], axis=1)
+    windows = unclipped.copy()
+    windows[:, :2] = np.clip(windows[:, :2], 0, shape[0])
+    windows[:, 2:] = np.clip(windows[:, 2:], 0, shape[1])
+    # Empty windows (villages outside the raster) get an empty part of the mask too
+    windows[:, 1] = np.maximum(windows[:, 0], windows[:, 1])
+    windows[:, 3] = np.maximum(windows[:, 2], windows[:, 3])
+    return windows, windows - unclipped[:, [0, 0, 2, 2]]
+
+
+def read_windows(dataset: RasterReader, windows: np.ndarray, band: int | None = 1) -> list[np.ndarray]:
+    """
+    Read a band of the raster, or every band at once, once for each window.
+
+    :param dataset: Raster opened with a RasterReader
+    :type dataset: RasterReader
+    :param windows: Array of shape (n, 4) of the windows (row_start, row_stop, col_start, col_stop)
+    :type windows: np.ndarray
+    :param band: Band to read, starting at 1, or None to read every band
+    :type band: int | None
+    :return: The pixels of each window, of shape (height, width) or (bands, height, width)
+    :rtype: list[np.ndarray]
+    """
+    return [dataset.read(window, band) for window in windows]
+
+
+def crop_windows(arrays: list[np.ndarray], windows: np.ndarray, outer: np.ndarray) -> list[np.ndarray]:
+    """
+    Crop the pixels of smaller windows out of the larger windows already read, without reading the raster again.
+    The smaller windows must be nested in the larger ones, which is the case of the windows of concentric buffers.
+    The windows of every band of a stack are cropped at once.
+
+    :param arrays: The pixels of each larger window
+    :type arrays: list[np.ndarray]
+    :param windows: Array of shape (n, 4) of the smaller windows (row_start, row_stop, col_start, col_stop)
+    :type windows: np.ndarray
+    :param outer: Array of shape (n, 4) of the larger windows the pixels were read from
+    :type outer: np.ndarray
+    :return: The pixels of each smaller window, as views of the larger ones
+    :rtype: list[np.ndarray]
+    """
+    relative = windows - outer[:, [0, 0, 2, 2]]
+    return [array[..., r0:r1, c0:c1] for array, (r0, r1, c0, c1) in zip(arrays, relative)]
+
+
+def group_windows(
+    arrays: list[np.ndarray],
+    keys: np.ndarray | None = None
+) -> Iterator[tuple[np.ndarray, np.ndarray, tuple[int, ...]]]:
+    """
+    Group the windows having the same shape (and the same key, if any) so they can be stacked and reduced together.
+    The keys are used to group the windows sharing the same part of a buffer mask, so a single mask is broadcast over
+    the whole stack.
+
+    :param arrays: The pixels of each window
+    :type arrays: list[np.ndarray]
+    :param keys: Array of shape (n, m) of the keys of the windows
+    :type keys: np.ndarray | None
+    :return: The positions of the windows in the list, their pixels stacked in an array of shape (k, height, width) (or
+        (k, bands, height, width) for the windows of every band of a stack) and their key
+    :rtype: Iterator[tuple[np.ndarray, np.ndarray, tuple[int, ...]]]
+    """
+    groups: dict[tuple[tuple[int, ...], tuple[int, ...]], list[int]] = {}
+    for i, array in enumerate(arrays):
+        key = () if keys is None else tuple(keys[i].tolist())
+        groups.setdefault((array.shape, key), []).append(i)
+    for (shape, key), positions in groups.items():
+        yield np.asarray(positions), np.stack([arrays[i] for i in positions]).reshape(len(positions), *shape), key
+
+
+def reduce_windows(
+    stack: np.ndarray,
+    statistics: list[str],
+    nodata: float | None = None,
+    weights: np.ndarray | None = None,
+    scale: float = 1.,
+    offset: float = 0.
+) -> dict[str, np.ndarray]:
+    """
+    Reduce a stack of windows of shape (k, height, width) to one value per window for every statistic at once.
+    The pixels are reduced in their own dtype: the nodata pixels are skipped with the where argument of the reductions
+    of NumPy instead of being replaced by NaN in a float64 copy, and the sums are accumulated in float64. The count is
+    computed once, the sum only for the statistics needing it (the sum, the mean and the standard deviation) and the
+    sum of squares only for the standard deviation.
+    The scale and the offset of the raster (value = raw * scale + offset) are applied to the values reduced, not to
+    every pixel.
+    The nodata pixels are ignored, windows without valid pixels give a sum of 0 and NaN for the other statistics, and
+    empty windows give NaN.
+    With weights (a buffer mask of shape (height, width) shared by the whole stack), the pixels of weight 0 are ignored
+    and the sum, the count, the mean and the standard deviation are weighted.
+
+    :param stack: Stack of windows
+    :type stack: np.ndarray
+    :param statistics: Statistics to compute among 'sum', 'min', 'mean', 'max', 'count' and 'std'
+    :type statistics: list[str]
+    :param nodata: Value of the pixels to ignore
+    :type nodata: float | None
+    :param weights: Weight of each pixel of the windows
+    :type weights: np.ndarray | None
+    :param scale: Scale factor of the values of the raster
+    :type scale: float
+    :param offset: Offset of the values of the raster
+    :type offset: float
+    :return: The values of each statistic
+    :rtype: dict[str, np.ndarray]
+    """
+    unknown = set(statistics) - set(REDUCTIONS)
+    if unknown:
+        raise UserWarning(f"Unknown statistics {sorted(unknown)}, choose among {REDUCTIONS}")
+    values = stack.reshape(len(stack), -1)
+    if weights is not None:
+        # The mask is the same for the whole stack so the pixels outside the buffer are dropped once for all windows
+        weights = weights.ravel()
+        values, weights = values[:, weights > 0], weights[weights > 0].astype(np.float64)
+    if values.shape[1] == 0:
+        return {statistic: np.full(len(values), np.nan) for statistic in statistics}
+    floating = values.dtype.kind == "f"
+    valid = np.ones(values.shape, dtype=bool) if nodata is None else values != nodata
+    if floating:
+        valid &= ~np.isnan(values)
+    summed = {"sum", "mean", "std"} & set(statistics)
+    if weights is None:
+        count = valid.sum(axis=1).astype(np.float64)
+        total = values.sum(axis=1, dtype=np.float64, where=valid) if summed else None
+    else:
+        values = np.where(valid, values, 0)
+        count = valid @ weights
+        total = values @ weights if summed else None
+    result = {"count": count}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if summed:
+            result["sum"] = total * scale + count * offset
+            mean = np.where(count > 0, total / count, np.nan)
+            result["mean"] = mean * scale + offset
+        if "min" in statistics or "max" in statistics:
+            info = np.finfo(values.dtype) if floating else np.iinfo(values.dtype)
+            lowest = np.min(values, axis=1, initial=info.max, where=valid).astype(np.float64)
+            highest = np.max(values, axis=1, initial=info.min, where=valid).astype(np.float64)
+            lowest, highest = np.where(count > 0, lowest, np.nan), np.where(count > 0, highest, np.nan)
+            # A negative scale swaps the minimum and the maximum
+            if scale < 0:
+                lowest, highest = highest, lowest
+            result["min"], result["max"] = lowest * scale + offset, highest * scale + offset
+        if "std" in statistics:
+            squares = np.square(values, dtype=np.float64)
+            squares = squares.sum(axis=1, where=valid) if weights is None else squares @ weights
+            result["std"] = np.sqrt(np.maximum(squares / count - mean ** 2, 0.)) * abs(scale)
+    return {statistic: result[statistic] for statistic in statistics}
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from INPMT.processing import LAYERS, get_urban_profile
+from INPMT.utils.benchmark import PARKS, RASTERS, VILLAGES, make_dataset
+from INPMT.utils.raster import RasterReader
+
+
+@pytest.fixture(scope="session")
+def datasets(tmp_path_factory):
+    """
+    A small synthetic copy of the datasets, written once for the whole session.
+    """
+    path = str(tmp_path_factory.mktemp("datasets"))
+    make_dataset(path, villages=60, parks=5, extent=60000.)
+    return path
+
+
+@pytest.fixture
+def rasters(datasets):
+    rasters = [RasterReader(os.path.join(datasets, LAYERS[name].file), name=name) for name in RASTERS]
+    yield rasters
+    for dataset in rasters:
+        dataset.close()
+
+
+@pytest.fixture
+def run_profile(datasets, rasters):
+    """
+    Compute the profile of the synthetic villages, with the arguments of ***get_urban_profile*** given.
+    """
+    def run_profile(**kwargs):
+        return get_urban_profile(
+            datasets=datasets,
+            villages=os.path.join(datasets, VILLAGES),
+            parks=os.path.join(datasets, PARKS),
+            rasters=rasters,
+            **kwargs,
+        )
+    return run_profile
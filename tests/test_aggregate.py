@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from INPMT.utils.aggregate import RINGS, ParkAggregator, get_ring_labels
+
+
+@pytest.fixture
+def profile():
+    rng = np.random.default_rng(0)
+    profile = pd.DataFrame({"PREVALENCE_500": rng.random(300), "NDVI_mean_500": rng.random(300)})
+    profile.loc[::9, "NDVI_mean_500"] = np.nan
+    for n in range(1, 4):
+        profile[f"NP_{n}"] = rng.choice(["A", "B", "C", None], 300)
+        profile[f"dist_NP_{n}"] = rng.uniform(-5000, 80000, 300)
+    return profile.assign(NP=profile["NP_1"], dist_NP=profile["dist_NP_1"])
+
+
+def get_parks_profile(profile, parks):
+    """
+    Reference of the profile of the parks: the villages stacked for each of their parks, then grouped with pandas.
+    """
+    columns = ["PREVALENCE_500", "NDVI_mean_500"]
+    stacked = pd.concat([
+        profile[columns].assign(NP=profile[park], dist_NP=profile[distance]) for park, distance in parks
+    ]).dropna(subset=["NP"])
+    labels = get_ring_labels(RINGS)
+    rings = np.where(stacked["dist_NP"] < 0, 0, np.searchsorted(RINGS, stacked["dist_NP"], side="right"))
+    grouped = stacked.assign(ring=np.asarray(labels)[rings]).groupby(["NP", "ring"])
+    expected = grouped[columns].mean().assign(villages=grouped.size()).reset_index()
+    return expected.set_index(["NP", "ring"])
+
+
+@pytest.mark.parametrize("nearest", [0, 1, 3])
+def test_park_aggregator_matches_pandas(profile, nearest):
+    aggregator = ParkAggregator(["PREVALENCE_500", "NDVI_mean_500", "POP_500"], nearest=nearest)
+    # The villages come in chunks
+    for start in range(0, len(profile), 80):
+        aggregator.add(profile.iloc[start:start + 80])
+    result = aggregator.to_dataframe().set_index(["NP", "ring"])
+    parks = [("NP", "dist_NP")] if not nearest else [(f"NP_{n}", f"dist_NP_{n}") for n in range(1, nearest + 1)]
+    expected = get_parks_profile(profile, parks)
+    assert sorted(result.index) == sorted(expected.index)
+    pd.testing.assert_frame_equal(result.loc[expected.index, expected.columns], expected, check_dtype=False)
+
+
+def test_park_aggregator_counts_the_village_for_each_of_its_parks(profile):
+    aggregator = ParkAggregator(["PREVALENCE_500"], nearest=3)
+    aggregator.add(profile)
+    villages = aggregator.to_dataframe()["villages"].sum()
+    assert villages == sum(profile[f"NP_{n}"].notna().sum() for n in range(1, 4))
+
+
+def test_park_aggregator_rings_must_increase():
+    with pytest.raises(UserWarning):
+        ParkAggregator(["PREVALENCE_500"], rings=(0, 5000, 1000))
@@ -0,0 +1,68 @@
+import dataclasses
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+from INPMT.processing import LAYERS
+from INPMT.utils.cache import get_geometry_keys
+from INPMT.utils.checkpoint import (
+    FINGERPRINTS,
+    read_checkpoint,
+    write_checkpoint,
+)
+from INPMT.utils.report import RunReport
+
+
+@pytest.fixture
+def keys():
+    return pd.Series(get_geometry_keys(gpd.GeoSeries([Point(0, 0), Point(1, 1), Point(2, 2)])))
+
+
+def test_read_checkpoint_keeps_the_villages_with_the_same_geometry(tmp_path, keys):
+    fingerprints = {"ndvi": "a", "swi": "b"}
+    write_checkpoint(tmp_path, pd.DataFrame({"NDVI_500": [1., 2., 3.]}), keys, fingerprints)
+    moved = keys.copy()
+    moved[1] = get_geometry_keys(gpd.GeoSeries([Point(5, 5)]))[0]
+    done = read_checkpoint(tmp_path, moved, fingerprints)
+    assert done.index.tolist() == [0, 2] and done.columns.tolist() == ["NDVI_500"]
+
+
+@pytest.mark.parametrize("fingerprints", [
+    {"ndvi": "a", "swi": "c"},
+    {"ndvi": "a"},
+    {"ndvi": "a", "swi": "b", "gws": "d"},
+])
+def test_read_checkpoint_refuses_other_rasters(tmp_path, keys, fingerprints):
+    write_checkpoint(tmp_path, pd.DataFrame({"NDVI_500": [1., 2., 3.]}), keys, {"ndvi": "a", "swi": "b"})
+    with pytest.raises(ValueError):
+        read_checkpoint(tmp_path, keys, fingerprints)
+
+
+def test_read_checkpoint_refuses_a_checkpoint_without_fingerprints(tmp_path, keys):
+    write_checkpoint(tmp_path, pd.DataFrame({"NDVI_500": [1., 2., 3.]}), keys, {})
+    (tmp_path / FINGERPRINTS).unlink()
+    with pytest.raises(ValueError):
+        read_checkpoint(tmp_path, keys, {})
+
+
+def test_resume_checkpoint(run_profile, tmp_path):
+    expected = run_profile(checkpoint=str(tmp_path), chunksize=20)
+    report = RunReport()
+    resumed = run_profile(checkpoint=str(tmp_path), chunksize=20, report=report)
+    pd.testing.assert_frame_equal(resumed, expected)
+    assert report.counters.get("villages_resumed") == len(expected)
+
+
+@pytest.mark.parametrize("settings", [
+    {"buffer_mask": "square"},
+    {"layers": {**LAYERS, "ndvi": dataclasses.replace(LAYERS["ndvi"], scale=0.001)}},
+    {"layers": {**LAYERS, "swi": dataclasses.replace(LAYERS["swi"], nodata=0)}},
+])
+def test_resume_checkpoint_with_other_settings(run_profile, tmp_path, settings):
+    run_profile(checkpoint=str(tmp_path), chunksize=20)
+    with pytest.raises(ValueError, match="other rasters or settings"):
+        run_profile(checkpoint=str(tmp_path), chunksize=20, **settings)
+    # Without the checkpoint, the statistics are the ones of the new settings
+    assert not run_profile(**settings).equals(run_profile())
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from INPMT.utils.corr import get_correlation, get_pearson, get_ranks
+
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(200, 5))
+    values[:, 1] += values[:, 0]
+    # Ties and large values
+    values[:, 2] = np.round(values[:, 2])
+    values[:, 3] = values[:, 3] * 1e6 + 1e9
+    return values
+
+
+def test_get_ranks_matches_pandas(values):
+    values = values.copy()
+    values[::7, 4] = np.nan
+    expected = pd.DataFrame(values).rank(method="average").to_numpy()
+    np.testing.assert_allclose(get_ranks(values), expected)
+    # Several arrays are ranked at once
+    np.testing.assert_allclose(get_ranks(np.stack([values, values[::-1]]))[1], expected[::-1])
+
+
+def test_get_pearson_matches_pandas(values):
+    values = values.copy()
+    values[::5, 0] = np.nan
+    values[::3, 4] = np.nan
+    correlation, count = get_pearson(values)
+    df = pd.DataFrame(values)
+    np.testing.assert_allclose(correlation, df.corr(method="pearson").to_numpy(), atol=1e-12)
+    valid = df.notna().astype(int)
+    np.testing.assert_array_equal(count, valid.T @ valid)
+
+
+def test_get_spearman_matches_pandas(values):
+    correlation, _ = get_correlation(values, method="spearman")
+    np.testing.assert_allclose(correlation, pd.DataFrame(values).corr(method="spearman").to_numpy(), atol=1e-12)
+
+
+def test_get_pearson_constant_column(values):
+    values = values.copy()
+    values[:, 2] = 1.
+    correlation, _ = get_pearson(values)
+    assert np.isnan(correlation[2, [0, 1, 3, 4]]).all()
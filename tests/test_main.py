@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+
+import INPMT.__main__ as main
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """
+    The rasters opened by the runs, kept to check they are closed afterwards.
+    """
+    opened = []
+    open_rasters = main.open_rasters
+
+    def recording_open_rasters(*args, **kwargs):
+        rasters = open_rasters(*args, **kwargs)
+        opened.extend(rasters)
+        return rasters
+    monkeypatch.setattr(main, "open_rasters", recording_open_rasters)
+    return opened
+
+
+def test_run_closes_the_rasters(datasets, tmp_path, opened):
+    profile = main.run(datasets, output=str(tmp_path / "profile.csv"), return_profile=True)
+    assert len(profile) == len(pd.read_csv(tmp_path / "profile.csv"))
+    assert opened and all(dataset.dataset.closed for dataset in opened)
+
+
+def test_run_closes_the_rasters_when_it_fails(datasets, tmp_path, opened):
+    with pytest.raises(UserWarning):
+        main.run(datasets, output=str(tmp_path / "profile.csv"), stack_layout="unknown")
+    assert opened and all(dataset.dataset.closed for dataset in opened)
@@ -0,0 +1,102 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, box
+
+from INPMT.processing import get_nearest_park, get_nearest_parks
+
+
+def get_nearest_park_loop(parks, geom_village):
+    """
+    The loop over the parks the spatial index replaced, kept as the reference of its results.
+    """
+    name, loc_np, res_dist = None, None, None
+    min_dist = 1000000000000000
+    for i in range(len(parks)):
+        dist = parks.loc[i, "geometry"].boundary.distance(geom_village.centroid)
+        if dist < min_dist:
+            min_dist = dist
+            name = parks.loc[i, "NAME"]
+            if parks.loc[i, "geometry"].contains(geom_village):
+                res_dist, loc_np = -min_dist, "P"
+            else:
+                res_dist, loc_np = min_dist, "B"
+    return res_dist, loc_np, name
+
+
+@pytest.fixture
+def parks():
+    rng = np.random.default_rng(0)
+    corners = rng.uniform(0, 100000, (30, 2))
+    sizes = rng.uniform(1000, 20000, (30, 2))
+    return gpd.GeoDataFrame(
+        {"NAME": [f"Park {i}" for i in range(30)]},
+        geometry=[box(x, y, x + w, y + h) for (x, y), (w, h) in zip(corners, sizes)],
+        crs="EPSG:3857",
+    )
+
+
+@pytest.mark.parametrize("radius", [0, 2000])
+def test_get_nearest_park_matches_loop(parks, radius):
+    rng = np.random.default_rng(1)
+    villages = gpd.GeoSeries([Point(x, y) for x, y in rng.uniform(-10000, 110000, (200, 2))], crs="EPSG:3857")
+    geom_villages = villages.buffer(radius) if radius else villages
+    result = get_nearest_park(parks, geom_villages)
+    for i, geom in geom_villages.items():
+        dist, loc_np, name = get_nearest_park_loop(parks, geom)
+        assert result.loc[i, "dist_NP"] == pytest.approx(dist)
+        assert result.loc[i, "loc_NP"] == loc_np
+        assert result.loc[i, "NP"] == name
+
+
+def test_get_nearest_park_keeps_the_first_of_ties():
+    parks = gpd.GeoDataFrame({"NAME": ["A", "B"]}, geometry=[box(0, 0, 10, 10), box(20, 0, 30, 10)])
+    result = get_nearest_park(parks, gpd.GeoSeries([Point(15, 5)], index=[7]))
+    assert result.loc[7, "NP"] == get_nearest_park_loop(parks, Point(15, 5))[2] == "A"
+
+
+def test_get_nearest_park_without_parks(parks):
+    result = get_nearest_park(parks.iloc[:0], gpd.GeoSeries([Point(0, 0)]))
+    assert result["NP"].isna().all()
+
+
+def get_nearest_parks_loop(parks, geom_village, k, max_distance):
+    """
+    Brute-force reference of the k nearest parks: every park in reach, ranked by distance, the first one on ties.
+    """
+    found = []
+    for i in range(len(parks)):
+        geometry = parks.loc[i, "geometry"]
+        dist = geometry.boundary.distance(geom_village.centroid)
+        inside = geometry.contains(geom_village)
+        if dist <= max_distance or geom_village.within(geometry):
+            found.append((dist, i, parks.loc[i, "NAME"], "P" if inside else "B", -dist if inside else dist))
+    return [found_park[2:] for found_park in sorted(found)[:k]]
+
+
+@pytest.mark.parametrize("radius", [0, 2000])
+def test_get_nearest_parks_matches_loop(parks, radius):
+    rng = np.random.default_rng(2)
+    villages = gpd.GeoSeries([Point(x, y) for x, y in rng.uniform(-10000, 110000, (200, 2))], crs="EPSG:3857")
+    geom_villages = villages.buffer(radius) if radius else villages
+    result = get_nearest_parks(parks, geom_villages, k=3, max_distance=5000.)
+    for i, geom in geom_villages.items():
+        expected = get_nearest_parks_loop(parks, geom, 3, 5000.)
+        for n in range(1, 4):
+            if n > len(expected):
+                assert pd.isna(result.loc[i, f"NP_{n}"]) and np.isnan(result.loc[i, f"dist_NP_{n}"])
+                continue
+            name, loc_np, dist = expected[n - 1]
+            assert result.loc[i, f"NP_{n}"] == name
+            assert result.loc[i, f"loc_NP_{n}"] == loc_np
+            assert result.loc[i, f"dist_NP_{n}"] == pytest.approx(dist)
+
+
+def test_get_nearest_parks_keeps_the_park_containing_the_village():
+    parks = gpd.GeoDataFrame({"NAME": ["Large", "Small"]}, geometry=[box(0, 0, 400000, 400000), box(0, 0, 10, 10)])
+    villages = gpd.GeoSeries([Point(200000, 200000)], index=[3])
+    result = get_nearest_parks(parks, villages, k=2, max_distance=50000.)
+    assert result.loc[3, "NP_1"] == get_nearest_park(parks, villages).loc[3, "NP"] == "Large"
+    assert result.loc[3, "loc_NP_1"] == "P" and result.loc[3, "dist_NP_1"] == pytest.approx(-200000.)
+    assert pd.isna(result.loc[3, "NP_2"])
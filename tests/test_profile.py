@@ -0,0 +1,19 @@
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_spatial_order_gives_the_same_profile(run_profile, workers):
+    expected = run_profile(chunksize=16)
+    profile = run_profile(chunksize=16, spatial_order=True, workers=workers)
+    pd.testing.assert_frame_equal(profile, expected)
+
+
+def test_nearest_parks_are_rounded_like_the_nearest_park(run_profile):
+    profile = run_profile(nearest=3, max_distance=100000.)
+    for n in range(1, 4):
+        distances = profile[f"dist_NP_{n}"].dropna()
+        assert len(distances) and (distances == distances.round(3)).all()
+    # The nearest of the k parks is the nearest park
+    pd.testing.assert_series_equal(profile["dist_NP_1"], profile["dist_NP"], check_names=False)
+    assert (profile["NP_1"] == profile["NP"]).all()
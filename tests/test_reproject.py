@@ -0,0 +1,169 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from rasterio.warp import Resampling, calculate_default_transform, reproject
+from shapely.geometry import Point
+
+from INPMT.processing import (
+    get_buffer_windows,
+    get_zonal_stats,
+    validate_villages,
+)
+from INPMT.utils.layers import Layer
+from INPMT.utils.raster import RasterReader
+from INPMT.utils.zonal import (
+    get_local_resolution,
+    is_reprojected,
+    reproject_points,
+)
+
+# Extent of the raster in EPSG:3857: 60 km wide, at about 4° south like the synthetic datasets
+ORIGIN = (1000000., -440000.)
+SIZE, RESOLUTION = 600, 100.
+LAYERS = {"smooth": Layer("smooth", statistics=(("V_mean", "mean"), ("V_sum", "sum"), ("V_count", "count")))}
+
+
+def write_raster(path, values, transform, crs):
+    with rasterio.open(
+        path, "w", driver="GTiff", height=values.shape[0], width=values.shape[1], count=1, dtype="float32", crs=crs,
+        transform=transform, nodata=-9999.,
+    ) as dataset:
+        dataset.write(values.astype(np.float32), 1)
+
+
+@pytest.fixture(scope="module")
+def smooth_rasters(tmp_path_factory):
+    """
+    A smooth raster in EPSG:3857 and its copy reprojected in EPSG:4326, so their statistics only differ by the
+    geometry of the buffers and not by the noise of the resampling.
+    """
+    path = tmp_path_factory.mktemp("reproject")
+    transform = from_origin(*ORIGIN, RESOLUTION, RESOLUTION)
+    rows, cols = np.mgrid[0:SIZE, 0:SIZE] + 0.5
+    values = 100 + 50 * np.sin(cols * RESOLUTION / 7000) + 30 * np.cos(rows * RESOLUTION / 5000)
+    write_raster(path / "smooth_3857.tif", values, transform, "EPSG:3857")
+    bounds = (ORIGIN[0], ORIGIN[1] - SIZE * RESOLUTION, ORIGIN[0] + SIZE * RESOLUTION, ORIGIN[1])
+    geographic, width, height = calculate_default_transform("EPSG:3857", "EPSG:4326", SIZE, SIZE, *bounds)
+    reprojected = np.full((height, width), -9999., dtype=np.float32)
+    reproject(
+        values.astype(np.float32), reprojected, src_transform=transform, src_crs="EPSG:3857", dst_nodata=-9999.,
+        dst_transform=geographic, dst_crs="EPSG:4326", resampling=Resampling.bilinear,
+    )
+    write_raster(path / "smooth_4326.tif", reprojected, geographic, "EPSG:4326")
+    return str(path / "smooth_3857.tif"), str(path / "smooth_4326.tif")
+
+
+@pytest.fixture
+def villages():
+    rng = np.random.default_rng(0)
+    margin = 5000.
+    x = rng.uniform(ORIGIN[0] + margin, ORIGIN[0] + SIZE * RESOLUTION - margin, 40)
+    y = rng.uniform(ORIGIN[1] - SIZE * RESOLUTION + margin, ORIGIN[1] - margin, 40)
+    return gpd.GeoSeries([Point(point) for point in zip(x, y)], crs="EPSG:3857")
+
+
+def test_is_reprojected():
+    assert not is_reprojected("EPSG:3857", "EPSG:3857")
+    assert not is_reprojected(None, "EPSG:4326")
+    assert is_reprojected("EPSG:3857", "EPSG:4326")
+
+
+def test_reproject_points_matches_pyproj(villages):
+    x, y = villages.x.to_numpy(), villages.y.to_numpy()
+    lon, lat = reproject_points(x, y, "EPSG:3857", "EPSG:4326")
+    expected = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True).transform(x, y)
+    np.testing.assert_allclose(lon, expected[0])
+    np.testing.assert_allclose(lat, expected[1])
+    # The points come back where they were
+    back = reproject_points(lon, lat, "EPSG:4326", "EPSG:3857")
+    np.testing.assert_allclose(np.column_stack(back), np.column_stack([x, y]))
+
+
+def test_get_local_resolution_matches_mercator():
+    transform = from_origin(0., 60., 0.01, 0.01)
+    lat = np.array([-30., 0., 15., 45.])
+    lon = np.zeros(len(lat))
+    sizes = get_local_resolution(transform, "EPSG:4326", lon, lat, "EPSG:3857")
+    radius = 6378137.
+    width = radius * np.radians(0.01)
+    mercator = lambda latitude: radius * np.log(np.tan(np.pi / 4 + np.radians(latitude) / 2))
+    height = mercator(lat + 0.005) - mercator(lat - 0.005)
+    # The sizes keep the sign of the transform and are rounded to 3 significant digits
+    np.testing.assert_allclose(sizes[:, 0], width, rtol=5e-3)
+    np.testing.assert_allclose(sizes[:, 1], -height, rtol=5e-3)
+    assert (sizes[:, 1] < 0).all()
+
+
+def test_get_buffer_windows_of_a_reprojected_raster(smooth_rasters, villages):
+    dataset = RasterReader(smooth_rasters[1], name="smooth")
+    try:
+        transform = dataset.transform
+        x, y = reproject_points(villages.x.to_numpy(), villages.y.to_numpy(), villages.crs, dataset.crs)
+        masks, windows = get_buffer_windows(dataset, villages, [2000], "circle")
+        squares = get_buffer_windows(dataset, villages, [2000], "square")[1][2000][0]
+    finally:
+        dataset.close()
+    outer, keys = windows[2000]
+    for village in range(len(villages)):
+        mask = masks[2000][keys[village, 0]]
+        # The central pixel of the mask is the pixel of the raster containing the reprojected village
+        row = outer[village, 0] - keys[village, 1] + mask.shape[0] // 2
+        col = outer[village, 2] - keys[village, 3] + mask.shape[1] // 2
+        assert row == int((y[village] - transform.f) // transform.e)
+        assert col == int((x[village] - transform.c) // transform.a)
+    # The squares hold the bounds of the buffers reprojected in the CRS of the raster
+    bounds = villages.buffer(2000).to_crs(dataset.crs).bounds.to_numpy()
+    assert (transform.c + squares[:, 2] * transform.a <= bounds[:, 0] + abs(transform.a)).all()
+    assert (transform.c + squares[:, 3] * transform.a >= bounds[:, 2] - abs(transform.a)).all()
+    assert (transform.f + squares[:, 0] * transform.e >= bounds[:, 3] - abs(transform.e)).all()
+    assert (transform.f + squares[:, 1] * transform.e <= bounds[:, 1] + abs(transform.e)).all()
+
+
+# The windows of the squares are snapped to the pixels on each side, the circles are centred on the villages
+@pytest.mark.parametrize("buffer_mask, tolerance", [("square", 0.02), ("circle", 0.005), ("coverage", 0.005)])
+def test_get_zonal_stats_of_a_reprojected_raster(smooth_rasters, villages, buffer_mask, tolerance):
+    projected, geographic = (RasterReader(path, name="smooth") for path in smooth_rasters)
+    try:
+        expected = get_zonal_stats(villages, [projected], [2000], {}, buffer_mask=buffer_mask, layers=LAYERS)
+        result = get_zonal_stats(villages, [geographic], [2000], {}, buffer_mask=buffer_mask, layers=LAYERS)
+        x, y = reproject_points(villages.x.to_numpy(), villages.y.to_numpy(), villages.crs, geographic.crs)
+        sizes = get_local_resolution(geographic.transform, geographic.crs, x, y, villages.crs)
+    finally:
+        projected.close()
+        geographic.close()
+    np.testing.assert_allclose(result["V_mean_2000"], expected["V_mean_2000"], rtol=tolerance)
+    # The buffers cover the same area, in the units of the CRS of the villages, whatever the CRS of the raster
+    area = result["V_count_2000"] * np.abs(sizes[:, 0] * sizes[:, 1])
+    np.testing.assert_allclose(area, expected["V_count_2000"] * RESOLUTION ** 2, rtol=0.05)
+    np.testing.assert_allclose(
+        result["V_sum_2000"] * np.abs(sizes[:, 0] * sizes[:, 1]), expected["V_sum_2000"] * RESOLUTION ** 2, rtol=0.05
+    )
+
+
+def test_validate_villages(smooth_rasters):
+    villages = gpd.GeoSeries([
+        Point(ORIGIN[0] + 30000., ORIGIN[1] - 30000.),
+        # The largest buffer crosses the left edge of the raster, not the smallest one
+        Point(ORIGIN[0] + 1000., ORIGIN[1] - 30000.),
+        Point(ORIGIN[0] - 100000., ORIGIN[1] - 30000.),
+        Point(),
+        None,
+    ], index=[10, 11, 12, 13, 14], crs="EPSG:3857")
+    rasters = [RasterReader(path, name=name) for path, name in zip(smooth_rasters, ["projected", "geographic"])]
+    try:
+        flags = validate_villages(villages, rasters, [500, 2000])
+        # A buffer of 500 m holds about 79 pixels of 100 m
+        pixels = validate_villages(villages, rasters[:1], [500, 2000], "circle", min_pixels=100)
+    finally:
+        for dataset in rasters:
+            dataset.close()
+    assert flags.index.tolist() == [10, 11, 12, 13, 14]
+    assert flags[10] is None
+    assert flags[11] == "edge projected;edge geographic"
+    assert flags[12] == "outside projected;pixels projected;outside geographic;pixels geographic"
+    assert flags[13] == flags[14] == "geometry"
+    assert pixels[10] == "pixels projected"
+    assert pixels[11] == "edge projected;pixels projected"
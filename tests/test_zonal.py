@@ -0,0 +1,252 @@
+import numpy as np
+import pandas as pd
+import pytest
+from affine import Affine
+
+from INPMT.processing import get_landuse, get_lookup_table
+from INPMT.utils.zonal import (
+    SUBPIXEL_BINS,
+    crop_windows,
+    get_buffer_mask,
+    get_centred_windows,
+    get_subpixel_offsets,
+    get_windows,
+    reduce_windows,
+)
+
+NODATA = -1
+
+
+def reduce_window(window, nodata, weights, scale, offset):
+    """
+    Reference of the statistics of a single window, computed on the real values of its valid pixels.
+    """
+    values = window.ravel().astype(np.float64)
+    weights = np.ones(values.shape) if weights is None else weights.ravel()
+    valid = (values != nodata) & ~np.isnan(values) & (weights > 0)
+    values, weights = values[valid] * scale + offset, weights[valid]
+    if not len(values):
+        return {"sum": 0., "count": 0., "mean": np.nan, "min": np.nan, "max": np.nan, "std": np.nan}
+    mean = np.average(values, weights=weights)
+    return {
+        "sum": (values * weights).sum(),
+        "count": weights.sum(),
+        "mean": mean,
+        "min": values.min(),
+        "max": values.max(),
+        "std": np.sqrt(np.average((values - mean) ** 2, weights=weights)),
+    }
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint8, np.float32])
+@pytest.mark.parametrize("weighted", [False, True])
+@pytest.mark.parametrize("scale, offset", [(1., 0.), (0.0001, 0.), (-2., 10.)])
+def test_reduce_windows_matches_reference(dtype, weighted, scale, offset):
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 100, (20, 7, 9)).astype(dtype)
+    nodata = 255 if dtype == np.uint8 else NODATA
+    stack[rng.random(stack.shape) < 0.2] = nodata
+    # A window without any valid pixel
+    stack[3] = nodata
+    if dtype == np.float32:
+        stack[5, :2] = np.nan
+    weights = rng.random((7, 9)) * (rng.random((7, 9)) > 0.3) if weighted else None
+    statistics = ["sum", "min", "mean", "max", "count", "std"]
+    result = reduce_windows(stack, statistics, nodata, weights, scale, offset)
+    for i, window in enumerate(stack):
+        expected = reduce_window(window, nodata, weights, scale, offset)
+        for statistic in statistics:
+            assert result[statistic][i] == pytest.approx(expected[statistic], rel=1e-6, abs=1e-9, nan_ok=True)
+
+
+@pytest.mark.parametrize("statistics", [["min"], ["max", "count"], ["std"], ["mean", "sum"]])
+def test_reduce_windows_subset_of_statistics(statistics):
+    rng = np.random.default_rng(2)
+    stack = rng.integers(-1, 50, (10, 4, 5)).astype(np.int16)
+    result = reduce_windows(stack, statistics, NODATA, scale=0.5, offset=1.)
+    assert list(result) == statistics
+    for i, window in enumerate(stack):
+        expected = reduce_window(window, NODATA, None, 0.5, 1.)
+        for statistic in statistics:
+            assert result[statistic][i] == pytest.approx(expected[statistic], nan_ok=True)
+
+
+def test_reduce_windows_empty_windows():
+    result = reduce_windows(np.zeros((4, 0, 0), dtype=np.int16), ["sum", "mean", "std"], NODATA)
+    for values in result.values():
+        assert values.shape == (4,) and np.isnan(values).all()
+
+
+def test_reduce_windows_unknown_statistic():
+    with pytest.raises(UserWarning):
+        reduce_windows(np.zeros((1, 2, 2)), ["median"])
+
+
+@pytest.fixture
+def lookup_table():
+    qml = [["10", "Cropland"], ["20", "Cropland"], ["50", "Forest"], ["60", "Forest"], ["210", "Water"]]
+    return qml, get_lookup_table(qml, unknown="Unknown")
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_get_landuse_matches_pandas(lookup_table, weighted):
+    qml, table = lookup_table
+    legend = {}
+    for value, label in qml:
+        legend.setdefault(int(value), label)
+    rng = np.random.default_rng(0)
+    stack = rng.choice([0, 10, 20, 50, 60, 100, 210, 255], (15, 5, 6)).astype(np.uint8)
+    weights = rng.random((5, 6)) * (rng.random((5, 6)) > 0.3) if weighted else None
+    proportions, distinct = get_landuse(stack, table, weights)
+    assert proportions.shape == (len(stack), len(table[2]))
+    flat_weights = np.ones(30) if weights is None else weights.ravel()
+    for i, window in enumerate(stack):
+        pixels = pd.DataFrame({"value": window.ravel(), "weight": flat_weights})
+        pixels = pixels[pixels["weight"] > 0]
+        labels = pixels["value"].map(legend).fillna("Unknown")
+        expected = pixels["weight"].groupby(labels).sum() * 100 / pixels["weight"].sum()
+        expected = expected.reindex(table[2], fill_value=0.)
+        np.testing.assert_allclose(proportions[i], expected.to_numpy())
+        assert distinct[i] == pixels["value"].nunique()
+
+
+def test_get_landuse_empty_windows(lookup_table):
+    _, table = lookup_table
+    proportions, distinct = get_landuse(np.zeros((3, 0, 0), dtype=np.uint8), table)
+    assert np.isnan(proportions).all()
+    assert np.isnan(distinct).all()
+    # A mask without any pixel leaves the windows empty too
+    proportions, distinct = get_landuse(np.full((2, 3, 3), 10, dtype=np.uint8), table, np.zeros((3, 3)))
+    assert np.isnan(proportions).all() and np.isnan(distinct).all()
+
+
+def clip_window(transform, shape, bounds):
+    """
+    Window of the former clip function: the pixels between the ones whose centre is the nearest to the bounds.
+    """
+    xs = transform.c + (np.arange(shape[1]) + 0.5) * transform.a
+    ys = transform.f + (np.arange(shape[0]) + 0.5) * transform.e
+    x_min, y_min, x_max, y_max = bounds
+    nearest = lambda coordinates, value: int(np.argmin(np.abs(coordinates - value)))
+    return nearest(ys, y_max), nearest(ys, y_min) + 1, nearest(xs, x_min), nearest(xs, x_max) + 1
+
+
+@pytest.fixture
+def raster():
+    transform = Affine(300., 0., 1000000., 0., -300., 1300000.)
+    return transform, (1000, 1000)
+
+
+def test_get_windows_matches_clip(raster):
+    transform, shape = raster
+    rng = np.random.default_rng(0)
+    centres = rng.uniform(1010000., 1290000., (500, 2))
+    radii = rng.uniform(100., 5000., (500, 1))
+    bounds = np.hstack([centres - radii, centres + radii])
+    windows = get_windows(transform, bounds, shape)
+    for window, bound in zip(windows, bounds):
+        assert tuple(window) == clip_window(transform, shape, bound)
+
+
+def test_get_windows_outside_the_raster(raster):
+    transform, shape = raster
+    windows = get_windows(transform, [[0., 0., 1000., 1000.], [1299000., 1299000., 1400000., 1400000.]], shape)
+    assert (windows[0, 1] - windows[0, 0]) * (windows[0, 3] - windows[0, 2]) == 0
+    # The window of a geometry partly outside the raster keeps only the pixels which exist
+    assert tuple(windows[1]) == (0, 4, 996, 1000)
+
+
+def test_crop_windows_matches_clip(raster):
+    transform, shape = raster
+    image = np.arange(shape[0] * shape[1]).reshape(shape)
+    rng = np.random.default_rng(1)
+    centres = rng.uniform(1010000., 1290000., (100, 2))
+    outer = get_windows(transform, np.hstack([centres - 2000., centres + 2000.]), shape)
+    inner = get_windows(transform, np.hstack([centres - 500., centres + 500.]), shape)
+    arrays = [image[r0:r1, c0:c1] for r0, r1, c0, c1 in outer]
+    for array, centre in zip(crop_windows(arrays, inner, outer), centres):
+        r0, r1, c0, c1 = clip_window(transform, shape, [*(centre - 500.), *(centre + 500.)])
+        np.testing.assert_array_equal(array, image[r0:r1, c0:c1])
+
+
+@pytest.mark.parametrize("resolution", [(300., -300.), (1000., -1000.), (250., -400.)])
+@pytest.mark.parametrize("offset", [(0., 0.), (0.375, -0.125), (-0.375, 0.375)])
+def test_get_buffer_mask_matches_pixel_centres(resolution, offset):
+    width, height = abs(resolution[0]), abs(resolution[1])
+    for radius in (500, 2000, 3100):
+        mask = get_buffer_mask(resolution, radius, offset=offset)
+        rows, cols = mask.shape[0] // 2, mask.shape[1] // 2
+        assert mask.shape == (2 * rows + 1, 2 * cols + 1)
+        # Distance of the centre of each pixel to the centre of the buffer, the village being in the central pixel
+        dy = (np.arange(-rows, rows + 1)[:, None] - offset[1]) * height
+        dx = (np.arange(-cols, cols + 1)[None, :] - offset[0]) * width
+        inside = dx ** 2 + dy ** 2 <= radius ** 2
+        if inside.any():
+            np.testing.assert_array_equal(mask, inside)
+            # The mask is large enough to hold the whole circle: the pixels beyond it are further than the radius
+            assert (rows + 1 - abs(offset[1])) * height > radius and (cols + 1 - abs(offset[0])) * width > radius
+        else:
+            assert mask.sum() == 1 and mask[rows, cols] == 1
+
+
+def test_get_buffer_mask_keeps_the_pixel_of_the_village():
+    # No pixel centre is closer than 500 m to a village in the corner of a 1 km pixel
+    mask = get_buffer_mask((1000., -1000.), 500, offset=(0.375, 0.375))
+    assert mask.sum() == 1 and mask[mask.shape[0] // 2, mask.shape[1] // 2] == 1
+
+
+@pytest.mark.parametrize("offset", [(0., 0.), (0.375, -0.125)])
+def test_get_buffer_mask_coverage(offset):
+    resolution, radius = (300., -300.), 2000
+    weights = get_buffer_mask(resolution, radius, coverage=True, offset=offset, samples=16)
+    assert ((weights >= 0) & (weights <= 1)).all()
+    # The weights add up to the area of the circle, in pixels
+    assert weights.sum() == pytest.approx(np.pi * radius ** 2 / 300 ** 2, rel=0.01)
+    # The pixels whose centre is in the circle are mostly covered
+    assert (weights[get_buffer_mask(resolution, radius, offset=offset) > 0] > 0.4).all()
+
+
+def test_get_subpixel_offsets(raster):
+    transform, _ = raster
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(1000000., 1300000., 500), rng.uniform(1000000., 1300000., 500)
+    offsets = get_subpixel_offsets(transform, x, y)
+    assert np.isin(offsets, (np.arange(SUBPIXEL_BINS) + 0.5) / SUBPIXEL_BINS - 0.5).all()
+    # The centre of the bin is half a bin away from the village at most, along each axis
+    col, row = (x - transform.c) / transform.a, (y - transform.f) / transform.e
+    positions = np.stack([col - np.floor(col) - 0.5, row - np.floor(row) - 0.5], axis=1)
+    assert (np.abs(offsets - positions) <= 0.5 / SUBPIXEL_BINS + 1e-9).all()
+    # The villages without coordinates get an offset anyway
+    assert np.isfinite(get_subpixel_offsets(transform, [np.nan], [np.nan])).all()
+
+
+def test_get_centred_windows_covers_the_buffer(raster):
+    transform, shape = raster
+    rng = np.random.default_rng(3)
+    # Villages inside the raster, at its edges and outside it
+    x = np.concatenate([rng.uniform(1000000., 1300000., 30), [1000100., 1299900., 900000., 1400000.]])
+    y = np.concatenate([rng.uniform(1000000., 1300000., 30), [1299900., 1000100., 900000., 1400000.]])
+    radius = 1000
+    offsets = get_subpixel_offsets(transform, x, y)
+    tolerance = np.hypot(transform.a, transform.e) / SUBPIXEL_BINS
+    for village, (dx, dy) in enumerate(offsets):
+        mask = get_buffer_mask((transform.a, transform.e), radius, offset=(dx, dy))
+        windows, parts = get_centred_windows(transform, x[[village]], y[[village]], mask.shape, shape)
+        (r0, r1, c0, c1), (m0, m1, n0, n1) = windows[0], parts[0]
+        assert (r1 - r0, c1 - c0) == (m1 - m0, n1 - n0)
+        assert 0 <= r0 <= r1 <= shape[0] and 0 <= c0 <= c1 <= shape[1]
+        # The pixels of the raster selected by the window and its part of the mask
+        rows, cols = np.nonzero(mask[m0:m1, n0:n1])
+        selected = np.zeros(shape, dtype=bool)
+        selected[r0 + rows, c0 + cols] = True
+        # The pixels whose centre is in the buffer, up to the shift of the centre of the buffer to the centre of its bin
+        all_rows, all_cols = np.mgrid[0:shape[0], 0:shape[1]]
+        distances = np.hypot(
+            transform.c + (all_cols + 0.5) * transform.a - x[village],
+            transform.f + (all_rows + 0.5) * transform.e - y[village],
+        )
+        assert (distances[selected] <= radius + tolerance).all()
+        assert selected[distances <= radius - tolerance].all()
+    windows, parts = get_centred_windows(transform, [900000.], [900000.], (7, 7), shape)
+    assert (windows[0, 1] - windows[0, 0]) * (windows[0, 3] - windows[0, 2]) == 0
+    assert (parts[0, 1] - parts[0, 0]) * (parts[0, 3] - parts[0, 2]) == 0